@@ -4,17 +4,18 @@ from __future__ import annotations
 
 from json import load
 from pathlib import Path
-from typing import Any, Optional
+from typing import TYPE_CHECKING, Any, Optional
 from zipfile import ZipFile
 
-import pandas as pd
-from omegaconf import DictConfig
-
 from plinder.core.utils import gcs
 from plinder.core.utils.config import get_config
 from plinder.core.utils.dec import timeit
 from plinder.core.utils.log import setup_logger
 
+if TYPE_CHECKING:
+    import pandas as pd
+    from omegaconf import DictConfig
+
 LOG = setup_logger(__name__)
 
 _PLINDEX = None
@@ -39,6 +40,8 @@ def get_plindex(
     pd.DataFrame
         the plindex
     """
+    import pandas as pd
+
     global _PLINDEX
 
     if _PLINDEX is not None:
@@ -78,6 +81,8 @@ def get_manifest(
     pd.DataFrame
         the manifest
     """
+    import pandas as pd
+
     global _MANIFEST
 
     if _MANIFEST is not None:
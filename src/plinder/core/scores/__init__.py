@@ -1,11 +1,28 @@
 # Copyright (c) 2024, Plinder Development Team
 # Distributed under the terms of the Apache License 2.0
-from .clusters import query_clusters
-from .ligand import query_ligand_similarity
-from .protein import query_protein_similarity
+from importlib import import_module
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from .clusters import query_clusters
+    from .ligand import query_ligand_similarity
+    from .protein import query_protein_similarity
 
 __all__ = [
     "query_ligand_similarity",
     "query_protein_similarity",
     "query_clusters",
 ]
+
+# submodules (and their dependencies) are imported on first attribute access
+_LAZY = {
+    "query_clusters": "clusters",
+    "query_ligand_similarity": "ligand",
+    "query_protein_similarity": "protein",
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name in _LAZY:
+        return getattr(import_module(f"{__name__}.{_LAZY[name]}"), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
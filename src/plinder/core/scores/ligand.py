@@ -2,8 +2,7 @@
 # Distributed under the terms of the Apache License 2.0
 from __future__ import annotations
 
-import pandas as pd
-from duckdb import sql
+from typing import TYPE_CHECKING
 
 from plinder.core.scores.query import ensure_dataset, make_query
 from plinder.core.utils.config import get_config
@@ -11,6 +10,9 @@ from plinder.core.utils.dec import timeit
 from plinder.core.utils.log import setup_logger
 from plinder.core.utils.schemas import TANIMOTO_SCORE_SCHEMA
 
+if TYPE_CHECKING:
+    import pandas as pd
+
 LOG = setup_logger(__name__)
 
 
@@ -36,6 +38,8 @@ def query_ligand_similarity(
     df : pd.DataFrame | None
         the protein similarity results
     """
+    from duckdb import sql
+
     cfg = get_config()
     dataset = ensure_dataset(rel=cfg.data.ligand_scores)
     query = make_query(
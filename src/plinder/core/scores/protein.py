@@ -2,14 +2,20 @@
 # Distributed under the terms of the Apache License 2.0
 from __future__ import annotations
 
-import pandas as pd
-from duckdb import sql
+from typing import TYPE_CHECKING
 
-from plinder.core.scores.query import ensure_dataset, make_query
+from plinder.core.scores.query import ensure_dataset, make_query, make_wide_query
 from plinder.core.utils.config import get_config
 from plinder.core.utils.dec import timeit
 from plinder.core.utils.log import setup_logger
-from plinder.core.utils.schemas import PROTEIN_SIMILARITY_SCHEMA
+from plinder.core.utils.schemas import (
+    PROTEIN_SIMILARITY_METRICS,
+    PROTEIN_SIMILARITY_SCHEMA,
+    PROTEIN_SIMILARITY_WIDE_SCHEMA,
+)
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 LOG = setup_logger(__name__)
 
@@ -20,6 +26,7 @@ def query_protein_similarity(
     search_db: str,
     columns: list[str] | None = None,
     filters: list[tuple[str, str, str]] | None = None,
+    layout: str = "long",
 ) -> pd.DataFrame | None:
     """
     Query the protein similarity database for
@@ -33,27 +40,47 @@ def query_protein_similarity(
         the columns to return
     filters : list[tuple[str, str, str]]
         the filters to apply
+    layout : str, default="long"
+        the on-disk score layout to read, one of "long" or "wide".
+        Results are returned in the long format either way, but
+        the wide layout only reads the metric columns selected by
+        metric filters. Note that the wide layout does not store
+        the per-metric source and mapping columns.
 
     Returns
     -------
     df : pd.DataFrame | None
         the protein similarity results
     """
+    from duckdb import sql
+
     if search_db not in ["apo", "holo", "pred"]:
         raise ValueError(f"search_db={search_db} not in ['apo', 'holo', 'pred']")
+    if layout not in ["long", "wide"]:
+        raise ValueError(f"layout={layout} not in ['long', 'wide']")
     cfg = get_config()
     if isinstance(filters, list):
         for i, (col, _, _) in enumerate(filters):
             if col == "search_db":
                 filters = filters[:i] + filters[i + 1 :]
                 break
-    dataset = ensure_dataset(rel=f"{cfg.data.scores}/search_db={search_db}")
-    query = make_query(
-        schema=PROTEIN_SIMILARITY_SCHEMA,
-        dataset=dataset,
-        filters=filters,
-        columns=columns,
-    )
+    if layout == "wide":
+        dataset = ensure_dataset(rel=f"{cfg.data.scores_wide}/search_db={search_db}")
+        query = make_wide_query(
+            schema=PROTEIN_SIMILARITY_WIDE_SCHEMA,
+            dataset=dataset,
+            metrics=PROTEIN_SIMILARITY_METRICS,
+            filters=filters,
+            columns=columns,
+        )
+    else:
+        dataset = ensure_dataset(rel=f"{cfg.data.scores}/search_db={search_db}")
+        query = make_query(
+            schema=PROTEIN_SIMILARITY_SCHEMA,
+            dataset=dataset,
+            filters=filters,
+            columns=columns,
+        )
     if query is None:
         LOG.warning("try minimally passing filters=[('similarity', '>', 90)]")
         return None
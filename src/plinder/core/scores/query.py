@@ -160,6 +160,110 @@ def make_query(
     return f"{qry};"
 
 
+def make_wide_query(
+    schema: pa.Schema,
+    dataset: Path,
+    metrics: list[str],
+    columns: list[str] | None = None,
+    filters: list[tuple[str, str, str]] | None = None,
+) -> str | None:
+    """
+    Query a wide-format similarity dataset (one column per metric)
+    as if it were in the long format (one row per metric). Filters
+    on ``metric`` select which metric columns are read and all
+    remaining filters are applied to the unpivoted rows, so that
+    filters written against the long layout keep working.
+
+    Parameters
+    ----------
+    schema : pa.Schema
+        the pyarrow schema of the wide dataset
+    dataset : Path
+        the path to the dataset
+    metrics : list[str]
+        the metric columns available in the dataset
+    columns : list[str], default=None
+        the long-format columns to select
+    filters : list[tuple[str, str, str]], default=None
+        the long-format filters to apply
+
+    Returns
+    -------
+    query : str | None
+        the duckdb SQL query string
+    """
+    if filters is None or not len(filters):
+        LOG.error("no filters provided, aborting query generation!")
+        return None
+    info = [name for name in schema.names if name not in metrics]
+    long_schema = pa.schema(
+        [schema.field(name) for name in info]
+        + [("metric", pa.string()), ("similarity", pa.int8())]
+    )
+    selected = list(metrics)
+    wheres = []
+    similarity_wheres = []
+    for filter in filters:
+        if len(filter) != 3:
+            raise ValueError(f"filters must be (column, operator, value): got {filter}")
+        col, op, val = filter
+        if col not in long_schema.names:
+            raise ValueError(f"column={col} not in schema={long_schema.names}")
+        if col == "metric":
+            if val not in metrics:
+                raise ValueError(f"metric={val} not in metrics={metrics}")
+            if op in ["==", "="]:
+                selected = [metric for metric in selected if metric == val]
+            elif op == "!=":
+                selected = [metric for metric in selected if metric != val]
+            else:
+                raise ValueError(f"metric filters must use == or !=: got {filter}")
+            continue
+        val = _handle_condition_by_schema(long_schema, col, val)
+        wheres.append(f"{col} {SQL_OP_MAP.get(op, op)} {val}")
+        if col == "similarity":
+            similarity_wheres.append((SQL_OP_MAP.get(op, op), val))
+    if not len(selected):
+        LOG.error("no metrics left after applying filters, aborting!")
+        return None
+    cs = long_schema.names if columns is None or not len(columns) else columns
+    for col in cs:
+        if col not in long_schema.names:
+            raise ValueError(f"column={col} not in schema={long_schema.names}")
+    margin = "\n            "
+    select = margin.join(["", f",{margin}".join(cs)])
+    inner = margin.join(["", f",{margin}".join(info + selected)])
+    # with a single metric the similarity filters can be pushed down
+    # onto the metric column so parquet statistics can skip row groups
+    inner_wheres = []
+    if len(selected) == 1:
+        inner_wheres = [f"{selected[0]} {op} {val}" for (op, val) in similarity_wheres]
+    inner_where = ""
+    if len(inner_wheres):
+        inner_where = "WHERE " + " AND ".join(inner_wheres)
+    qry = dedent(
+        f"""\
+        SELECT {select}
+        FROM (
+            UNPIVOT (
+                SELECT {inner}
+                FROM '{dataset}/*.parquet'
+                {inner_where}
+            )
+            ON {", ".join(selected)}
+            INTO NAME metric VALUE similarity
+        )
+        """
+    )
+    if len(wheres):
+        where = margin.join(["", f" AND {margin}".join(wheres)])
+        qry += f"\nWHERE {where}"
+    if ";" in qry:
+        raise ValueError(f"query={qry} contains a semicolon!")
+    LOG.debug("\n" + qry + ";")
+    return f"{qry};"
+
+
 def make_query_no_schema(
     dataset: Path,
     columns: list[str] | None = None,
@@ -1,12 +1,15 @@
 # Copyright (c) 2024, Plinder Development Team
 # Distributed under the terms of the Apache License 2.0
-from typing import Any, Optional
+from __future__ import annotations
 
-from omegaconf import DictConfig
+from typing import TYPE_CHECKING, Any, Optional
 
 from plinder.core.index import utils
 from plinder.core.utils.log import setup_logger
 
+if TYPE_CHECKING:
+    from omegaconf import DictConfig
+
 LOG = setup_logger(__name__)
 
 
@@ -1,11 +1,14 @@
 # Copyright (c) 2024, Plinder Development Team
 # Distributed under the terms of the Apache License 2.0
-from typing import Any, Optional, Union
+from __future__ import annotations
 
-from omegaconf import DictConfig
+from typing import TYPE_CHECKING, Any, Optional, Union
 
 from plinder.core.index.utils import _load_entries_from_zips
 
+if TYPE_CHECKING:
+    from omegaconf import DictConfig
+
 
 def load_systems(
     *,
@@ -1,5 +1,7 @@
 # Copyright (c) 2024, Plinder Development Team
 # Distributed under the terms of the Apache License 2.0
+from __future__ import annotations
+
 from dataclasses import dataclass, field
 from functools import partial
 from hashlib import md5
@@ -7,12 +9,13 @@ from io import StringIO
 from json import dumps
 from os import getenv
 from pathlib import Path
-from typing import Any, Optional
-
-from omegaconf import DictConfig, ListConfig, OmegaConf
+from typing import TYPE_CHECKING, Any, Optional
 
 from plinder.core.utils.log import setup_logger
 
+if TYPE_CHECKING:
+    from omegaconf import DictConfig
+
 LOG = setup_logger(__name__)
 
 
@@ -34,6 +37,8 @@ def _validate_cfg(*, cfg: DictConfig, schema: dict[str, Any]) -> DictConfig:
     DictConfig
         the validated config with post-init validation logic
     """
+    from omegaconf import DictConfig
+
     keys = set(cfg.keys()).union(set(schema.keys()))
     return DictConfig({str(k): schema[str(k)](**cfg.get(k, {})) for k in keys})
 
@@ -53,6 +58,8 @@ def _clean_sort_config(*, cfg: Any) -> Any:
     Any
         the cleaned and sorted object (if nested)
     """
+    from omegaconf import DictConfig, ListConfig
+
     if isinstance(cfg, (dict, DictConfig)):
         return {k: _clean_sort_config(cfg=v) for k, v in sorted(cfg.items())}
     elif isinstance(cfg, (list, ListConfig)):
@@ -64,7 +71,7 @@ def _clean_sort_config(*, cfg: Any) -> Any:
 class _get_config:
     _schema: dict[str, Any] = {}
     _packages: set[str] = set()
-    _cfg = DictConfig({})
+    _cfg: Optional[DictConfig] = None
 
     def __call__(
         self,
@@ -105,8 +112,11 @@ class _get_config:
         config : DictConfig
             the fully resolved, merged config
         """
+        from omegaconf import DictConfig, OmegaConf
+
         if (
             cached
+            and self._cfg is not None
             and len(self._cfg)
             and schema.items() <= self._schema.items()
             and config is None
@@ -168,6 +178,8 @@ def get_config_hash(config_obj: Any) -> str:
     config_hash : str
         the hash of the configuration
     """
+    from omegaconf import DictConfig
+
     if isinstance(config_obj, (dict, DictConfig)):
         contents = config_obj
     else:
@@ -242,6 +254,7 @@ class DataConfig(_BaseConfig):
     ligands: str = "ligands"
     mmp: str = "mmp"
     scores: str = "scores"
+    scores_wide: str = "scores_wide"
     splits: str = "splits"
     systems: str = "systems"
     index_file: str = "annotation_table.parquet"
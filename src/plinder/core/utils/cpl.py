@@ -1,16 +1,18 @@
 # Copyright (c) 2024, Plinder Development Team
 # Distributed under the terms of the Apache License 2.0
+from __future__ import annotations
+
 from functools import wraps
 from time import sleep
-from typing import Callable, Optional, TypeVar, Union, overload
-
-from cloudpathlib import AnyPath, GSClient
-from tqdm.contrib.concurrent import thread_map
+from typing import TYPE_CHECKING, Callable, Optional, TypeVar, Union, overload
 
 from plinder.core.utils.config import get_config
 from plinder.core.utils.dec import timeit
 from plinder.core.utils.log import setup_logger
 
+if TYPE_CHECKING:
+    from cloudpathlib import AnyPath
+
 T = TypeVar("T")
 LOG = setup_logger(__name__)
 
@@ -69,6 +71,8 @@ def download_many(*, rel: str) -> None:
     rel : str
         Relative path to the files to download.
     """
+    from tqdm.contrib.concurrent import thread_map
+
     root = get_plinder_path(rel=rel)
     paths = [path for path in root.rglob("*") if not path.is_dir()]
 
@@ -96,6 +100,8 @@ def get_plinder_path(*, rel: str) -> AnyPath:
     AnyPath
         The cloudpathlib path.
     """
+    from cloudpathlib import AnyPath, GSClient
+
     cfg = get_config()
     root = cfg.data.plinder_mount
     if hasattr(cfg, "ingest"):
@@ -4,6 +4,7 @@ from functools import wraps
 from time import time
 from typing import Any, Callable, TypeVar
 
+from plinder.core.utils import profiling
 from plinder.core.utils.log import setup_logger
 
 T = TypeVar("T")
@@ -11,19 +12,23 @@ T = TypeVar("T")
 
 def timeit(func: Callable[..., T]) -> Callable[..., T]:
     """
-    Simple function timer decorator
+    Function timer decorator. Logs the wall time of every call
+    and records a profiling span when profiling is enabled
+    (see plinder.core.utils.profiling).
     """
+    log = setup_logger(".".join([func.__module__, func.__name__]))
+    name = f"{func.__module__}.{func.__qualname__}"
 
     @wraps(func)
     def wrapped(*args: Any, **kwargs: Any) -> T:
-        log = setup_logger(".".join([func.__module__, func.__name__]))
         ts = time()
-        result = None
         try:
-            result = func(*args, **kwargs)
-            log.info(f"runtime succeeded: {time() - ts:.2f}s")
-        except Exception:
-            log.error(f"runtime failed: {time() - ts:.2f}s")
+            with profiling.span(name):
+                result = func(*args, **kwargs)
+            log.info(f"runtime succeeded: {time() - ts:>9.2f}s")
+        except Exception as e:
+            log.error(f"runtime failed: {time() - ts:>9.2f}s")
+            log.error(f"{func.__name__} failed with: {repr(e)}")
             raise
         return result
 
@@ -1,19 +1,20 @@
 # Copyright (c) 2024, Plinder Development Team
 # Distributed under the terms of the Apache License 2.0
+from __future__ import annotations
+
 from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from pathlib import Path
 from time import sleep
-from typing import Any, Callable, Optional, TypeVar
-
-from google.cloud.storage.bucket import Bucket
-from google.cloud.storage.client import Client
-from omegaconf import DictConfig
-from tqdm import tqdm
+from typing import TYPE_CHECKING, Any, Callable, Optional, TypeVar
 
 from plinder.core.utils.dec import timeit
 from plinder.core.utils.log import setup_logger
 
+if TYPE_CHECKING:
+    from google.cloud.storage.bucket import Bucket
+    from omegaconf import DictConfig
+
 BUCKET = "plinder"
 BUCKETS: dict[str, Bucket] = {}
 LOG = setup_logger(__name__)
@@ -24,6 +25,8 @@ def retry(f: Optional[Callable[..., T]] = None, retries: int = 5) -> Callable[..
     def decorator(func: Callable[..., T]) -> Callable[..., T]:
         @wraps(func)
         def inner(**kwargs: Any) -> T:
+            from google.cloud.storage.client import Client
+
             bucket = kwargs.get("bucket", None)
             if bucket is None:
                 cfg = kwargs.get("cfg", None)
@@ -128,6 +131,8 @@ def download_many(
     cfg: Optional[DictConfig] = None,
     bucket_name: Optional[str] = None,
 ) -> None:
+    from tqdm import tqdm
+
     if not len(gcs_paths):
         LOG.info("No files to download")
         return
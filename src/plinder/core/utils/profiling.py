@@ -0,0 +1,499 @@
+# Copyright (c) 2024, Plinder Development Team
+# Distributed under the terms of the Apache License 2.0
+"""
+Lightweight hierarchical profiling spans.
+
+Spans are disabled by default and cost a single attribute lookup
+when disabled. Set ``PLINDER_PROFILE`` to enable them:
+
+    - ``PLINDER_PROFILE=1`` (or ``jsonl``) streams one JSON line per
+      finished span to ``{PLINDER_PROFILE_DIR}/{run_id}/{pid}.jsonl``
+    - ``PLINDER_PROFILE=parquet`` additionally consolidates all JSON
+      lines of the run into ``{PLINDER_PROFILE_DIR}/{run_id}.parquet``
+      when the process that started the run exits
+
+The run id and the currently open span of the main thread are
+propagated to child processes through environment variables, so
+spans opened in multiprocessing workers or subprocesses are attached
+to the span that spawned them. Work handed to other threads (or pool
+workers) attaches to its submitting span with ``parent``.
+"""
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import resource
+import sys
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import wraps
+from itertools import count
+from pathlib import Path
+from time import process_time, strftime, time
+from typing import Any, Callable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+PROFILE_ENV = "PLINDER_PROFILE"
+PROFILE_DIR_ENV = "PLINDER_PROFILE_DIR"
+PROFILE_RUN_ENV = "PLINDER_PROFILE_RUN"
+PROFILE_PARENT_ENV = "PLINDER_PROFILE_PARENT"
+PROFILE_FORMATS = ["jsonl", "parquet"]
+
+# ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+_RSS_SCALE = 1 / 1024**2 if sys.platform == "darwin" else 1 / 1024
+
+
+def _parse_format(value: str) -> Optional[str]:
+    value = value.strip().lower()
+    if value in ["", "0", "false", "no", "off"]:
+        return None
+    if value in PROFILE_FORMATS:
+        return value
+    return "jsonl"
+
+
+def _read_bytes() -> Optional[int]:
+    """
+    Bytes read by the current process so far (linux only).
+
+    Returns
+    -------
+    int | None
+        the rchar counter from /proc/self/io or None if unavailable
+    """
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+@dataclass
+class Span:
+    """
+    A single profiled region of code.
+
+    Attributes
+    ----------
+    name : str
+        the name of the span
+    span_id : str
+        unique id of the span within the run
+    parent_id : str | None
+        the span_id of the enclosing span
+    path : str
+        slash-separated names of all enclosing spans in this process
+    depth : int
+        nesting depth of the span in this process
+    attrs : dict[str, Any]
+        arbitrary JSON-serializable attributes
+    items : int
+        number of items processed, incremented with Span.add
+    bytes_read : int
+        explicit number of bytes read, incremented with Span.add. If
+        left at 0, the bytes read by the process during the span are
+        reported instead (linux only)
+    """
+
+    name: str
+    span_id: str = ""
+    parent_id: Optional[str] = None
+    path: str = ""
+    depth: int = 0
+    attrs: dict[str, Any] = field(default_factory=dict)
+    items: int = 0
+    bytes_read: int = 0
+
+    def add(self, items: int = 0, bytes_read: int = 0) -> None:
+        """
+        Increment the item and byte counters of the span.
+
+        Parameters
+        ----------
+        items : int, default=0
+            number of items processed
+        bytes_read : int, default=0
+            number of bytes read
+        """
+        self.items += items
+        self.bytes_read += bytes_read
+
+    def set(self, **attrs: Any) -> None:
+        """
+        Attach attributes to the span.
+        """
+        self.attrs.update(attrs)
+
+
+class _Profiler:
+    def __init__(self) -> None:
+        self.format = _parse_format(os.getenv(PROFILE_ENV, ""))
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._ids = count()
+        self._file: Any = None
+        self._owner = False
+        # the span that spawned this process, if any
+        self._process_parent = os.getenv(PROFILE_PARENT_ENV)
+        self.run_id = ""
+        self.root = Path()
+        if self.format is not None:
+            self._start_run()
+
+    @property
+    def enabled(self) -> bool:
+        return self.format is not None
+
+    def _start_run(self, run_id: Optional[str] = None) -> None:
+        # the process starting a run (rather than inheriting it) owns it
+        self.run_id = run_id or os.getenv(PROFILE_RUN_ENV, "")
+        if run_id is not None or not self.run_id:
+            self.run_id = self.run_id or f"{strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+            os.environ[PROFILE_RUN_ENV] = self.run_id
+            self._owner = True
+            atexit.register(self._finish_run)
+        self.root = Path(os.getenv(PROFILE_DIR_ENV, "plinder_profiles")).absolute()
+        # child processes inherit the format and destination
+        os.environ[PROFILE_ENV] = self.format or ""
+        os.environ[PROFILE_DIR_ENV] = self.root.as_posix()
+
+    def enable(
+        self,
+        format: str = "jsonl",
+        root: Optional[Path] = None,
+        run_id: Optional[str] = None,
+    ) -> None:
+        if format not in PROFILE_FORMATS:
+            raise ValueError(f"format={format} not in {PROFILE_FORMATS}")
+        self.disable()
+        self.format = format
+        if root is not None:
+            os.environ[PROFILE_DIR_ENV] = Path(root).as_posix()
+        self._start_run(run_id or "")
+
+    def disable(self) -> None:
+        if self._owner:
+            self._finish_run()
+            atexit.unregister(self._finish_run)
+            os.environ.pop(PROFILE_RUN_ENV, None)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        os.environ.pop(PROFILE_ENV, None)
+        os.environ.pop(PROFILE_PARENT_ENV, None)
+        self._owner = False
+        self.format = None
+
+    @property
+    def run_dir(self) -> Path:
+        return self.root / self.run_id
+
+    def _stack(self) -> list[Span]:
+        stack: Optional[list[Span]] = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = []
+            self._local.stack = stack
+        return stack
+
+    def current_span_id(self) -> Optional[str]:
+        stack = self._stack()
+        if len(stack):
+            return stack[-1].span_id
+        inherited: Optional[str] = getattr(self._local, "parent", None)
+        return inherited or self._process_parent
+
+    @contextmanager
+    def parent(self, span_id: Optional[str]) -> Iterator[None]:
+        previous = getattr(self._local, "parent", None)
+        self._local.parent = span_id
+        try:
+            yield
+        finally:
+            self._local.parent = previous
+
+    def _write(self, record: dict[str, Any]) -> None:
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            if self._file is None:
+                self.run_dir.mkdir(exist_ok=True, parents=True)
+                self._file = open(self.run_dir / f"{os.getpid()}.jsonl", "a")
+            self._file.write(line)
+            self._file.flush()
+
+    def _finish_run(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.format == "parquet" and self.run_dir.is_dir():
+            export_parquet(self.run_dir, self.root / f"{self.run_id}.parquet")
+
+    @contextmanager
+    def span(self, name: str, **attrs: Any) -> Iterator[Span]:
+        stack = self._stack()
+        parent_id = self.current_span_id()
+        path = f"{stack[-1].path}/{name}" if len(stack) else name
+        current = Span(
+            name=name,
+            span_id=f"{os.getpid()}:{next(self._ids)}",
+            parent_id=parent_id,
+            path=path,
+            depth=len(stack),
+            attrs=attrs,
+        )
+        stack.append(current)
+        # the environment is shared by all threads, only the main thread
+        # exports its open span to the processes it spawns
+        export = threading.current_thread() is threading.main_thread()
+        previous = os.environ.get(PROFILE_PARENT_ENV)
+        if export:
+            os.environ[PROFILE_PARENT_ENV] = current.span_id
+        status = "succeeded"
+        start = time()
+        cpu = process_time()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        rchar = _read_bytes()
+        try:
+            yield current
+        except BaseException:
+            status = "failed"
+            raise
+        finally:
+            wall = time() - start
+            cpu = process_time() - cpu
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu_children = (after.ru_utime + after.ru_stime) - (
+                children.ru_utime + children.ru_stime
+            )
+            bytes_read = current.bytes_read
+            if not bytes_read and rchar is not None:
+                bytes_read = (_read_bytes() or rchar) - rchar
+            stack.pop()
+            if export and previous is None:
+                os.environ.pop(PROFILE_PARENT_ENV, None)
+            elif export:
+                os.environ[PROFILE_PARENT_ENV] = previous
+            self._write(
+                {
+                    "run_id": self.run_id,
+                    "span_id": current.span_id,
+                    "parent_id": current.parent_id,
+                    "name": current.name,
+                    "path": current.path,
+                    "depth": current.depth,
+                    "pid": os.getpid(),
+                    "start": start,
+                    "wall_s": wall,
+                    "cpu_s": cpu,
+                    "cpu_children_s": cpu_children,
+                    # ru_maxrss is the peak of the whole process so far,
+                    # not of the span alone
+                    "process_peak_rss_mb": resource.getrusage(
+                        resource.RUSAGE_SELF
+                    ).ru_maxrss
+                    * _RSS_SCALE,
+                    "items": current.items,
+                    "bytes_read": bytes_read,
+                    "status": status,
+                    "attrs": json.dumps(current.attrs, default=str),
+                }
+            )
+
+
+_PROFILER = _Profiler()
+
+
+def enabled() -> bool:
+    """
+    Check if profiling spans are currently recorded.
+
+    Returns
+    -------
+    bool
+        True if spans are recorded
+    """
+    return _PROFILER.enabled
+
+
+def enable(
+    format: str = "jsonl",
+    root: Optional[Path] = None,
+    run_id: Optional[str] = None,
+) -> None:
+    """
+    Programmatically enable profiling, equivalent to setting the
+    PLINDER_PROFILE, PLINDER_PROFILE_DIR and PLINDER_PROFILE_RUN
+    environment variables.
+
+    Parameters
+    ----------
+    format : str, default="jsonl"
+        one of "jsonl" or "parquet"
+    root : Path, default=None
+        the directory in which to write profiles
+    run_id : str, default=None
+        the run id, generated if not provided
+    """
+    _PROFILER.enable(format=format, root=root, run_id=run_id)
+
+
+def disable() -> None:
+    """
+    Stop recording spans and finalize the current run.
+    """
+    _PROFILER.disable()
+
+
+def run_dir() -> Optional[Path]:
+    """
+    The directory containing the JSON lines of the current run.
+
+    Returns
+    -------
+    Path | None
+        the run directory or None if profiling is disabled
+    """
+    if not _PROFILER.enabled:
+        return None
+    return _PROFILER.run_dir
+
+
+_NULL_SPAN = Span(name="")
+
+
+@contextmanager
+def _null_span() -> Iterator[Span]:
+    yield _NULL_SPAN
+
+
+def span(name: str, **attrs: Any) -> Any:
+    """
+    Context manager recording a (possibly nested) profiling span.
+    Wall time, CPU time (own and of waited-for child processes),
+    the peak RSS of the process so far, item counts and bytes read
+    are recorded when the span closes.
+
+    Parameters
+    ----------
+    name : str
+        the name of the span
+    **attrs : Any
+        attributes to attach to the span
+
+    Returns
+    -------
+    ContextManager[Span]
+        yields the Span, which can be used to count items and bytes
+
+    Examples
+    --------
+    >>> with span("make_entries", chunk=0) as s:
+    ...     s.add(items=10)
+    """
+    if not _PROFILER.enabled:
+        return _null_span()
+    return _PROFILER.span(name, **attrs)
+
+
+def current_span_id() -> Optional[str]:
+    """
+    The id of the innermost open span of the calling thread, or of
+    the span it was attached to with parent.
+
+    Returns
+    -------
+    str | None
+        the span id or None if profiling is disabled or no span is open
+    """
+    if not _PROFILER.enabled:
+        return None
+    return _PROFILER.current_span_id()
+
+
+def parent(span_id: Optional[str]) -> Any:
+    """
+    Context manager attaching the spans opened by the calling thread
+    outside of any other span to span_id, e.g. the span that submitted
+    the work to a thread or process pool.
+
+    Parameters
+    ----------
+    span_id : str | None
+        the id of the parent span (see current_span_id)
+
+    Returns
+    -------
+    ContextManager[None]
+    """
+    if not _PROFILER.enabled:
+        return _null_parent()
+    return _PROFILER.parent(span_id)
+
+
+@contextmanager
+def _null_parent() -> Iterator[None]:
+    yield
+
+
+def profile(func: Callable[..., T]) -> Callable[..., T]:
+    """
+    Function decorator recording a span for every call.
+    """
+    name = f"{func.__module__}.{func.__qualname__}"
+
+    @wraps(func)
+    def wrapped(*args: Any, **kwargs: Any) -> T:
+        if not _PROFILER.enabled:
+            return func(*args, **kwargs)
+        with _PROFILER.span(name):
+            return func(*args, **kwargs)
+
+    return wrapped
+
+
+def read_spans(path: Path) -> Any:
+    """
+    Read all spans of a run directory into a DataFrame.
+
+    Parameters
+    ----------
+    path : Path
+        the run directory containing one JSON lines file per process
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per span
+    """
+    import pandas as pd
+
+    files = sorted(Path(path).glob("*.jsonl"))
+    if not len(files):
+        return pd.DataFrame()
+    return pd.concat(
+        [pd.read_json(file, lines=True, dtype={"attrs": str}) for file in files],
+        ignore_index=True,
+    )
+
+
+def export_parquet(path: Path, output: Path) -> None:
+    """
+    Consolidate the JSON lines of a run directory into a single
+    parquet file.
+
+    Parameters
+    ----------
+    path : Path
+        the run directory containing one JSON lines file per process
+    output : Path
+        the parquet file to write
+    """
+    df = read_spans(path)
+    if df.empty:
+        return
+    df.sort_values("start").to_parquet(output, index=False)
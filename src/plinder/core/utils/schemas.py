@@ -16,6 +16,54 @@ PROTEIN_SIMILARITY_SCHEMA = pa.schema(
 )
 
 
+PROTEIN_SIMILARITY_METRICS = [
+    # pli_qcov:
+    "pli_qcov",
+    "pli_unique_qcov",
+    # seq_sim:
+    "protein_seqsim_qcov_max",
+    "protein_seqsim_qcov_weighted_max",
+    "protein_seqsim_qcov_weighted_sum",
+    "protein_seqsim_max",
+    "protein_seqsim_weighted_max",
+    "protein_seqsim_weighted_sum",
+    # protein
+    "protein_fident_qcov_max",
+    "protein_fident_qcov_weighted_max",
+    "protein_fident_qcov_weighted_sum",
+    "protein_fident_max",
+    "protein_fident_weighted_max",
+    "protein_fident_weighted_sum",
+    "protein_lddt_max",
+    "protein_lddt_qcov_max",
+    "protein_lddt_qcov_weighted_max",
+    "protein_lddt_qcov_weighted_sum",
+    "protein_lddt_weighted_max",
+    "protein_lddt_weighted_sum",
+    "protein_qcov_max",
+    "protein_qcov_weighted_max",
+    "protein_qcov_weighted_sum",
+    # pocket
+    "pocket_fident_qcov",
+    "pocket_fident",
+    "pocket_lddt_qcov",
+    "pocket_lddt",
+    "pocket_qcov",
+]
+
+
+# one row per (query_system, target_system) pair and one column per metric
+PROTEIN_SIMILARITY_WIDE_SCHEMA = pa.schema(
+    [
+        ("query_system", pa.string()),
+        ("target_system", pa.string()),
+        ("protein_mapping", pa.string()),
+        ("protein_mapper", pa.dictionary(pa.int8(), pa.string())),
+    ]
+    + [(metric, pa.int8()) for metric in PROTEIN_SIMILARITY_METRICS]
+)
+
+
 NETWORKX_CLUSTER_SCHEMA = pa.schema(
     [
         ("system_id", pa.dictionary(pa.int32(), pa.string())),
@@ -3,13 +3,14 @@
 from __future__ import annotations
 
 from pathlib import Path
-from typing import Optional
-
-from omegaconf import DictConfig
+from typing import TYPE_CHECKING, Optional
 
 from plinder.core.utils import gcs
 from plinder.core.utils.config import get_config
 
+if TYPE_CHECKING:
+    from omegaconf import DictConfig
+
 ZIP_KINDS = ["entries", "systems"]
 ID_KINDS = ["system_id", "pdb_id", "two_char_code"]
 
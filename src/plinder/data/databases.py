@@ -1,13 +1,19 @@
 # Copyright (c) 2024, Plinder Development Team
 # Distributed under the terms of the Apache License 2.0
+from __future__ import annotations
+
+import csv
 import json
+import os
 import subprocess as sp
 from pathlib import Path
 from typing import TYPE_CHECKING, Dict, Optional
 
+import numpy as np
 import pandas as pd
 
 from plinder.core.utils.log import setup_logger
+from plinder.data.pipeline.config import FoldseekConfig, MMSeqsConfig
 
 if TYPE_CHECKING:
     from plinder.data.utils.annotations.aggregate_annotations import Entry
@@ -67,6 +73,122 @@ def make_db(
     )
 
 
+def get_search_config(search_db: str, aln_type: str) -> FoldseekConfig | MMSeqsConfig:
+    """
+    Get the parameters of the searches against a sub-database.
+
+    Parameters
+    ----------
+    search_db : str
+        holo, apo or pred
+    aln_type : str
+        foldseek or mmseqs
+
+    Returns
+    -------
+    FoldseekConfig | MMSeqsConfig
+        the search parameters
+    """
+    config: FoldseekConfig | MMSeqsConfig
+    if aln_type == "foldseek":
+        config = FoldseekConfig()
+    else:
+        config = MMSeqsConfig()
+    if search_db in ["apo", "pred"]:
+        config.coverage = 0.9
+        config.min_seq_id = 0.9
+    return config
+
+
+def create_search_index(sub_db: Path, aln_type: str) -> None:
+    """
+    Pre-compute the search index of a sub-database with the
+    prefilter parameters of the searches against it, so that the
+    searches can use it. Coverage and sequence identity only
+    filter alignments and are not part of the index.
+
+    Parameters
+    ----------
+    sub_db : Path
+        the sub-database directory, named {search_db}_{aln_type}
+    aln_type : str
+        foldseek or mmseqs
+    """
+    config = get_search_config(sub_db.name.split("_")[0], aln_type)
+    run(
+        [
+            aln_type,
+            "createindex",
+            str(sub_db / sub_db.name),
+            str(sub_db / "tmp_index"),
+            "-s",
+            f"{config.sensitivity}",
+            "--max-seqs",
+            f"{config.max_seqs}",
+        ]
+    )
+
+
+# full database lookup indices by path, reused across the sub-databases
+# (and batches) created from the same full database in a process
+_LOOKUP_INDEXES: Dict[str, tuple[int, pd.DataFrame]] = {}
+
+
+def load_lookup_index(full_db: Path) -> pd.DataFrame:
+    """
+    Load the lookup of a full database indexed by chain id. The
+    index is built once from the .lookup file, persisted next to it
+    as .lookup.parquet and rebuilt if the .lookup file changes.
+
+    Parameters
+    ----------
+    full_db : Path
+        path to full database
+
+    Returns
+    -------
+    index : pd.DataFrame
+        the key, name and file columns of the .lookup file in
+        their original order, indexed by name (the chain id)
+    """
+    lookup = full_db.parent / f"{full_db.name}.lookup"
+    mtime = lookup.stat().st_mtime_ns
+    cached = _LOOKUP_INDEXES.get(str(lookup))
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    index_file = lookup.parent / f"{lookup.name}.parquet"
+    if index_file.is_file() and index_file.stat().st_mtime_ns >= mtime:
+        df = pd.read_parquet(index_file)
+    else:
+        LOG.info(f"indexing {lookup}")
+        df = pd.read_csv(
+            lookup,
+            sep="\t",
+            header=None,
+            names=["key", "name", "file"],
+            dtype=str,
+            keep_default_na=False,
+            quoting=csv.QUOTE_NONE,
+        )
+        # concurrent sub-database jobs may index the same lookup
+        tmp = index_file.with_suffix(f".{os.getpid()}.tmp")
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, index_file)
+    df.index = pd.Index(df["name"])
+    _LOOKUP_INDEXES[str(lookup)] = (mtime, df)
+    return df
+
+
+def select_db_keys(index: pd.DataFrame, entry_chain_ids: set[str]) -> pd.DataFrame:
+    """
+    Select the rows of a lookup index for the given chain ids,
+    in the order of the full database.
+    """
+    positions = index.index.get_indexer_for(list(entry_chain_ids))
+    positions = np.unique(positions[positions >= 0])
+    return index.iloc[positions]
+
+
 def make_sub_db(
     entry_chain_ids: set[str],
     full_db: Path,
@@ -89,64 +211,74 @@ def make_sub_db(
     aln_type : str
         database name
     """
-    # Map chain ids to full database ids
-    sub_db_lookup_file = sub_db / "ids.tsv"
-    found = set()
-    with open(full_db.parent / f"{full_db.name}.lookup", "r") as f:
-        with open(sub_db_lookup_file, "w") as fw:
-            for line in f:
-                fields = line.split()
-                if fields[1] in entry_chain_ids:
-                    fw.write(line)
-                    found.add(fields[1])
-    # Create subdb
-    if aln_type == "foldseek":
-        run(
-            [
-                "foldseek",
-                "createsubdb",
-                str(sub_db_lookup_file),
-                str(full_db),
-                str(sub_db / sub_db.name),
-                "--subdb-mode",
-                "1",
-            ]
-        )
-        run(
-            [
-                "foldseek",
-                "createsubdb",
-                str(sub_db_lookup_file),
-                f"{full_db}_ss",
-                f"{sub_db / sub_db.name}_ss",
-                "--subdb-mode",
-                "1",
-            ]
-        )
-        run(
-            [
-                "foldseek",
-                "createsubdb",
-                str(sub_db_lookup_file),
-                f"{full_db}_ca",
-                f"{sub_db / sub_db.name}_ca",
-                "--subdb-mode",
-                "1",
-            ]
-        )
-    elif aln_type == "mmseqs":
-        run(
-            [
-                "mmseqs",
-                "createsubdb",
-                str(sub_db_lookup_file),
-                str(full_db),
-                str(sub_db / sub_db.name),
-            ]
-        )
+    return make_sub_dbs_from_full_db({sub_db: entry_chain_ids}, full_db, aln_type)[
+        sub_db.name
+    ]
 
-    missing = set(entry_chain_ids) - found
-    return list(missing)
+
+def make_sub_dbs_from_full_db(
+    sub_db_ids: Dict[Path, set[str]],
+    full_db: Path,
+    aln_type: str,
+) -> Dict[str, list[str]]:
+    """
+    Create several sub databases of the same full database,
+    loading its lookup index only once.
+
+    Parameters
+    ----------
+    sub_db_ids : Dict[Path, set[str]]
+        map of path to sub database to its chain ids (output from get_db_ids)
+    full_db : Path
+        path to full database
+    aln_type : str
+        database name
+
+    Returns
+    -------
+    missing : Dict[str, list[str]]
+        map of sub database name to the chain ids missing in the full database
+    """
+    index = load_lookup_index(full_db)
+    report = {}
+    for sub_db, entry_chain_ids in sub_db_ids.items():
+        # Map chain ids to full database ids
+        sub_db_lookup_file = sub_db / "ids.tsv"
+        selected = select_db_keys(index, entry_chain_ids)
+        selected.to_csv(
+            sub_db_lookup_file,
+            sep="\t",
+            header=False,
+            index=False,
+            quoting=csv.QUOTE_NONE,
+        )
+        # Create subdb
+        if aln_type == "foldseek":
+            for suffix in ["", "_ss", "_ca"]:
+                run(
+                    [
+                        "foldseek",
+                        "createsubdb",
+                        str(sub_db_lookup_file),
+                        f"{full_db}{suffix}",
+                        f"{sub_db / sub_db.name}{suffix}",
+                        "--subdb-mode",
+                        "1",
+                    ]
+                )
+        elif aln_type == "mmseqs":
+            run(
+                [
+                    "mmseqs",
+                    "createsubdb",
+                    str(sub_db_lookup_file),
+                    str(full_db),
+                    str(sub_db / sub_db.name),
+                ]
+            )
+        missing = set(entry_chain_ids) - set(selected["name"])
+        report[sub_db.name] = list(missing)
+    return report
 
 
 def get_ids_in_db(data_dir: Path, search_db: str, aln_type: str) -> pd.DataFrame:
@@ -191,6 +323,7 @@ def make_sub_dbs(
     db_dir: Path,
     db_sources: Dict[str, Path],
     entries: Dict[str, "Entry"],
+    create_index: bool = False,
 ) -> None:
     """
     Create the apo/holo subdbs for score
@@ -204,19 +337,27 @@ def make_sub_dbs(
         map of database name to path to full database
     entries : Dict[str, Entry]
         map of all the entries
+    create_index : bool, default=False
+        pre-compute the search index of every subdb (see create_search_index),
+        so that the batch searches against it do not have to build it
+        each time
     """
 
     db_dir.mkdir(exist_ok=True)
-    report = {}
+    # sub databases sharing a full database (e.g. holo and apo) are made together
+    by_full_db: Dict[tuple[Path, str], Dict[Path, set[str]]] = {}
     for search_db_aln_type, full_db in db_sources.items():
         search_db, aln_type = search_db_aln_type.split("_")
         subdb = db_dir / search_db_aln_type
         subdb.mkdir(exist_ok=True)
-        report[search_db_aln_type] = make_sub_db(
-            get_db_ids(entries, search_db, aln_type),
-            full_db,
-            subdb,
-            aln_type,
+        by_full_db.setdefault((full_db, aln_type), {})[subdb] = get_db_ids(
+            entries, search_db, aln_type
         )
+    report = {}
+    for (full_db, aln_type), sub_db_ids in by_full_db.items():
+        report.update(make_sub_dbs_from_full_db(sub_db_ids, full_db, aln_type))
+        if create_index:
+            for subdb in sub_db_ids:
+                create_search_index(subdb, aln_type)
     with (db_dir / "missing.json").open("w") as f:
         json.dump(report, f)
@@ -4,7 +4,7 @@ from __future__ import annotations
 
 import json
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, Generator
+from typing import TYPE_CHECKING, Any, Callable, Generator, Optional
 
 import numpy as np
 import pandas as pd
@@ -24,21 +24,99 @@ if TYPE_CHECKING:
 LOG = setup_logger(__name__)
 
 
-def ligand_is_rdkit_loadable(sdf_path: Path) -> bool:
+class StructureCache:
+    """
+    Parse every structure file at most once per toolkit so that
+    all checks of a system share the parsed objects. Parsing
+    failures are cached as well and re-raised on every access,
+    so that each check behaves as if it had parsed the file itself.
+
+    Note
+    ----
+    The parsed objects are shared, checks must not modify them.
+    """
+
+    def __init__(self) -> None:
+        self._parsed: dict[tuple[str, str], tuple[Any, Optional[Exception]]] = {}
+
+    def _get(self, kind: str, path: Path, loader: Callable[[Path], Any]) -> Any:
+        key = (kind, str(path))
+        if key not in self._parsed:
+            try:
+                self._parsed[key] = (loader(path), None)
+            except Exception as e:
+                self._parsed[key] = (None, e)
+        parsed, error = self._parsed[key]
+        if error is not None:
+            raise error
+        return parsed
+
+    def biotite(self, path: Path) -> Any:
+        """AtomArray of a ligand sdf or (with label fields) a cif"""
+
+        def load(path: Path) -> Any:
+            if path.suffix == ".sdf":
+                return load_structure(path)
+            return load_structure(path, use_author_fields=False)
+
+        return self._get("biotite", path, load)
+
+    def rdkit(self, path: Path) -> Optional[Chem.Mol]:
+        """Sanitized rdkit molecule of a ligand sdf"""
+        return self._get(
+            "rdkit", path, lambda path: next(Chem.SDMolSupplier(str(path)))
+        )
+
+    def rdkit_unsanitized(self, path: Path) -> Optional[Chem.Mol]:
+        """Unsanitized rdkit molecule of a ligand sdf"""
+        return self._get(
+            "rdkit_unsanitized",
+            path,
+            lambda path: next(Chem.SDMolSupplier(str(path), sanitize=False)),
+        )
+
+    def rdkit_fixed(self, path: Path) -> Optional[Chem.Mol]:
+        """Rdkit molecule of a ligand sdf with valency issues fixed"""
+
+        def load(path: Path) -> Any:
+            mol = self.rdkit_unsanitized(path)
+            # fix_valency_issues works in place, keep the unsanitized one intact
+            return fix_valency_issues(Chem.Mol(mol) if mol is not None else mol)
+
+        return self._get("rdkit_fixed", path, load)
+
+    def obabel(self, path: Path) -> bool:
+        """Whether openbabel can read a ligand sdf"""
+
+        def load(path: Path) -> bool:
+            obconversion = ob.OBConversion()
+            obconversion.SetInFormat("sdf")
+            return bool(obconversion.ReadFile(ob.OBMol(), str(path)))
+
+        loaded: bool = self._get("obabel", path, load)
+        return loaded
+
+
+def ligand_is_rdkit_loadable(
+    sdf_path: Path, cache: Optional[StructureCache] = None
+) -> bool:
     """Check if structure is loadable by rdkit
 
     Parameters
     ----------
     sdf_path : Path
         Path to ligand sdf
+    cache : StructureCache, default=None
+        parsed structures shared between checks
 
     Returns
     -------
     bool
         True if loadable, False otherwise.
     """
+    cache = cache or StructureCache()
     try:
-        mol = next(Chem.SDMolSupplier(str(sdf_path)))
+        mol = cache.rdkit(sdf_path)
         if mol is not None:
             return True
         else:
@@ -47,22 +125,27 @@ def ligand_is_rdkit_loadable(sdf_path: Path) -> bool:
         return False
 
 
-def ligand_is_rdkit_loadable_with_fix(sdf_path: Path) -> bool:
+def ligand_is_rdkit_loadable_with_fix(
+    sdf_path: Path, cache: Optional[StructureCache] = None
+) -> bool:
     """Check if structure is loadable by rdkit after fixing
 
     Parameters
     ----------
     sdf_path : Path
         Path to ligand sdf
+    cache : StructureCache, default=None
+        parsed structures shared between checks
 
     Returns
     -------
     bool
         True if loadable, False otherwise.
     """
-    mol = next(Chem.SDMolSupplier(str(sdf_path), sanitize=False))
+    cache = cache or StructureCache()
+    cache.rdkit_unsanitized(sdf_path)
     try:
-        mol = fix_valency_issues(mol)
+        mol = cache.rdkit_fixed(sdf_path)
         if mol is not None:
             return True
         else:
@@ -72,48 +155,53 @@ def ligand_is_rdkit_loadable_with_fix(sdf_path: Path) -> bool:
         return False
 
 
-def ligand_is_obabel_loadable(sdf_path: Path) -> bool:
+def ligand_is_obabel_loadable(
+    sdf_path: Path, cache: Optional[StructureCache] = None
+) -> bool:
     """Check if structure is loadable by openbabel
 
     Parameters
     ----------
     sdf_path : Path
         Path to ligand sdf
+    cache : StructureCache, default=None
+        parsed structures shared between checks
 
     Returns
     -------
     bool
         True if loadable, False otherwise.
     """
+    return (cache or StructureCache()).obabel(sdf_path)
 
-    obconversion = ob.OBConversion()
-    obconversion.SetInFormat("sdf")
-    obmol = ob.OBMol()
-    return bool(obconversion.ReadFile(obmol, str(sdf_path)))
 
-
-def ligand_is_obabel_loadable_with_rdkit_fix(sdf_path: Path) -> bool:
+def ligand_is_obabel_loadable_with_rdkit_fix(
+    sdf_path: Path, cache: Optional[StructureCache] = None
+) -> bool:
     """Check if structure is loadable by openbabel after fixing
 
     Parameters
     ----------
     sdf_path : Path
         Path to ligand sdf
+    cache : StructureCache, default=None
+        parsed structures shared between checks
 
     Returns
     -------
     bool
         True if loadable, False otherwise.
     """
-    obconversion = ob.OBConversion()
-    obconversion.SetInFormat("sdf")
-    obmol = ob.OBMol()
-    if obconversion.ReadFile(obmol, str(sdf_path)):
+    cache = cache or StructureCache()
+    if cache.obabel(sdf_path):
         return True
     else:
-        mol = next(Chem.SDMolSupplier(str(sdf_path), sanitize=False))
+        obconversion = ob.OBConversion()
+        obconversion.SetInFormat("sdf")
+        obmol = ob.OBMol()
+        cache.rdkit_unsanitized(sdf_path)
         try:
-            mol = fix_valency_issues(mol)
+            mol = cache.rdkit_fixed(sdf_path)
             if mol is not None:
                 fixed_sdf_str = Chem.MolToMolBlock(mol)
                 return bool(obconversion.ReadString(obmol, fixed_sdf_str))
@@ -123,7 +211,9 @@ def ligand_is_obabel_loadable_with_rdkit_fix(sdf_path: Path) -> bool:
             return False
 
 
-def ligand_matches_smiles_atom_num(smiles: str, sdf_path: Path) -> bool:
+def ligand_matches_smiles_atom_num(
+    smiles: str, sdf_path: Path, cache: Optional[StructureCache] = None
+) -> bool:
     """Check if atom number in ligand sdf matches the one from annotation smiles
 
     Parameters
@@ -132,14 +222,15 @@ def ligand_matches_smiles_atom_num(smiles: str, sdf_path: Path) -> bool:
         smiles from annotation foile
     sdf_path : Path
         Path to ligand sdf
+    cache : StructureCache, default=None
+        parsed structures shared between checks
 
     Returns
     -------
     bool
         True if matching, False otherwise.
     """
-    mol = next(Chem.SDMolSupplier(str(sdf_path), sanitize=False))
-    mol = fix_valency_issues(mol)
+    mol = (cache or StructureCache()).rdkit_fixed(sdf_path)
 
     target_mol = Chem.MolFromSmiles(smiles, sanitize=False)
     target_mol = fix_valency_issues(target_mol)
@@ -154,13 +245,17 @@ def ligand_matches_smiles_atom_num(smiles: str, sdf_path: Path) -> bool:
         )
 
 
-def get_molvs_ligand_validation(sdf_path: Path) -> list[str]:
+def get_molvs_ligand_validation(
+    sdf_path: Path, cache: Optional[StructureCache] = None
+) -> list[str]:
     """Check for errors that could be detected by MolVS
 
     Parameters
     ----------
     sdf_path : Path
         Path to ligand sdf
+    cache : StructureCache, default=None
+        parsed structures shared between checks
 
     Returns
     -------
@@ -172,31 +267,37 @@ def get_molvs_ligand_validation(sdf_path: Path) -> list[str]:
         rdMolStandardize.FragmentValidation(),
         rdMolStandardize.NeutralValidation(),
     ]
-    mol = fix_valency_issues(next(Chem.SDMolSupplier(str(sdf_path), sanitize=False)))
+    mol = (cache or StructureCache()).rdkit_fixed(sdf_path)
     vm = rdMolStandardize.MolVSValidation(validations)
     return list(vm.validate(mol))
 
 
-def get_rdkit_ligand_validation(sdf_path: Path) -> list[str]:
+def get_rdkit_ligand_validation(
+    sdf_path: Path, cache: Optional[StructureCache] = None
+) -> list[str]:
     """Check for errors that could be detected by RDKit
 
     Parameters
     ----------
     sdf_path : Path
         Path to ligand sdf
+    cache : StructureCache, default=None
+        parsed structures shared between checks
 
     Returns
     -------
     list[str]
         [] if not validation error.
     """
-    mol = fix_valency_issues(next(Chem.SDMolSupplier(str(sdf_path), sanitize=False)))
+    mol = (cache or StructureCache()).rdkit_fixed(sdf_path)
     vm = rdMolStandardize.RDKitValidation()
     return list(vm.validate(mol))
 
 
 def ligand_positions_correct(
-    center_of_mass: np.ndarray[Any, Any], sdf_path: Path
+    center_of_mass: np.ndarray[Any, Any],
+    sdf_path: Path,
+    cache: Optional[StructureCache] = None,
 ) -> bool:
     """Check if ligand position is maintained
 
@@ -206,14 +307,15 @@ def ligand_positions_correct(
         Center of mass from annotation
     sdf_path : Path
         Path to sdf ligand
+    cache : StructureCache, default=None
+        parsed structures shared between checks
 
     Returns
     -------
     bool
         True if position is maintained, otherwise False
     """
-    mol = next(Chem.SDMolSupplier(str(sdf_path), sanitize=False))
-    mol = fix_valency_issues(mol)
+    mol = (cache or StructureCache()).rdkit_fixed(sdf_path)
     conf = mol.GetConformer()
     return bool(
         np.allclose(
@@ -222,13 +324,17 @@ def ligand_positions_correct(
     )
 
 
-def file_loadbable_via_biotite(structure_path: Path) -> bool:
+def file_loadbable_via_biotite(
+    structure_path: Path, cache: Optional[StructureCache] = None
+) -> bool:
     """Ligand is loadable by biotite
 
     Parameters
     ----------
     structure_path : Path
         Path to stucture (could be protein/ligand/complex)
+    cache : StructureCache, default=None
+        parsed structures shared between checks
 
     Returns
     -------
@@ -237,10 +343,7 @@ def file_loadbable_via_biotite(structure_path: Path) -> bool:
     """
 
     try:
-        if structure_path.suffix == ".sdf":
-            arr = load_structure(structure_path)
-        else:
-            arr = load_structure(structure_path, use_author_fields=False)
+        arr = (cache or StructureCache()).biotite(structure_path)
         return bool(arr.coord.shape[0] > 0)
     except Exception:
         return False
@@ -282,6 +385,7 @@ def ligand_protein_neighbor_still_preserved_complex(
     protein_chains: set[str],
     ligand_chains: set[str],
     radius: int = 10,
+    cache: Optional[StructureCache] = None,
 ) -> bool:
     """
     Check if all ligand protein neighbors are saved
@@ -295,13 +399,15 @@ def ligand_protein_neighbor_still_preserved_complex(
         Path to complex structure
     radius : int
         Radius around ligand to extract neighbors
+    cache : StructureCache, default=None
+        parsed structures shared between checks
 
     Returns
     -------
     bool
         True if all neighbors are present, otherwise False
     """
-    complex_arr = load_structure(complex_file, use_author_fields=False)
+    complex_arr = (cache or StructureCache()).biotite(complex_file)
     # protein_arr = complex_arr[~complex_arr.hetero]
     # ligand_arr = complex_arr[complex_arr.hetero]
     protein_arr = complex_arr[np.isin(complex_arr.chain_id, list(protein_chains))]
@@ -310,7 +416,9 @@ def ligand_protein_neighbor_still_preserved_complex(
     return {str(neighbor.chain_id) for neighbor in neighbor_arr} == neighbor_chains
 
 
-def all_ligand_chains_present(ligand_chains: set[str], complex_file: Path) -> bool:
+def all_ligand_chains_present(
+    ligand_chains: set[str], complex_file: Path, cache: Optional[StructureCache] = None
+) -> bool:
     """
     Check if all ligand chains are correctly saved
 
@@ -320,20 +428,24 @@ def all_ligand_chains_present(ligand_chains: set[str], complex_file: Path) -> bo
         Set of ligand chain ids from annotation
     complex_file : Path
         Path to complex structure
+    cache : StructureCache, default=None
+        parsed structures shared between checks
 
     Returns
     -------
     bool
         True if all ligand chains are present, otherwise False
     """
-    complex_arr = load_structure(complex_file, use_author_fields=False)
+    complex_arr = (cache or StructureCache()).biotite(complex_file)
     # ligand_arr = complex_arr[complex_arr.hetero]
     # chains = {ch for ch in ligand_arr.chain_id}
     chains = {ch for ch in complex_arr.chain_id}
     return bool(ligand_chains.issubset(chains))
 
 
-def all_protein_chains_present(protein_chains: set[str], complex_file: Path) -> bool:
+def all_protein_chains_present(
+    protein_chains: set[str], complex_file: Path, cache: Optional[StructureCache] = None
+) -> bool:
     """
     Check if all protein chains are correctly saved
 
@@ -343,13 +455,15 @@ def all_protein_chains_present(protein_chains: set[str], complex_file: Path) ->
         Set of protein chain ids from annotation
     complex_file : Path
         Path to complex structure
+    cache : StructureCache, default=None
+        parsed structures shared between checks
 
     Returns
     -------
     bool
         True if all protein chains are present, otherwise False
     """
-    complex_arr = load_structure(complex_file, use_author_fields=False)
+    complex_arr = (cache or StructureCache()).biotite(complex_file)
     # protein_arr = complex_arr[~complex_arr.hetero]
     # chains = {ch for ch in protein_arr.chain_id}
     chains = {ch for ch in complex_arr.chain_id}
@@ -379,6 +493,8 @@ def run_structure_checks(system_dict: dict[str, Any]) -> list[dict[str, Any]]:
     """
     system_checks = []
     complex_path: Any = system_dict["complex_path"]
+    # parse the complex and every ligand once for all checks of the system
+    cache = StructureCache()
     for ligand_chain, ligand in system_dict["ligands"].items():
         ligand_path: Path = ligand["ligand_path"]
         protein_chains: Any = system_dict["protein_chains"]
@@ -388,35 +504,49 @@ def run_structure_checks(system_dict: dict[str, Any]) -> list[dict[str, Any]]:
                 "system_id": complex_path.parent.name,
                 "ligand_instance": ligand["ligand_instance"],
                 "ligand_asym_id": ligand["ligand_asym_id"],
-                "ligand_is_rdkit_loadable": ligand_is_rdkit_loadable(ligand_path),
+                "ligand_is_rdkit_loadable": ligand_is_rdkit_loadable(
+                    ligand_path, cache
+                ),
                 "ligand_is_rdkit_loadable_with_fix": ligand_is_rdkit_loadable_with_fix(
-                    ligand_path
+                    ligand_path, cache
+                ),
+                "ligand_is_obabel_loadable": ligand_is_obabel_loadable(
+                    ligand_path, cache
                 ),
-                "ligand_is_obabel_loadable": ligand_is_obabel_loadable(ligand_path),
                 "ligand_is_obabel_loadable_with_rdkit_fix": ligand_is_obabel_loadable_with_rdkit_fix(
-                    ligand_path
+                    ligand_path, cache
                 ),
                 # "ligand_is_diffdock_loadable": ligand_is_diffdock_loadable(ligand_path),
                 "ligand_matches_smiles_atom_num": ligand_matches_smiles_atom_num(
-                    ligand["ligand_resolved_smiles"], ligand_path
+                    ligand["ligand_resolved_smiles"], ligand_path, cache
                 ),
                 "ligand_positions_correct": ligand_positions_correct(
-                    ligand["center_of_mass"], ligand_path
+                    ligand["center_of_mass"], ligand_path, cache
+                ),
+                "ligand_loadbable_via_biotite": file_loadbable_via_biotite(
+                    ligand_path, cache
+                ),
+                "ligand_molvs_validation": get_molvs_ligand_validation(
+                    ligand_path, cache
+                ),
+                "ligand_rdkit_validation": get_rdkit_ligand_validation(
+                    ligand_path, cache
                 ),
-                "ligand_loadbable_via_biotite": file_loadbable_via_biotite(ligand_path),
-                "ligand_molvs_validation": get_molvs_ligand_validation(ligand_path),
-                "ligand_rdkit_validation": get_rdkit_ligand_validation(ligand_path),
                 "complex_loadbable_via_biotite": file_loadbable_via_biotite(
-                    complex_path
+                    complex_path, cache
                 ),
                 "ligand_protein_neighbor_still_preserved_complex": ligand_protein_neighbor_still_preserved_complex(
-                    protein_chains, complex_path, protein_chains, ligand_chains
+                    protein_chains,
+                    complex_path,
+                    protein_chains,
+                    ligand_chains,
+                    cache=cache,
                 ),
                 "all_ligand_chains_present": all_ligand_chains_present(
-                    ligand_chains, complex_path
+                    ligand_chains, complex_path, cache
                 ),
                 "all_protein_chains_present": all_protein_chains_present(
-                    protein_chains, complex_path
+                    protein_chains, complex_path, cache
                 ),
             }
         )
@@ -133,10 +133,47 @@ def cloud_save_annotation() -> None:
     )
     assert cfg["mmcif_file"] is not None, "please pass mmcif_file=path/to/cif"
     assert cfg["validation_xml"] is not None, "please pass validation_xml=path/to/xml"
-    cif = Path(cfg.pop("mmcif_file"))
-    val = Path(cfg.pop("validation_xml"))
-    entry_cfg = cfg.pop("entry")
-    annotation_cfg = cfg.pop("annotation")
+    save_annotation(
+        mmcif_file=Path(cfg.pop("mmcif_file")),
+        validation_xml=Path(cfg.pop("validation_xml")),
+        annotation_cfg=cfg.pop("annotation"),
+        entry_cfg=cfg.pop("entry"),
+        raise_exceptions=cfg["raise_exceptions"],
+    )
+
+
+def save_annotation(
+    *,
+    mmcif_file: Path,
+    validation_xml: Path,
+    annotation_cfg: Any,
+    entry_cfg: Any,
+    raise_exceptions: bool = False,
+) -> None:
+    """
+    Annotate a single entry and save it as JSON in entry_cfg.save_folder.
+    Failures are appended to failures.csv in the same folder.
+
+    Note
+    ----
+    This is the in-process counterpart of running this module as a
+    script, used by the warm worker pool in plinder.data.pipeline.mpqueue
+
+    Parameters
+    ----------
+    mmcif_file : Path
+        the mmcif file of the entry
+    validation_xml : Path
+        the validation report of the entry
+    annotation_cfg : Any
+        from plinder.data.pipeline.config.AnnotationConfig
+    entry_cfg : Any
+        from plinder.data.pipeline.config.EntryConfig
+    raise_exceptions : bool, default=False
+        if True, raise instead of recording failures
+    """
+    cif = Path(mmcif_file)
+    val = Path(validation_xml)
     save_folder = entry_cfg.get("save_folder")
     if save_folder is not None:
         Path(save_folder).mkdir(exist_ok=True, parents=True)
@@ -154,7 +191,7 @@ def cloud_save_annotation() -> None:
             with open(f"{save_folder}/{pdb_id}.json", "w") as f:
                 f.write(gpa.entry.model_dump_json(indent=4))
     except Exception as e:
-        if cfg["raise_exceptions"]:
+        if raise_exceptions:
             raise e
         LOG.error(f"exception on annotating {cif}: {repr(e)}")
         if save_folder is not None:
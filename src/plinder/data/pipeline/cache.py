@@ -0,0 +1,326 @@
+# Copyright (c) 2024, Plinder Development Team
+# Distributed under the terms of the Apache License 2.0
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass, field
+from hashlib import md5
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from omegaconf import DictConfig
+
+from plinder.core.utils.config import get_config_hash
+from plinder.core.utils.log import setup_logger
+from plinder.data.pipeline.utils import hash_contents
+
+LOG = setup_logger(__name__)
+
+_ChunkFiles = Callable[[list[Any]], tuple[list[str], list[str]]]
+
+
+@dataclass
+class StageFiles:
+    """
+    Declare what a stage depends on and what it produces so
+    that it can be skipped when nothing changed. All paths are
+    relative to the plinder_dir (unless absolute) and may be files,
+    directories or glob patterns.
+
+    Attributes
+    ----------
+    config : list[str]
+        config sections the stage depends on
+    inputs : list[str]
+        paths read by the (unscattered) stage
+    outputs : list[str]
+        paths written by the (unscattered) stage
+    chunk : Callable[[list[Any]], tuple[list[str], list[str]]], default=None
+        for scattered stages, return the input and output paths of a chunk
+    config_outputs : Callable[[DictConfig], list[str]], default=None
+        return additional output paths (relative or absolute) that
+        depend on the config, e.g. a configurable destination
+    """
+
+    config: list[str] = field(default_factory=list)
+    inputs: list[str] = field(default_factory=list)
+    outputs: list[str] = field(default_factory=list)
+    chunk: Optional[_ChunkFiles] = None
+    config_outputs: Optional[Callable[[DictConfig], list[str]]] = None
+
+
+def _entry_files(pdb_dirs: list[str]) -> tuple[list[str], list[str]]:
+    inputs, outputs = [], []
+    for pdb_dir in pdb_dirs:
+        code, pdb_id = pdb_dir[-3:-1], pdb_dir[-4:]
+        inputs.extend([f"ingest/{code}/{pdb_dir}", f"reports/{code}/{pdb_id}"])
+        # the systems of an entry are saved in raw_entries/{code}/{system_id}/
+        outputs.extend(
+            [f"raw_entries/{code}/{pdb_id}.json", f"raw_entries/{code}/{pdb_id}__*"]
+        )
+    return inputs, outputs
+
+
+def _structure_qc_files(codes: list[str]) -> tuple[list[str], list[str]]:
+    inputs = [f"raw_entries/{code}" for code in codes]
+    outputs = (
+        [f"entries/{code}.zip" for code in codes]
+        + [f"qc/index/{code}.parquet" for code in codes]
+        + [f"qc/logs/{code}_qc_fails.csv" for code in codes]
+    )
+    return inputs, outputs
+
+
+def _system_archive_files(codes: list[str]) -> tuple[list[str], list[str]]:
+    return (
+        [f"raw_entries/{code}" for code in codes],
+        [f"archives/{code}.zip" for code in codes]
+        + [f"archives/{code}.index.parquet" for code in codes],
+    )
+
+
+def _ligand_files(pdb_ids: list[str]) -> tuple[list[str], list[str]]:
+    codes = sorted({pdb_id[-3:-1] for pdb_id in pdb_ids})
+    return (
+        [f"entries/{code}.zip" for code in codes],
+        [f"ligands/{hash_contents(pdb_ids)}.parquet"],
+    )
+
+
+def _ligand_score_files(ligand_ids: list[int]) -> tuple[list[str], list[str]]:
+    hashid = hash_contents([str(i) for i in ligand_ids])
+    return ["fingerprints"], [f"ligand_scores/{hashid}.parquet"]
+
+
+def _collated_files(cfg: DictConfig) -> list[str]:
+    return [cfg.get("collate", {}).get("dst_dir", "collated_scores")]
+
+
+# stages without an entry here are always run
+STAGE_FILES = {
+    "make_entries": StageFiles(config=["annotation", "entry"], chunk=_entry_files),
+    "structure_qc": StageFiles(chunk=_structure_qc_files),
+    "make_system_archives": StageFiles(chunk=_system_archive_files),
+    "make_ligands": StageFiles(chunk=_ligand_files),
+    "compute_ligand_fingerprints": StageFiles(
+        config=["ligand"],
+        inputs=["ligands"],
+        outputs=["fingerprints"],
+    ),
+    "make_ligand_scores": StageFiles(config=["ligand"], chunk=_ligand_score_files),
+    "collate_partitions": StageFiles(
+        config=["collate"], inputs=["scores"], config_outputs=_collated_files
+    ),
+    "make_mmp_index": StageFiles(
+        inputs=["qc/index", "clusters"],
+        outputs=[
+            "index/annotation_table.parquet",
+            "index/annotation_table_nonredundant.parquet",
+            "mmp",
+        ],
+    ),
+}
+
+
+def fingerprint_paths(
+    data_dir: Path,
+    paths: list[str],
+    hash_files: bool = False,
+) -> str:
+    """
+    Fingerprint files by their relative path, size and modification
+    time (and optionally their contents).
+
+    Parameters
+    ----------
+    data_dir : Path
+        the root plinder dir
+    paths : list[str]
+        files, directories or glob patterns, relative to data_dir
+        unless absolute
+    hash_files : bool, default=False
+        if True, also hash file contents
+
+    Returns
+    -------
+    str
+        the fingerprint
+    """
+    digest = md5()
+    for rel in sorted(paths):
+        matches = sorted(data_dir.glob(rel)) if any(c in rel for c in "*?[") else []
+        if not matches:
+            matches = [data_dir / rel]
+        for match in matches:
+            if not match.exists():
+                digest.update(f"{rel}:missing\n".encode())
+                continue
+            files = sorted(match.rglob("*")) if match.is_dir() else [match]
+            for file in files:
+                if not file.is_file():
+                    continue
+                stat = file.stat()
+                name = (
+                    file.relative_to(data_dir).as_posix()
+                    if file.is_relative_to(data_dir)
+                    else file.as_posix()
+                )
+                digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+                if hash_files:
+                    with file.open("rb") as f:
+                        for block in iter(lambda: f.read(1 << 20), b""):
+                            digest.update(block)
+    return digest.hexdigest()
+
+
+class StageCache:
+    """
+    Record input and output fingerprints of a stage (and of its
+    chunks) in {plinder_dir}/cache/{stage}.json so that unchanged
+    work can be skipped.
+
+    Parameters
+    ----------
+    data_dir : Path
+        the root plinder dir
+    stage : str
+        the name of the stage
+    cfg : DictConfig
+        the pipeline config
+    hash_files : bool, default=False
+        if True, also hash file contents
+    """
+
+    def __init__(
+        self,
+        *,
+        data_dir: Path,
+        stage: str,
+        cfg: DictConfig,
+        hash_files: bool = False,
+    ) -> None:
+        self.data_dir = data_dir
+        self.stage = stage
+        self.files = STAGE_FILES.get(stage)
+        self.hash_files = hash_files
+        self.path = data_dir / "cache" / f"{stage}.json"
+        self.config_hash = get_config_hash(
+            {
+                section: cfg.get(section, {})
+                for section in (self.files.config if self.files else [])
+            }
+        )
+        self.outputs: list[str] = []
+        if self.files is not None:
+            self.outputs = list(self.files.outputs)
+            if self.files.config_outputs is not None:
+                self.outputs += self.files.config_outputs(cfg)
+        self.state: dict[str, Any] = {"stage": None, "chunks": {}}
+        if self.path.is_file():
+            self.state = json.loads(self.path.read_text())
+
+    @property
+    def enabled(self) -> bool:
+        return self.files is not None
+
+    def _paths(self, chunk: Optional[list[Any]]) -> tuple[list[str], list[str]]:
+        assert self.files is not None
+        if chunk is None:
+            return self.files.inputs, self.outputs
+        if self.files.chunk is None:
+            return [], []
+        return self.files.chunk(chunk)
+
+    def _fingerprint(self, chunk: Optional[list[Any]]) -> dict[str, str]:
+        inputs, outputs = self._paths(chunk)
+        return {
+            "config": self.config_hash,
+            "inputs": fingerprint_paths(self.data_dir, inputs, self.hash_files),
+            "outputs": fingerprint_paths(self.data_dir, outputs, self.hash_files),
+        }
+
+    def _key(self, chunk: list[Any]) -> str:
+        return hash_contents([str(item) for item in chunk])
+
+    def is_fresh(self, chunk: Optional[list[Any]] = None) -> bool:
+        """
+        Check if the stage (or chunk) was already run with the
+        same config and inputs and its outputs are untouched.
+
+        Parameters
+        ----------
+        chunk : list[Any], default=None
+            the chunk to check, if None check the whole stage
+
+        Returns
+        -------
+        bool
+            True if the work can be skipped
+        """
+        if not self.enabled:
+            return False
+        if chunk is not None and self.files.chunk is None:  # type: ignore
+            return False
+        if chunk is None:
+            recorded = self.state.get("stage")
+        else:
+            recorded = self.state["chunks"].get(self._key(chunk))
+        return recorded is not None and recorded == self._fingerprint(chunk)
+
+    def freeze(self, chunks: list[list[Any]]) -> list[list[Any]]:
+        """
+        Re-use the chunks of the previous scatter if they hold the same
+        items in as many chunks, so that chunks balanced with changed
+        cost estimates keep their keys (and stay fresh).
+
+        Parameters
+        ----------
+        chunks : list[list[Any]]
+            the chunks produced by the scatter
+
+        Returns
+        -------
+        list[list[Any]]
+            the previous chunks or the given chunks, which are recorded
+        """
+        if not self.enabled or self.files.chunk is None:  # type: ignore
+            return chunks
+
+        def items(chunks: list[list[Any]]) -> list[str]:
+            return sorted(json.dumps(item) for chunk in chunks for item in chunk)
+
+        previous = self.state.get("scatter")
+        if (
+            previous is not None
+            and len(previous) == len(chunks)
+            and items(previous) == items(chunks)
+        ):
+            return [list(chunk) for chunk in previous]
+        self.state["scatter"] = chunks
+        self._save()
+        return chunks
+
+    def record(self, chunk: Optional[list[Any]] = None) -> None:
+        """
+        Record the current fingerprint of the stage (or chunk).
+
+        Parameters
+        ----------
+        chunk : list[Any], default=None
+            the chunk to record, if None record the whole stage
+        """
+        if not self.enabled:
+            return
+        if chunk is None:
+            self.state["stage"] = self._fingerprint(None)
+        elif self.files.chunk is not None:  # type: ignore
+            self.state["chunks"][self._key(chunk)] = self._fingerprint(chunk)
+        else:
+            return
+        self._save()
+
+    def _save(self) -> None:
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.state, indent=2))
+        tmp.replace(self.path)
@@ -5,41 +5,10 @@ from functools import partial
 from typing import Any, Optional
 
 from plinder.core.utils import config as _config
+from plinder.core.utils import schemas as _schemas
+from plinder.data.pipeline.executor import EXECUTORS
 
-METRICS = [
-    # pli_qcov:
-    "pli_qcov",
-    "pli_unique_qcov",
-    # seq_sim:
-    "protein_seqsim_qcov_max",
-    "protein_seqsim_qcov_weighted_max",
-    "protein_seqsim_qcov_weighted_sum",
-    "protein_seqsim_max",
-    "protein_seqsim_weighted_max",
-    "protein_seqsim_weighted_sum",
-    # protein
-    "protein_fident_qcov_max",
-    "protein_fident_qcov_weighted_max",
-    "protein_fident_qcov_weighted_sum",
-    "protein_fident_max",
-    "protein_fident_weighted_max",
-    "protein_fident_weighted_sum",
-    "protein_lddt_max",
-    "protein_lddt_qcov_max",
-    "protein_lddt_qcov_weighted_max",
-    "protein_lddt_qcov_weighted_sum",
-    "protein_lddt_weighted_max",
-    "protein_lddt_weighted_sum",
-    "protein_qcov_max",
-    "protein_qcov_weighted_max",
-    "protein_qcov_weighted_sum",
-    # pocket
-    "pocket_fident_qcov",
-    "pocket_fident",
-    "pocket_lddt_qcov",
-    "pocket_lddt",
-    "pocket_qcov",
-]
+METRICS = _schemas.PROTEIN_SIMILARITY_METRICS
 
 
 @dataclass
@@ -57,10 +26,23 @@ class IngestConfig(_config.DataConfig):
         if set, comma-separated list of specific stages to run
     skip_specific_stages : str, default=""
         if set, comma-separated list of specific stages to skip
+    cache_stages : bool, default=False
+        if True, skip stages (or chunks of stages) whose config, inputs
+        and outputs did not change since they last ran successfully
+    cache_hash_files : bool, default=False
+        if True, fingerprint file contents in addition to sizes and
+        modification times when caching stages
+    run_id : str, default=""
+        if set, record the chunks of every stage in a run ledger at
+        {plinder_dir}/ledger/{run_id}.sqlite and, when run again with
+        the same run_id, only run the chunks that did not succeed yet
     """
 
     run_specific_stages: Any = ""
     skip_specific_stages: Any = ""
+    cache_stages: bool = False
+    cache_hash_files: bool = False
+    run_id: str = ""
 
     def __post_init__(self) -> None:
         super().__post_init__()
@@ -128,6 +110,13 @@ class ScorerConfig:
     rerun_existing_batch: bool = False
     minimum_threshold: float = 0.2
     sub_databases: Any = "holo,apo,pred"
+    # also write scores_wide (one file per batch, not collated)
+    write_wide_scores: bool = False
+    # entries kept in memory across the pdb_ids of a make_batch_scores batch
+    entry_cache_size: int = 5000
+    # pre-compute the sub-database indices in make_sub_dbs and keep them
+    # in memory (touchdb, --db-load-mode 2) for run_batch_searches
+    preload_target_dbs: bool = False
 
     def __post_init__(self) -> None:
         if isinstance(self.sub_databases, str):
@@ -204,6 +193,40 @@ class ScatterConfig:
         if the entry JSON already exists, skip generation
     make_entries_cpu : int, default=1
         misguided experiments in multiprocessing over C++ libs (bad idea)
+    make_entries_tasks_per_worker : int, default=0
+        respawn make_entries annotation workers after this many entries,
+        0 keeps workers warm for the whole chunk
+    make_entries_task_timeout : int, default=10800
+        seconds after which the annotation of a single entry is killed
+        and recorded as failed, 0 for no limit
+    structure_qc_cpu : int, default=1
+        number of processes validating and checking the entries of a
+        two character code in structure_qc
+    make_system_archives_batch_size : int, default=4
+        number of two character codes per make_system_archives task
+    make_system_archives_cpu : int, default=4
+        number of processes deflating the archive members of a chunk
+        of two character codes in make_system_archives
+    make_batch_scores_cpu : int, default=1
+        number of processes scoring the pdb IDs of a batch
+        in make_batch_scores
+    make_ligands_cpu : int, default=1
+        number of processes computing the inchikeys of a chunk
+        in make_ligands
+    compute_ligand_fingerprints_cpu : int, default=1
+        number of processes computing the ligand fingerprints
+        in compute_ligand_fingerprints
+    make_ligand_scores_cpu : int, default=1
+        number of threads computing the ligand similarities of
+        a batch in make_ligand_scores, 0 for all cpus
+    balance_chunks : bool, default=False
+        keep the number of chunks of make_entries, structure_qc,
+        make_system_archives, run_batch_searches and make_batch_scores
+        but balance them by a cost estimate (CIF size and previous
+        make_entries telemetry, or size of the raw entries) instead
+        of slicing a fixed number of items per chunk; with
+        ingest.cache_stages, the chunks of the previous scatter of the
+        same items are re-used
     """
 
     two_char_batch_size: int = 2  # ~1060 codes / 500 workers
@@ -216,6 +239,16 @@ class ScatterConfig:
     wipe_entries: bool = False
     wipe_annotations: bool = False
     make_entries_cpu: int = 4
+    make_entries_tasks_per_worker: int = 0
+    make_entries_task_timeout: int = 10800
+    structure_qc_cpu: int = 1
+    make_system_archives_batch_size: int = 4  # ~1060 codes / 265 workers
+    make_system_archives_cpu: int = 4
+    make_batch_scores_cpu: int = 1
+    make_ligands_cpu: int = 1
+    compute_ligand_fingerprints_cpu: int = 1
+    make_ligand_scores_cpu: int = 1
+    balance_chunks: bool = False
     make_sub_dbs_cpu: int = 4
     make_scorers_cpu: int = 4
     download_alternative_datasets_threads: int = 10
@@ -247,6 +280,93 @@ class LigandConfig:
     save_top_k_similar_ligands: int = 5000
     multiply_by: int = 100
     score_name: str = "tanimoto_similarity_max"
+    # persistent cache of inchikeys and fingerprints by canonical SMILES,
+    # relative to plinder_dir unless absolute, shared across releases
+    cache_dir: str = ""
+
+
+@dataclass
+class ExecutorConfig:
+    """
+    Control how IngestPipeline.run_stage executes the chunks
+    of a stage when the pipeline is run locally.
+
+    Attributes
+    ----------
+    kind : str, default="serial"
+        one of "serial", "process" or "thread"
+    max_workers : int, default=0
+        maximum number of chunks run concurrently, 0 means os.cpu_count()
+    stage_max_workers : str, default=""
+        comma-separated stage:max_workers overrides of max_workers,
+        e.g. "make_entries:16,make_batch_scores:4"
+    min_available_memory_gb : float, default=0.0
+        hold back new chunks while less memory is available (0 to disable)
+    memory_poll_interval : float, default=1.0
+        seconds between memory checks while throttled
+    """
+
+    kind: str = "serial"
+    max_workers: int = 0
+    stage_max_workers: Any = ""
+    min_available_memory_gb: float = 0.0
+    memory_poll_interval: float = 1.0
+
+    def __post_init__(self) -> None:
+        if self.kind not in EXECUTORS:
+            raise ValueError(f"{self.__class__.__name__}.kind must be in {EXECUTORS}")
+        if isinstance(self.stage_max_workers, str):
+            stage_max_workers = {}
+            for item in self.stage_max_workers.split(","):
+                if not item:
+                    continue
+                stage, _, workers = item.partition(":")
+                if not workers.isdigit():
+                    raise ValueError(
+                        f"{self.__class__.__name__}.stage_max_workers must be "
+                        "comma-separated stage:max_workers pairs"
+                    )
+                stage_max_workers[stage] = int(workers)
+            self.stage_max_workers = stage_max_workers
+        if self.max_workers < 0:
+            raise ValueError(f"{self.__class__.__name__}.max_workers must be >= 0")
+
+
+@dataclass
+class CollateConfig:
+    """
+    Control how collate_partitions merges the batch scores of
+    make_batch_scores into a dataset partitioned by metric.
+
+    Attributes
+    ----------
+    dst_dir : str, default="collated_scores"
+        destination of the collated dataset, relative to plinder_dir
+        unless absolute
+    incremental : bool, default=True
+        only append batch files that were not collated yet, the
+        dataset is rebuilt if a collated batch file changed or vanished
+    memory_limit : str, default=""
+        duckdb memory limit (e.g. "16GB"), larger data spills to disk
+    threads : int, default=0
+        duckdb threads, 0 for duckdb's default
+    row_group_size : int, default=500000
+        parquet row group size of the collated files
+    compact_min_files : int, default=0
+        compact metric partitions holding at least this many files into
+        a single file in the background, 0 to disable
+    """
+
+    dst_dir: str = "collated_scores"
+    incremental: bool = True
+    memory_limit: str = ""
+    threads: int = 0
+    row_group_size: int = 500_000
+    compact_min_files: int = 0
+
+    def __post_init__(self) -> None:
+        if self.threads < 0:
+            raise ValueError(f"{self.__class__.__name__}.threads must be >= 0")
 
 
 SCHEMA = {
@@ -259,6 +379,8 @@ SCHEMA = {
     "scorer": ScorerConfig,
     "scatter": ScatterConfig,
     "ligand": LigandConfig,
+    "executor": ExecutorConfig,
+    "collate": CollateConfig,
 }
 
 
@@ -0,0 +1,202 @@
+# Copyright (c) 2024, Plinder Development Team
+# Distributed under the terms of the Apache License 2.0
+from __future__ import annotations
+
+import multiprocessing
+import os
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import Any, Callable, Optional, Sequence
+
+from plinder.core.utils import profiling
+from plinder.core.utils.log import setup_logger
+
+LOG = setup_logger(__name__)
+
+EXECUTORS = ["serial", "process", "thread"]
+
+
+def get_available_memory_gb() -> Optional[float]:
+    """
+    Get the memory available for new allocations without swapping.
+
+    Returns
+    -------
+    float | None
+        available memory in GB or None if it can not be determined
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024**2
+    except OSError:
+        pass
+    return None
+
+
+def _run_chunk(
+    func: Callable[..., Any],
+    index: int,
+    chunk: Any,
+    parent_id: Optional[str] = None,
+) -> Any:
+    # parent_id is the span that submitted the chunk, workers do not share it
+    with profiling.parent(parent_id), profiling.span("chunk", index=index) as span:
+        span.add(items=len(chunk))
+        return func(chunk)
+
+
+def _wait_for_memory(
+    *,
+    in_flight: set[Future[Any]],
+    min_available_memory_gb: float,
+    poll_interval: float,
+) -> set[Future[Any]]:
+    """
+    Block until enough memory is available or nothing is running
+    anymore (in which case submitting is the only way forward).
+    Returns the futures that finished in the meantime.
+    """
+    finished: set[Future[Any]] = set()
+    if min_available_memory_gb <= 0:
+        return finished
+    warned = False
+    while in_flight:
+        available = get_available_memory_gb()
+        if available is None or available >= min_available_memory_gb:
+            return finished
+        if not warned:
+            LOG.info(
+                f"throttling: {available:.1f}GB available < "
+                f"{min_available_memory_gb:.1f}GB, waiting on {len(in_flight)} chunks"
+            )
+            warned = True
+        done, _ = wait(in_flight, timeout=poll_interval, return_when=FIRST_COMPLETED)
+        in_flight.difference_update(done)
+        finished.update(done)
+    return finished
+
+
+def run_chunks(
+    func: Callable[..., Any],
+    chunks: Sequence[Any],
+    *,
+    kind: str = "serial",
+    max_workers: int = 0,
+    min_available_memory_gb: float = 0.0,
+    poll_interval: float = 1.0,
+    on_start: Optional[Callable[[int], None]] = None,
+    on_done: Optional[Callable[[int, Any], None]] = None,
+    on_error: Optional[Callable[[int, BaseException], None]] = None,
+) -> list[Any]:
+    """
+    Call func on every chunk and return the outputs in chunk order,
+    so that the join of a stage sees the same outputs regardless of
+    how the chunks were executed.
+
+    Parameters
+    ----------
+    func : Callable[..., Any]
+        the compute function of a stage, must be picklable for kind="process"
+    chunks : Sequence[Any]
+        the chunks produced by the scatter of a stage
+    kind : str, default="serial"
+        one of "serial", "process" or "thread"
+    max_workers : int, default=0
+        maximum number of chunks to run concurrently, 0 means os.cpu_count()
+    min_available_memory_gb : float, default=0.0
+        hold back new chunks while less memory is available (0 to disable)
+    poll_interval : float, default=1.0
+        seconds between memory checks while throttled
+    on_start : Callable[[int], None], default=None
+        called in the calling process with the index of every chunk
+        when it is handed to a worker
+    on_done : Callable[[int, Any], None], default=None
+        called in the calling process with the index and output of
+        every chunk as soon as it finished successfully
+    on_error : Callable[[int, BaseException], None], default=None
+        called in the calling process with the index and exception of
+        the chunk that failed before the exception is raised
+
+    Returns
+    -------
+    list[Any]
+        the outputs of func for every chunk
+    """
+    if kind not in EXECUTORS:
+        raise ValueError(f"kind={kind} not in {EXECUTORS}")
+    workers = min(max_workers or os.cpu_count() or 1, max(len(chunks), 1))
+    if kind == "serial" or workers == 1:
+        outs = []
+        for i, chunk in enumerate(chunks):
+            if on_start is not None:
+                on_start(i)
+            try:
+                outs.append(_run_chunk(func, i, chunk))
+            except BaseException as error:
+                if on_error is not None:
+                    on_error(i, error)
+                raise
+            if on_done is not None:
+                on_done(i, outs[-1])
+        return outs
+    executor: Executor
+    if kind == "process":
+        executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    LOG.info(f"run_chunks: {len(chunks)} chunks on {workers} {kind} workers")
+    futures: list[Future[Any]] = []
+    in_flight: set[Future[Any]] = set()
+    indices: dict[Future[Any], int] = {}
+
+    def report(done: set[Future[Any]]) -> None:
+        # surface failures early instead of after all submissions
+        for future in done:
+            try:
+                out = future.result()
+            except BaseException as error:
+                if on_error is not None:
+                    on_error(indices[future], error)
+                raise
+            if on_done is not None:
+                on_done(indices[future], out)
+
+    with executor:
+        try:
+            for i, chunk in enumerate(chunks):
+                if len(in_flight) >= workers:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    report(done)
+                report(
+                    _wait_for_memory(
+                        in_flight=in_flight,
+                        min_available_memory_gb=min_available_memory_gb,
+                        poll_interval=poll_interval,
+                    )
+                )
+                if on_start is not None:
+                    on_start(i)
+                future = executor.submit(
+                    _run_chunk, func, i, chunk, profiling.current_span_id()
+                )
+                futures.append(future)
+                indices[future] = i
+                in_flight.add(future)
+            while in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                report(done)
+            return [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
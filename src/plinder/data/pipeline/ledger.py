@@ -0,0 +1,270 @@
+# Copyright (c) 2024, Plinder Development Team
+# Distributed under the terms of the Apache License 2.0
+from __future__ import annotations
+
+import pickle
+import sqlite3
+from pathlib import Path
+from time import time
+from typing import Any, Optional
+
+from plinder.core.utils.log import setup_logger
+from plinder.data.pipeline.utils import hash_contents
+
+LOG = setup_logger(__name__)
+
+STATUSES = ["pending", "running", "succeeded", "failed", "cached"]
+# chunks in these states are not run again when resuming
+DONE = ("succeeded", "cached")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stages (
+    stage TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    n_chunks INTEGER,
+    started REAL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    stage TEXT NOT NULL,
+    chunk_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    n_items INTEGER NOT NULL,
+    items BLOB NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started REAL,
+    finished REAL,
+    wall_s REAL,
+    error TEXT,
+    output BLOB,
+    PRIMARY KEY (stage, position)
+);
+-- ledgers created with chunks keyed by chunk_id
+CREATE UNIQUE INDEX IF NOT EXISTS chunks_position ON chunks (stage, position);
+"""
+
+
+def chunk_id(chunk: Any) -> str:
+    """
+    Return a repeatable identifier of a chunk
+
+    Parameters
+    ----------
+    chunk : Any
+        a chunk produced by the scatter of a stage
+
+    Returns
+    -------
+    str
+        the chunk id
+    """
+    return hash_contents([str(item) for item in chunk])
+
+
+class RunLedger:
+    """
+    Record the scatter chunks of every stage of a pipeline run
+    along with their status, timings, retries and outputs in a
+    SQLite database, so that an interrupted run can be resumed
+    without scattering again and without re-running the chunks
+    that already succeeded.
+
+    Parameters
+    ----------
+    path : Path
+        the SQLite database, e.g. {plinder_dir}/ledger/{run_id}.sqlite
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.conn = sqlite3.connect(path.as_posix(), isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def stage_status(self, stage: str) -> Optional[str]:
+        """
+        Get the status of a stage or None if it was never started.
+        """
+        row = self.conn.execute(
+            "SELECT status FROM stages WHERE stage = ?", (stage,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def start_stage(self, stage: str, n_chunks: Optional[int] = None) -> None:
+        self.conn.execute(
+            "INSERT INTO stages (stage, status, n_chunks, started) "
+            "VALUES (?, 'running', ?, ?) ON CONFLICT (stage) DO UPDATE SET "
+            "status = 'running', n_chunks = COALESCE(excluded.n_chunks, n_chunks)",
+            (stage, n_chunks, time()),
+        )
+
+    def finish_stage(self, stage: str, status: str = "succeeded") -> None:
+        self.conn.execute(
+            "UPDATE stages SET status = ?, finished = ? WHERE stage = ?",
+            (status, time(), stage),
+        )
+
+    def register(self, stage: str, chunks: list[Any]) -> None:
+        """
+        Record the chunks produced by the scatter of a stage by
+        their position. Chunks that are already known at the same
+        position keep their status, other chunks are reset.
+
+        Parameters
+        ----------
+        stage : str
+            the name of the stage
+        chunks : list[Any]
+            the chunks produced by the scatter
+        """
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT INTO chunks "
+                "(stage, chunk_id, position, n_items, items, status) "
+                "VALUES (?, ?, ?, ?, ?, 'pending') "
+                "ON CONFLICT (stage, position) DO UPDATE SET "
+                "chunk_id = excluded.chunk_id, n_items = excluded.n_items, "
+                "items = excluded.items, status = 'pending', attempts = 0, "
+                "started = NULL, finished = NULL, wall_s = NULL, error = NULL, "
+                "output = NULL WHERE chunk_id != excluded.chunk_id",
+                [
+                    (stage, chunk_id(chunk), i, len(chunk), pickle.dumps(chunk))
+                    for i, chunk in enumerate(chunks)
+                ],
+            )
+            self.conn.execute(
+                "DELETE FROM chunks WHERE stage = ? AND position >= ?",
+                (stage, len(chunks)),
+            )
+        self.start_stage(stage, len(chunks))
+
+    def positioned_chunks(
+        self, stage: str, pending: bool = False
+    ) -> list[tuple[int, Any]]:
+        """
+        Get the registered chunks of a stage and their positions
+        in scatter order.
+
+        Parameters
+        ----------
+        stage : str
+            the name of the stage
+        pending : bool, default=False
+            if True, only return chunks that did not succeed yet
+
+        Returns
+        -------
+        list[tuple[int, Any]]
+            the positions and chunks
+        """
+        query = "SELECT position, items FROM chunks WHERE stage = ?"
+        params: tuple[str, ...] = (stage,)
+        if pending:
+            query += f" AND status NOT IN ({', '.join('?' * len(DONE))})"
+            params += DONE
+        rows = self.conn.execute(query + " ORDER BY position", params)
+        return [(position, pickle.loads(items)) for (position, items) in rows]
+
+    def chunks(self, stage: str, pending: bool = False) -> list[Any]:
+        """
+        Get the registered chunks of a stage in scatter order,
+        see positioned_chunks.
+        """
+        return [chunk for _, chunk in self.positioned_chunks(stage, pending)]
+
+    def outputs(self, stage: str) -> list[Any]:
+        """
+        Get the outputs of all chunks of a stage that returned
+        something, in scatter order.
+        """
+        rows = self.conn.execute(
+            "SELECT output FROM chunks WHERE stage = ? AND output IS NOT NULL "
+            "ORDER BY position",
+            (stage,),
+        )
+        return [pickle.loads(out) for (out,) in rows]
+
+    def _update(self, query: str, params: tuple[Any, ...], chunk: Any) -> None:
+        # the content hash guards against updating a chunk by a stale position
+        cursor = self.conn.execute(
+            query + " AND chunk_id = ?", (*params, chunk_id(chunk))
+        )
+        if cursor.rowcount != 1:
+            raise ValueError(f"chunk {chunk!r:.200} is not registered at {params[-1]}")
+
+    def start(self, stage: str, position: int, chunk: Any) -> None:
+        self._update(
+            "UPDATE chunks SET status = 'running', attempts = attempts + 1, "
+            "started = ?, finished = NULL, wall_s = NULL, error = NULL "
+            "WHERE stage = ? AND position = ?",
+            (time(), stage, position),
+            chunk,
+        )
+
+    def finish(
+        self,
+        stage: str,
+        position: int,
+        chunk: Any,
+        *,
+        status: str = "succeeded",
+        output: Any = None,
+        error: Optional[str] = None,
+    ) -> None:
+        """
+        Record the outcome of a chunk.
+
+        Parameters
+        ----------
+        stage : str
+            the name of the stage
+        position : int
+            the position of the chunk in the scatter
+        chunk : Any
+            the chunk
+        status : str, default="succeeded"
+            one of "succeeded", "failed" or "cached"
+        output : Any, default=None
+            the output of the chunk, passed to the join when resuming
+        error : str, default=None
+            the reason the chunk failed
+        """
+        if status not in STATUSES:
+            raise ValueError(f"status={status} not in {STATUSES}")
+        now = time()
+        self._update(
+            "UPDATE chunks SET status = ?, finished = ?, wall_s = ? - started, "
+            "error = ?, output = ? WHERE stage = ? AND position = ?",
+            (
+                status,
+                now,
+                now,
+                error,
+                None if output is None else pickle.dumps(output),
+                stage,
+                position,
+            ),
+            chunk,
+        )
+
+    def summary(self) -> list[dict[str, Any]]:
+        """
+        Count chunks, retries and time spent per stage and status.
+
+        Returns
+        -------
+        list[dict[str, Any]]
+            one record per stage and status
+        """
+        rows = self.conn.execute(
+            "SELECT stage, status, COUNT(*), SUM(n_items), SUM(attempts), "
+            "SUM(wall_s) FROM chunks GROUP BY stage, status ORDER BY stage, status"
+        )
+        keys = ["stage", "status", "chunks", "items", "attempts", "wall_s"]
+        return [dict(zip(keys, row)) for row in rows]
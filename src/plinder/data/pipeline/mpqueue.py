@@ -3,34 +3,59 @@
 #!/usr/bin/env python
 
 import argparse
+import importlib
 import logging
 import multiprocessing
 import os
+import resource
+import sys
 import time
+from collections import deque
+from dataclasses import dataclass
 from itertools import repeat
-from multiprocessing import cpu_count
-from subprocess import check_output
-from typing import List, Optional
+from multiprocessing import connection, cpu_count
+from subprocess import TimeoutExpired, check_output
+from typing import Any, Callable, List, Optional
 
 logging.basicConfig(format="[MPQueue] %(levelname)s: %(message)s", level=logging.DEBUG)
 
 
 class Task:
-    """A task class"""
+    """A task class, tasks with a higher cost are scheduled first"""
 
     def __init__(
-        self, command: str, path: str = ".", timeout: Optional[int] = None
+        self,
+        command: str,
+        path: str = ".",
+        timeout: Optional[int] = None,
+        cost: float = 0.0,
     ) -> None:
         self.command = command
         self.path = path
         if timeout is not None:
             timeout = int(timeout)
         self.timeout = timeout
+        self.cost = cost
+
+    @classmethod
+    def from_line(
+        cls, line: str, path: str = ".", timeout: Optional[int] = None
+    ) -> "Task":
+        """Parse a task line, optionally prefixed with a cost and a tab"""
+        prefix, sep, command = line.partition("\t")
+        if sep:
+            try:
+                return cls(command, path, timeout, float(prefix))
+            except ValueError:
+                pass
+        return cls(line, path, timeout)
 
     def run(self) -> None:
         """Runs a command in the given path"""
         try:
             check_output(self.command, shell=True, timeout=self.timeout, cwd=self.path)
+        except TimeoutExpired:
+            logging.warning(f"timed out after {self.timeout}s: {self.command}")
         except Exception:
             pass
 
@@ -65,15 +90,19 @@ class MPQueue(object):
         self.chunksize = chunksize
 
     def process(self) -> None:
+        # longest first so that expensive tasks do not straggle at the end,
+        # imap_unordered hands out the next task to whichever worker is free
+        ordered = sorted(enumerate(self.tasks), key=lambda item: -item[1].cost)
         with multiprocessing.get_context("spawn").Pool(
             processes=self.num_processes,
             maxtasksperchild=self.maxtasksperchild,
         ) as pool:
-            pool.map(
+            for _ in pool.imap_unordered(
                 MPQueue.run_task,
-                zip(enumerate(self.tasks), repeat(self.num_tasks)),
+                zip(ordered, repeat(self.num_tasks)),
                 chunksize=self.chunksize,
-            )
+            ):
+                pass
 
     @staticmethod
     def run_task(tup: tuple[tuple[int, Task], int]) -> None:
@@ -85,11 +114,297 @@ class MPQueue(object):
         logging.info(f"running task {item}/{total} took {(t1-t0):.2f}s")
 
 
+@dataclass
+class TaskResult:
+    """
+    The outcome of a task run by a WorkerPool
+
+    Attributes
+    ----------
+    index : int
+        the position of the task
+    status : str
+        one of "succeeded", "failed" (raised), "crashed" (worker died)
+        or "timeout" (worker killed after the task timeout)
+    error : str | None
+        the exception raised by the task or the reason the worker died
+    exitcode : int | None
+        the exit code of the worker if it died, negative for signals
+    wall_s : float
+        wall time of the task in seconds
+    cpu_s : float | None
+        CPU time of the task (including its subprocesses) in seconds,
+        None if the worker died
+    peak_rss_mb : float | None
+        peak resident memory of the worker during the task in MB,
+        None if the worker died
+    """
+
+    index: int
+    status: str
+    error: Optional[str] = None
+    exitcode: Optional[int] = None
+    wall_s: float = 0.0
+    cpu_s: Optional[float] = None
+    peak_rss_mb: Optional[float] = None
+
+
+def _cpu_time() -> float:
+    total = 0.0
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def _reset_peak_rss() -> None:
+    """Reset the peak RSS of the process so it can be measured per task (linux)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is the peak over the lifetime of the process
+    scale = 1 / 1024**2 if sys.platform == "darwin" else 1 / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def _load_target(target: str) -> Callable[..., Any]:
+    module, name = target.split(":")
+    func: Callable[..., Any] = getattr(importlib.import_module(module), name)
+    return func
+
+
+def _serve(target: str, conn: connection.Connection) -> None:
+    """
+    Worker loop: import the target once, then run tasks
+    received on conn until None is received.
+    """
+    func = _load_target(target)
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        index, kwargs = msg
+        _reset_peak_rss()
+        t0, cpu = time.time(), _cpu_time()
+        status, error = "succeeded", None
+        try:
+            func(**kwargs)
+        except Exception as e:
+            status, error = "failed", repr(e)
+        conn.send(
+            TaskResult(
+                index,
+                status,
+                error,
+                None,
+                time.time() - t0,
+                _cpu_time() - cpu,
+                _peak_rss_mb(),
+            )
+        )
+
+
+class _Worker:
+    def __init__(self, ctx: Any, target: str) -> None:
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_serve, args=(target, child), daemon=True)
+        self.process.start()
+        child.close()
+        self.index: Optional[int] = None
+        self.started = 0.0
+        self.done = 0
+
+    def submit(self, index: int, kwargs: dict[str, Any]) -> None:
+        self.conn.send((index, kwargs))
+        self.index = index
+        self.started = time.time()
+
+    def stop(self) -> None:
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """
+    Run tasks in long-lived worker processes that import the target
+    function once, instead of paying for a fresh interpreter (and
+    heavy imports) for every task. A worker dying on a task (e.g.
+    from a segfault in a C-extension) is detected, the task is
+    recorded as crashed and the worker is respawned, so later tasks
+    are unaffected. The same happens to a worker exceeding the task
+    timeout, which is killed.
+
+    Tasks are handed out one at a time to whichever worker is idle,
+    most expensive first when costs are given, so that the wall time
+    of a batch is not set by a straggler that happened to be queued
+    last.
+
+    Parameters
+    ----------
+    target : str
+        the function to call as "module:function", called with the
+        keyword arguments of every task
+    num_workers : int, default=0
+        number of worker processes, 0 means cpu_count() - 1
+    maxtasksperchild : int, default=None
+        respawn workers after this many tasks (None to never recycle)
+    timeout : float, default=None
+        kill a worker spending more than this many seconds on a task
+    """
+
+    def __init__(
+        self,
+        target: str,
+        num_workers: int = 0,
+        maxtasksperchild: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ) -> None:
+        self.target = target
+        self.num_workers = num_workers if num_workers > 0 else max(1, cpu_count() - 1)
+        self.maxtasksperchild = maxtasksperchild or None
+        self.timeout = timeout or None
+
+    def run(
+        self,
+        tasks: List[dict[str, Any]],
+        costs: Optional[List[float]] = None,
+    ) -> List[TaskResult]:
+        """
+        Run every task and return their results in task order
+
+        Parameters
+        ----------
+        tasks : list[dict[str, Any]]
+            keyword arguments of the target for every task
+        costs : list[float], default=None
+            estimated cost of every task (e.g. input file size),
+            used to schedule the most expensive tasks first
+
+        Returns
+        -------
+        list[TaskResult]
+            the outcome of every task
+        """
+        ctx = multiprocessing.get_context("spawn")
+        order = list(range(len(tasks)))
+        if costs is not None:
+            order.sort(key=lambda i: -costs[i])  # type: ignore
+        pending = deque((i, tasks[i]) for i in order)
+        results: List[Optional[TaskResult]] = [None] * len(tasks)
+        workers = [
+            _Worker(ctx, self.target) for _ in range(min(self.num_workers, len(tasks)))
+        ]
+        logging.info(f"WorkerPool running {len(tasks)} tasks on {len(workers)} workers")
+        try:
+            while True:
+                for i, worker in enumerate(workers):
+                    if worker.index is None and pending:
+                        index, kwargs = pending.popleft()
+                        try:
+                            worker.submit(index, kwargs)
+                        except OSError:
+                            # an idle worker died, replace it and retry
+                            worker.stop()
+                            workers[i] = worker = _Worker(ctx, self.target)
+                            worker.submit(index, kwargs)
+                busy = [worker for worker in workers if worker.index is not None]
+                if not busy:
+                    break
+                connection.wait(
+                    [w.conn for w in busy] + [w.process.sentinel for w in busy],
+                    timeout=self._next_deadline(busy),
+                )
+                for worker in busy:
+                    result = self._collect(worker) or self._expire(worker)
+                    if result is None:
+                        continue
+                    results[result.index] = result
+                    worker.index = None
+                    worker.done += 1
+                    recycle = (
+                        self.maxtasksperchild is not None
+                        and worker.done >= self.maxtasksperchild
+                    )
+                    if result.status in ["crashed", "timeout"] or recycle:
+                        worker.stop()
+                        workers[workers.index(worker)] = _Worker(ctx, self.target)
+        finally:
+            for worker in workers:
+                worker.stop()
+        return [result for result in results if result is not None]
+
+    def _next_deadline(self, busy: List[_Worker]) -> Optional[float]:
+        if self.timeout is None:
+            return None
+        started = min(worker.started for worker in busy)
+        return max(0.0, started + self.timeout - time.time())
+
+    def _expire(self, worker: _Worker) -> Optional[TaskResult]:
+        assert worker.index is not None
+        elapsed = time.time() - worker.started
+        if self.timeout is None or elapsed < self.timeout:
+            return None
+        logging.error(f"task {worker.index} timed out after {elapsed:.2f}s")
+        worker.process.kill()
+        worker.process.join()
+        return TaskResult(
+            worker.index,
+            "timeout",
+            f"timed out after {self.timeout}s",
+            worker.process.exitcode,
+            elapsed,
+        )
+
+    @staticmethod
+    def _collect(worker: _Worker) -> Optional[TaskResult]:
+        assert worker.index is not None
+        try:
+            if worker.conn.poll():
+                result: TaskResult = worker.conn.recv()
+                return result
+        except (EOFError, OSError):
+            pass
+        if worker.process.is_alive():
+            return None
+        worker.process.join()
+        exitcode = worker.process.exitcode
+        logging.error(f"worker died with exitcode {exitcode} on task {worker.index}")
+        return TaskResult(
+            worker.index,
+            "crashed",
+            f"worker died with exitcode {exitcode}",
+            exitcode,
+            time.time() - worker.started,
+        )
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="mpqueue")
     parser.add_argument(
         "tasks_file_name",
-        help="A file containing a task for each line",
+        help=(
+            "A file containing a task for each line, optionally prefixed by"
+            " a cost estimate and a tab to schedule expensive tasks first"
+        ),
         metavar="tasks_file_name",
     )
     parser.add_argument(
@@ -114,7 +429,7 @@ if __name__ == "__main__":
         "--chunksize",
         "-chunk",
         "-s",
-        help="Chunksize to pass to Pool.map",
+        help="Chunksize to pass to Pool.imap_unordered",
         dest="chunksize",
         type=int,
         default=1,
@@ -133,7 +448,9 @@ if __name__ == "__main__":
         tasks = []
         for line in handle:
             if line and not line.startswith("#"):
-                tasks.append(Task(line.rstrip(os.linesep), args.cwd, args.timeout))
+                tasks.append(
+                    Task.from_line(line.rstrip(os.linesep), args.cwd, args.timeout)
+                )
 
         queue = MPQueue(tasks, args.cores, args.maxtasksperchild)
         queue.process()
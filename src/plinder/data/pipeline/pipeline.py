@@ -1,12 +1,13 @@
 # Copyright (c) 2024, Plinder Development Team
 # Distributed under the terms of the Apache License 2.0
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Callable, Optional
 
 from omegaconf import DictConfig, OmegaConf
 
+from plinder.core.utils import profiling
 from plinder.core.utils.log import setup_logger
-from plinder.data.pipeline import config, tasks, utils
+from plinder.data.pipeline import cache, config, executor, ledger, tasks, utils
 
 LOG = setup_logger(__name__)
 
@@ -102,6 +103,7 @@ class IngestPipeline:
             wipe_annotations=self.cfg.scatter.wipe_annotations,
             skip_existing_entries=self.cfg.scatter.skip_existing_entries,
             skip_missing_annotations=self.cfg.scatter.skip_missing_annotations,
+            balance=self.cfg.scatter.balance_chunks,
         )
         return chunks
 
@@ -115,6 +117,8 @@ class IngestPipeline:
             wipe_entries=self.cfg.scatter.wipe_entries,
             wipe_annotations=self.cfg.scatter.wipe_annotations,
             cpu=self.cfg.scatter.make_entries_cpu,
+            tasks_per_worker=self.cfg.scatter.make_entries_tasks_per_worker,
+            task_timeout=self.cfg.scatter.make_entries_task_timeout,
             annotation_cfg=self.cfg.annotation,
             entry_cfg=self.cfg.entry,
         )
@@ -133,6 +137,7 @@ class IngestPipeline:
             data_dir=self.plinder_dir,
             two_char_codes=self.cfg.scatter.two_char_codes,
             batch_size=self.cfg.scatter.two_char_batch_size,
+            balance=self.cfg.scatter.balance_chunks,
         )
         return chunks
 
@@ -141,6 +146,7 @@ class IngestPipeline:
         tasks.structure_qc(
             data_dir=self.plinder_dir,
             two_char_codes=two_char_codes,
+            cpu=self.cfg.scatter.structure_qc_cpu,
         )
 
     @utils.ingest_flow_control
@@ -162,6 +168,8 @@ class IngestPipeline:
         tasks.make_ligands(
             data_dir=self.plinder_dir,
             pdb_ids=pdb_ids,
+            cpu=self.cfg.scatter.make_ligands_cpu,
+            cache_dir=self.cfg.ligand.cache_dir,
         )
 
     @utils.ingest_flow_control
@@ -169,6 +177,10 @@ class IngestPipeline:
         tasks.compute_ligand_fingerprints(
             data_dir=self.plinder_dir,
             split_char=self.cfg.ligand.ligand_id_split_char,
+            radius=self.cfg.ligand.radius,
+            nbits=self.cfg.ligand.nbits,
+            cpu=self.cfg.scatter.compute_ligand_fingerprints_cpu,
+            cache_dir=self.cfg.ligand.cache_dir,
         )
 
     @utils.ingest_flow_control
@@ -188,6 +200,7 @@ class IngestPipeline:
             save_top_k_similar_ligands=self.cfg.ligand.save_top_k_similar_ligands,
             multiply_by=self.cfg.ligand.multiply_by,
             number_id_col=self.cfg.scatter.number_id_col,
+            cpu=self.cfg.scatter.make_ligand_scores_cpu,
         )
 
     @utils.ingest_flow_control
@@ -199,7 +212,8 @@ class IngestPipeline:
         chunks: list[list[str]] = tasks.scatter_make_system_archives(
             data_dir=self.plinder_dir,
             two_char_codes=self.cfg.scatter.two_char_codes,
-            batch_size=self.cfg.scatter.two_char_batch_size,
+            batch_size=self.cfg.scatter.make_system_archives_batch_size,
+            balance=self.cfg.scatter.balance_chunks,
         )
         return chunks
 
@@ -208,6 +222,7 @@ class IngestPipeline:
         tasks.make_system_archives(
             data_dir=self.plinder_dir,
             two_char_codes=two_char_codes,
+            cpu=self.cfg.scatter.make_system_archives_cpu,
         )
 
     @utils.ingest_flow_control
@@ -215,6 +230,7 @@ class IngestPipeline:
         tasks.make_sub_dbs(
             data_dir=self.plinder_dir,
             sub_databases=self.cfg.scorer.sub_databases,
+            create_index=self.cfg.scorer.preload_target_dbs,
         )
 
     @utils.ingest_flow_control
@@ -224,6 +240,7 @@ class IngestPipeline:
             batch_size=self.cfg.scatter.run_batch_searches_batch_size,
             two_char_codes=self.cfg.scatter.two_char_codes,
             pdb_ids=self.cfg.scatter.pdb_ids,
+            balance=self.cfg.scatter.balance_chunks,
         )
         return chunks
 
@@ -242,6 +259,7 @@ class IngestPipeline:
             batch_size=self.cfg.scatter.make_batch_scores_batch_size,
             two_char_codes=self.cfg.scatter.two_char_codes,
             pdb_ids=self.cfg.scatter.pdb_ids,
+            balance=self.cfg.scatter.balance_chunks,
         )
         return chunks
 
@@ -251,11 +269,20 @@ class IngestPipeline:
             data_dir=self.plinder_dir,
             pdb_ids=pdb_ids,
             scorer_cfg=self.cfg.scorer,
+            cpu=self.cfg.scatter.make_batch_scores_cpu,
         )
 
     @utils.ingest_flow_control
     def collate_partitions(self) -> None:
-        tasks.collate_partitions(data_dir=self.plinder_dir)
+        tasks.collate_partitions(
+            data_dir=self.plinder_dir,
+            dst_dir=self.cfg.collate.dst_dir,
+            incremental=self.cfg.collate.incremental,
+            memory_limit=self.cfg.collate.memory_limit,
+            threads=self.cfg.collate.threads,
+            row_group_size=self.cfg.collate.row_group_size,
+            compact_min_files=self.cfg.collate.compact_min_files,
+        )
 
     @utils.ingest_flow_control
     def scatter_make_components_and_communities(self) -> list[list[tuple[str, int]]]:
@@ -329,31 +356,208 @@ class IngestPipeline:
             search_db="holo",
         )
 
+    def _stage_cache(self, stage: str) -> Optional[cache.StageCache]:
+        ingest = self.cfg.ingest
+        if not ingest.cache_stages or ingest.force_update:
+            return None
+        stage_cache = cache.StageCache(
+            data_dir=self.plinder_dir,
+            stage=stage,
+            cfg=self.cfg,
+            hash_files=ingest.cache_hash_files,
+        )
+        return stage_cache if stage_cache.enabled else None
+
+    def _run_ledger(self) -> Optional[ledger.RunLedger]:
+        run_id = self.cfg.ingest.run_id
+        if not run_id:
+            return None
+        return ledger.RunLedger(self.plinder_dir / "ledger" / f"{run_id}.sqlite")
+
     def run_stage(self, stage: str) -> None:
         """
         A stage is defined minimally as a {method} that
         is defined on the pipeline, optionally with
         a scatter_{method} to chunk inputs to feed into
         {method} and optionally a join_{method} to reduce
-        the outputs produced by it.
+        the outputs produced by it. Chunks are executed
+        as configured by the executor config, and their
+        outputs are joined in chunk order.
+
+        If ingest.cache_stages is set, chunks (or entire
+        unscattered stages) whose config, inputs and outputs
+        are unchanged since they last succeeded are skipped,
+        see plinder.data.pipeline.cache. Runs returning
+        something (e.g. failed entries) are never cached,
+        so the join only sees the outputs of executed chunks.
+        A scatter producing the same items as the previous one
+        re-uses its chunks, so that balanced chunks keep their
+        keys when the cost estimates change.
+
+        If ingest.run_id is set, the chunks, their status,
+        timings and attempts are recorded in a run ledger,
+        see plinder.data.pipeline.ledger. Running the same
+        run_id again re-uses the recorded chunks instead of
+        scattering, skips stages that already succeeded and
+        only runs chunks that are pending or failed (chunks
+        returning something count as failed). The join then
+        sees the outputs of all chunks of the run.
 
         Parameters
         ----------
         stage : str
             name of the stage to run
         """
+        ingest = self.cfg.ingest
+        # decided before the ledger and cache are touched, the methods
+        # of a skipped stage would otherwise be recorded as its chunks
+        if not utils.stage_is_selected(self, stage):
+            return
         scatter = getattr(self, f"scatter_{stage}", None)
         compute = getattr(self, stage)
         join = getattr(self, f"join_{stage}", None)
+        stage_cache = self._stage_cache(stage)
+        run_ledger = self._run_ledger()
+        status = None if run_ledger is None else run_ledger.stage_status(stage)
+        if status in ledger.DONE:
+            LOG.info(f"{stage}: already {status} in run {ingest.run_id}")
+            return
+        try:
+            with profiling.span(stage, kind="stage"):
+                self._run_stage(
+                    stage=stage,
+                    scatter=scatter,
+                    compute=compute,
+                    join=join,
+                    stage_cache=stage_cache,
+                    run_ledger=run_ledger,
+                    resume=status is not None,
+                )
+        except BaseException:
+            if run_ledger is not None:
+                run_ledger.finish_stage(stage, "failed")
+            raise
+        finally:
+            if run_ledger is not None:
+                run_ledger.close()
+
+    def _run_stage(
+        self,
+        *,
+        stage: str,
+        scatter: Optional[Callable[[], Any]],
+        compute: Callable[..., Any],
+        join: Optional[Callable[[list[Any]], Any]],
+        stage_cache: Optional[cache.StageCache],
+        run_ledger: Optional[ledger.RunLedger],
+        resume: bool,
+    ) -> None:
         chunks = None
         if scatter is not None:
-            chunks = scatter()
-        if chunks is not None:
-            outs = [compute(chunk) for chunk in chunks]
-        else:
+            if run_ledger is not None and resume:
+                chunks = run_ledger.chunks(stage)
+                LOG.info(f"{stage}: resuming {len(chunks)} chunks from ledger")
+            else:
+                chunks = scatter()
+                if stage_cache is not None and chunks is not None:
+                    chunks = stage_cache.freeze(chunks)
+                if run_ledger is not None and chunks is not None:
+                    run_ledger.register(stage, chunks)
+        if chunks is None:
+            if stage_cache is not None and stage_cache.is_fresh():
+                LOG.info(f"{stage}: skipping unchanged stage")
+                if run_ledger is not None:
+                    run_ledger.start_stage(stage)
+                    run_ledger.finish_stage(stage, "cached")
+                return
+            if run_ledger is not None:
+                run_ledger.start_stage(stage)
             outs = [compute()]
+            if stage_cache is not None and not outs[0]:
+                stage_cache.record()
+        else:
+            # chunks are recorded by their position in the scatter
+            todo = list(enumerate(chunks))
+            if run_ledger is not None:
+                todo = run_ledger.positioned_chunks(stage, pending=True)
+            if stage_cache is not None:
+                stale = []
+                for position, chunk in todo:
+                    if not stage_cache.is_fresh(chunk):
+                        stale.append((position, chunk))
+                    elif run_ledger is not None:
+                        run_ledger.finish(stage, position, chunk, status="cached")
+                LOG.info(
+                    f"{stage}: skipping {len(todo) - len(stale)} unchanged"
+                    f" of {len(todo)} chunks"
+                )
+                todo = stale
+            positions = [position for position, _ in todo]
+            chunks = [chunk for _, chunk in todo]
+            outs = executor.run_chunks(
+                compute,
+                chunks,
+                kind=self.cfg.executor.kind,
+                max_workers=self.cfg.executor.stage_max_workers.get(
+                    stage, self.cfg.executor.max_workers
+                ),
+                min_available_memory_gb=self.cfg.executor.min_available_memory_gb,
+                poll_interval=self.cfg.executor.memory_poll_interval,
+                **self._chunk_callbacks(
+                    stage, positions, chunks, stage_cache, run_ledger
+                ),
+            )
+            if run_ledger is not None:
+                outs = run_ledger.outputs(stage)
         if join is not None:
             join(outs)
+        if run_ledger is not None:
+            failed = chunks is not None and len(run_ledger.chunks(stage, pending=True))
+            run_ledger.finish_stage(stage, "failed" if failed else "succeeded")
+
+    @staticmethod
+    def _chunk_callbacks(
+        stage: str,
+        positions: list[int],
+        chunks: list[Any],
+        stage_cache: Optional[cache.StageCache],
+        run_ledger: Optional[ledger.RunLedger],
+    ) -> dict[str, Callable[..., None]]:
+        callbacks: dict[str, Callable[..., None]] = {}
+        if stage_cache is None and run_ledger is None:
+            return callbacks
+
+        def on_done(index: int, out: Any) -> None:
+            if stage_cache is not None and not out:
+                stage_cache.record(chunks[index])
+            if run_ledger is not None:
+                run_ledger.finish(
+                    stage,
+                    positions[index],
+                    chunks[index],
+                    status="failed" if out else "succeeded",
+                    output=out,
+                    error=f"returned {out!r:.200}" if out else None,
+                )
+
+        callbacks["on_done"] = on_done
+        if run_ledger is not None:
+
+            def on_start(index: int) -> None:
+                run_ledger.start(stage, positions[index], chunks[index])
+
+            def on_error(index: int, error: BaseException) -> None:
+                run_ledger.finish(
+                    stage,
+                    positions[index],
+                    chunks[index],
+                    status="failed",
+                    error=repr(error),
+                )
+
+            callbacks["on_start"] = on_start
+            callbacks["on_error"] = on_error
+        return callbacks
 
     def run(self) -> None:
         """
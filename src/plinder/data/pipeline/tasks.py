@@ -1,21 +1,23 @@
 # Copyright (c) 2024, Plinder Development Team
 # Distributed under the terms of the Apache License 2.0
+import json
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from shutil import rmtree
-from subprocess import check_output
 from textwrap import dedent
-from zipfile import ZIP_DEFLATED, ZipFile
+from typing import Any, Optional
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
 
 import pandas as pd
 from omegaconf import DictConfig
 
 from plinder.core.utils import gcs
 from plinder.core.utils.log import setup_logger
-from plinder.data import clusters, databases, leakage, splits
+from plinder.data import databases, leakage
 from plinder.data.pipeline import io, utils
 from plinder.data.pipeline.config import METRICS
-from plinder.data.utils import tanimoto
 
 LOG = setup_logger(__name__)
 STAGES = [
@@ -175,6 +177,39 @@ def make_dbs(*, data_dir: Path, sub_databases: list[str]) -> None:
         databases.make_db(source, output_dir, db.split("_")[-1])
 
 
+def _entry_costs(*, data_dir: Path, pdb_dirs: list[str]) -> list[float]:
+    """
+    Estimate the cost of annotating entries by the size of their
+    CIF, converted to seconds using make_entries telemetry (and
+    replaced by the measured wall time where available).
+    """
+    sizes = [
+        float(utils.get_path_size(data_dir / "ingest" / pdb_dir[-3:-1] / pdb_dir))
+        for pdb_dir in pdb_dirs
+    ]
+    telemetry = utils.load_task_telemetry(data_dir=data_dir, stage="make_entries")
+    if telemetry.empty:
+        return sizes
+    known = telemetry[telemetry["cif_bytes"] > 0]
+    rate = (known["wall_s"] / known["cif_bytes"]).median() if len(known) else 1.0
+    wall = dict(zip(telemetry["pdb_id"], telemetry["wall_s"]))
+    return [
+        float(wall.get(pdb_dir[-4:], size * rate))
+        for pdb_dir, size in zip(pdb_dirs, sizes)
+    ]
+
+
+def _two_char_code_costs(*, data_dir: Path, two_char_codes: list[str]) -> list[float]:
+    """
+    Estimate the cost of processing two character codes by the
+    size of their raw entries, a proxy for the number of systems.
+    """
+    return [
+        float(utils.get_path_size(data_dir / "raw_entries" / code))
+        for code in two_char_codes
+    ]
+
+
 def scatter_make_entries(
     *,
     data_dir: Path,
@@ -185,6 +220,7 @@ def scatter_make_entries(
     wipe_annotations: bool,
     skip_existing_entries: bool,
     skip_missing_annotations: bool,
+    balance: bool = False,
 ) -> list[list[str]]:
     """
     Distribute annotation generation by pdb id rather than
@@ -209,6 +245,8 @@ def scatter_make_entries(
         don't include pdb_dir if entry exists
     skip_missing_annotations : bool
         don't include pdb_dir even if annotation doesn't exist
+    balance : bool, default=False
+        balance chunks by CIF size (and previous telemetry) instead of count
     """
     pdb_dirs = utils.get_local_contents(
         data_dir=data_dir / "ingest",
@@ -229,6 +267,9 @@ def scatter_make_entries(
         )
     ]
     LOG.info(f"scatter_make_entries: found {len(pdb_dirs)} CIFs")
+    if balance:
+        costs = _entry_costs(data_dir=data_dir, pdb_dirs=pdb_dirs)
+        return utils.balance_chunks(pdb_dirs, costs, batch_size=batch_size)
     return [
         pdb_dirs[pos : pos + batch_size] for pos in range(0, len(pdb_dirs), batch_size)
     ]
@@ -245,15 +286,19 @@ def make_entries(
     annotation_cfg: DictConfig,
     entry_cfg: DictConfig,
     cpu: int = 1,
+    tasks_per_worker: int = 0,
+    task_timeout: float = 10800,
 ) -> list[str]:
     """
-    Offload individual plinder annotation tasks to
-    a multiprocessing queue wrapped as a subprocess.
-    This is a simple way to gracefully handle seg-faults
-    from C-extensions without impacting later entries in
-    the list of pdb_dirs. Additionally keep a record of
-    entries which failed so that they can be re-processed
-    with larger resource requests.
+    Offload individual plinder annotation tasks to a
+    pool of warm worker processes. A worker dying on an
+    entry (e.g. seg-faults from C-extensions) is respawned
+    without impacting later entries in the list of pdb_dirs.
+    Additionally keep a record of entries which failed so
+    that they can be re-processed with larger resource
+    requests, along with the wall time, CPU time, peak
+    memory and exit status of every entry in
+    reports/telemetry/make_entries_{hash}.parquet.
 
     Parameters
     ----------
@@ -275,80 +320,97 @@ def make_entries(
         from plinder.data.pipeline.config.EntryConfig
     cpu : int, default=1
         number of CPUs to use
+    tasks_per_worker : int, default=0
+        respawn annotation workers after this many entries (0 to never recycle)
+    task_timeout : float, default=10800
+        kill the annotation of an entry after this many seconds (0 for no limit)
 
     Returns
     -------
     failed : list[str]
         list of pdb directories to re-process
     """
+    from plinder.data.pipeline.mpqueue import WorkerPool
+
     input_dir = data_dir / "ingest"
     report_dir = data_dir / "reports"
     output_dir = data_dir / "raw_entries"
-    scratch_dir = data_dir / "scratch" / "raw_entries"
     LOG.info(f"making {len(pdb_dirs)} entries in {output_dir}")
     output_dir.mkdir(exist_ok=True, parents=True)
-    scratch_dir.mkdir(exist_ok=True, parents=True)
     hashed_contents = utils.hash_contents(pdb_dirs)
-    scratch_tasks = scratch_dir / f"tasks_{hashed_contents}.txt"
     check_finished = []
-    with scratch_tasks.open("w") as f:
-        for pdb_dir in pdb_dirs:
-            two_char_code = pdb_dir[-3:-1]
-            pdb_id = pdb_dir[-4:]
-            output = output_dir / two_char_code / (pdb_id + ".json")
-            if wipe_entries and output.is_file():
-                output.unlink()
-
-            pqt_df = output_dir / two_char_code / (pdb_id + ".parquet")
-            if wipe_annotations and pqt_df.is_file():
-                pqt_df.unlink()
-            output.parent.mkdir(exist_ok=True, parents=True)
-            if output.is_file():
-                if skip_existing_entries:
-                    LOG.info(f"skipping {pdb_id} since entry exist already")
-                    continue
-            #     elif not pqt_df.is_file() and skip_missing_annotations:
-            #         LOG.info(f"skipping {pdb_id} since skip_missing_annotations is set")
-            #         continue
-            check_finished.append((pdb_dir, output, pqt_df))
-            # cifs are in ingest/{two_char_code}/pdb_0000{pdb_id}/
-            # but vals are in reports/{two_char_code}/{pdb_id}/
-            # and not all cifs have vals so gracefully handle
-            [mmcif] = list((input_dir / two_char_code / pdb_dir).glob(io.CIF_GLOB))
-            try:
-                [report] = list((report_dir / two_char_code / pdb_id).glob(io.VAL_GLOB))
-            except Exception:
-                report = (
-                    report_dir / two_char_code / pdb_id / (pdb_id + io.VAL_GLOB[1:])
-                )
-            cmd = (
-                [
-                    "python",
-                    "-m",
-                    "plinder.data.get_system_annotations",
-                    f"mmcif_file={mmcif.as_posix()}",
-                    f"validation_xml={report.as_posix()}",
-                ]
-                + [f"annotation.{k}={v}" for k, v in annotation_cfg.items()]
-                + [f"entry.{k}={v}" for k, v in entry_cfg.items() if k != "save_folder"]
-                + [f"entry.save_folder={output.parent.as_posix()}"]
+    annotation_tasks = []
+    costs = []
+    for pdb_dir in pdb_dirs:
+        two_char_code = pdb_dir[-3:-1]
+        pdb_id = pdb_dir[-4:]
+        output = output_dir / two_char_code / (pdb_id + ".json")
+        if wipe_entries and output.is_file():
+            output.unlink()
+
+        pqt_df = output_dir / two_char_code / (pdb_id + ".parquet")
+        if wipe_annotations and pqt_df.is_file():
+            pqt_df.unlink()
+        output.parent.mkdir(exist_ok=True, parents=True)
+        if output.is_file():
+            if skip_existing_entries:
+                LOG.info(f"skipping {pdb_id} since entry exist already")
+                continue
+        #     elif not pqt_df.is_file() and skip_missing_annotations:
+        #         LOG.info(f"skipping {pdb_id} since skip_missing_annotations is set")
+        #         continue
+        check_finished.append((pdb_dir, output, pqt_df))
+        # cifs are in ingest/{two_char_code}/pdb_0000{pdb_id}/
+        # but vals are in reports/{two_char_code}/{pdb_id}/
+        # and not all cifs have vals so gracefully handle
+        [mmcif] = list((input_dir / two_char_code / pdb_dir).glob(io.CIF_GLOB))
+        try:
+            [report] = list((report_dir / two_char_code / pdb_id).glob(io.VAL_GLOB))
+        except Exception:
+            report = report_dir / two_char_code / pdb_id / (pdb_id + io.VAL_GLOB[1:])
+        costs.append(mmcif.stat().st_size)
+        annotation_tasks.append(
+            dict(
+                mmcif_file=mmcif,
+                validation_xml=report,
+                annotation_cfg=dict(annotation_cfg.items()),
+                entry_cfg={
+                    **{k: v for k, v in entry_cfg.items() if k != "save_folder"},
+                    "save_folder": output.parent.as_posix(),
+                },
+            )
+        )
+    # annotate in warm workers which import the annotation code once,
+    # segfaults only take down (and respawn) the worker of that entry
+    # and the largest structures are started first to avoid stragglers
+    pool = WorkerPool(
+        target="plinder.data.get_system_annotations:save_annotation",
+        num_workers=max(1, cpu - 1),
+        maxtasksperchild=tasks_per_worker,
+        timeout=task_timeout,
+    )
+    telemetry = []
+    for result in pool.run(annotation_tasks, costs=costs):
+        pdb_dir, output, _ = check_finished[result.index]
+        if result.status in ["crashed", "timeout"]:
+            LOG.error(f"make_entries: {pdb_dir} {result.status}: {result.error}")
+        telemetry.append(
+            dict(
+                pdb_id=pdb_dir[-4:],
+                status=result.status,
+                exitcode=result.exitcode,
+                error=result.error,
+                wall_s=result.wall_s,
+                cpu_s=result.cpu_s,
+                peak_rss_mb=result.peak_rss_mb,
+                entry_written=output.is_file(),
+                cif_bytes=costs[result.index],
+                cpu=cpu,
             )
-            f.write(" ".join(cmd) + "\n")
-    try:
-        check_output(
-            [
-                "python",
-                "-m",
-                "plinder.data.pipeline.mpqueue",
-                f"{scratch_tasks.as_posix()}",
-                f"--cores={max(1, cpu - 1)}",
-            ],
-            text=True,
-            timeout=10800,
         )
-        scratch_tasks.unlink()
-    except Exception:
-        LOG.error("beep boop mpqueue timed out")
+    utils.save_task_telemetry(
+        data_dir=data_dir, stage="make_entries", records=telemetry
+    )
 
     rerun = []
     for pdb_dir, output, pqt_df in check_finished:
@@ -370,6 +432,7 @@ def scatter_structure_qc(
     data_dir: Path,
     two_char_codes: list[str],
     batch_size: int,
+    balance: bool = False,
 ) -> list[list[str]]:
     """
     Scatter two character codes for system archive generation
@@ -382,6 +445,8 @@ def scatter_structure_qc(
         how many codes to put in a chunk
     two_char_codes : list[str], default=[]
         only consider particular codes
+    balance : bool, default=False
+        balance chunks by the size of their raw entries instead of count
 
     Returns
     -------
@@ -394,20 +459,74 @@ def scatter_structure_qc(
     else:
         codes = sorted(os.listdir(entry_dir.as_posix()))
     LOG.info(f"scatter_structure_qc: found {len(codes)} two character codes")
+    if balance:
+        costs = _two_char_code_costs(data_dir=data_dir, two_char_codes=codes)
+        return utils.balance_chunks(codes, costs, batch_size=batch_size)
     return [codes[pos : pos + batch_size] for pos in range(0, len(codes), batch_size)]
 
 
-def structure_qc(
-    *,
-    data_dir: Path,
-    two_char_codes: list[str],
-) -> None:
+def _structure_qc_entry(
+    entry_json: Path,
+) -> tuple[Path, Optional[str], Optional[pd.DataFrame], list[dict[str, Any]], str]:
+    """
+    Validate a single raw entry and run the structure checks of
+    its systems. Runs in structure_qc worker processes, so results
+    are returned rather than written.
+
+    Returns
+    -------
+    tuple[Path, str | None, pd.DataFrame | None, list[dict[str, Any]], str]
+        the entry_json, the validated entry as JSON, its annotation
+        table, the structure checks and the failures as CSV lines
+    """
     from plinder.data.final_structure_qc import (
         prepare_system_dict,
         run_structure_checks,
     )
     from plinder.data.utils.annotations.aggregate_annotations import Entry
 
+    try:
+        entry = Entry.from_json(entry_json, clear_non_pocket_residues=True)
+    except Exception as e:
+        LOG.warn(f"failed loading {entry_json}")
+        clean = str(e).replace(",", "_").replace("\n", " ")[:50]
+        return entry_json, None, None, [], f"{entry_json},{clean}\n"
+    entry_df = entry.to_df() if len(entry.systems) else None
+    structure_qc: list[dict[str, Any]] = []
+    fails = ""
+    try:
+        for system_dict in prepare_system_dict(entry_json.parent, entry):
+            structure_qc.extend(run_structure_checks(system_dict))
+    except Exception as e:
+        LOG.warn(f"failed structure checks for {entry_json}")
+        fails = f"{entry_json},{str(e).replace(',', '_')}\n"
+    return entry_json, entry.model_dump_json(), entry_df, structure_qc, fails
+
+
+def structure_qc(
+    *,
+    data_dir: Path,
+    two_char_codes: list[str],
+    cpu: int = 1,
+) -> None:
+    """
+    Validate the raw entries of two character codes, store them in
+    entries/{code}.zip and merge their annotations with the results
+    of the structure checks into qc/index/{code}.parquet.
+
+    Entries are validated and checked in a pool of cpu processes,
+    while the calling process is the single writer streaming their
+    results into the zip (in entry order) as they come in.
+
+    Parameters
+    ----------
+    data_dir : Path
+        the root plinder dir
+    two_char_codes : list[str]
+        the two character codes to process
+    cpu : int, default=1
+        number of processes to check entries with
+    """
     entry_dir = data_dir / "raw_entries"
     err_dir = data_dir / "qc" / "logs"
     zip_dir = data_dir / "entries"
@@ -415,48 +534,59 @@ def structure_qc(
     err_dir.mkdir(exist_ok=True, parents=True)
     zip_dir.mkdir(exist_ok=True, parents=True)
     pqt_dir.mkdir(exist_ok=True, parents=True)
-    for code in two_char_codes:
-        with ZipFile(zip_dir / f"{code}.zip", "w", compression=ZIP_DEFLATED) as archive:
-            with (err_dir / f"{code}_qc_fails.csv").open("w") as fails:
-                fails.write("entry_json,error\n")
-                LOG.info(f"structure_qc: two_char_code={code}")
-                entry_dfs = []
-                structure_qc = []
-                for i, entry_json in enumerate((entry_dir / code).glob("*json")):
-                    if not i % 25:
-                        LOG.info(f"on entry={i} {entry_json}")
-                    try:
-                        entry = Entry.from_json(
-                            entry_json, clear_non_pocket_residues=True
-                        )
-                    except Exception as e:
-                        LOG.warn(f"failed loading {entry_json}")
-                        clean = str(e).replace(",", "_").replace("\n", " ")[:50]
-                        fails.write(f"{entry_json},{clean}")
-                        continue
-                    if len(entry.systems):
-                        entry_dfs.append(entry.to_df())
-                    archive.writestr(entry_json.name, entry.model_dump_json())
-                    system_structure_path = entry_dir / code
-                    try:
-                        for system_dict in prepare_system_dict(
-                            system_structure_path,
-                            entry,
-                        ):
-                            structure_qc.extend(run_structure_checks(system_dict))
-                    except Exception as e:
-                        LOG.warn(f"failed structure checks for {entry_json}")
-                        fails.write(f"{entry_json},{str(e).replace(',', '_')}\n")
-                        continue
-                if len(entry_dfs) and len(structure_qc):
-                    entry_df = pd.concat(entry_dfs).reset_index(drop=True)
-                    structure_df = pd.DataFrame(structure_qc)
-                    pd.merge(
+    pool = None
+    if cpu > 1:
+        pool = ProcessPoolExecutor(
+            max_workers=cpu, mp_context=multiprocessing.get_context("spawn")
+        )
+    try:
+        for code in two_char_codes:
+            entry_jsons = sorted((entry_dir / code).glob("*json"))
+            if pool is None:
+                results = map(_structure_qc_entry, entry_jsons)
+            else:
+                results = pool.map(_structure_qc_entry, entry_jsons, chunksize=4)
+            with ZipFile(
+                zip_dir / f"{code}.zip", "w", compression=ZIP_DEFLATED
+            ) as archive:
+                with (err_dir / f"{code}_qc_fails.csv").open("w") as fails:
+                    fails.write("entry_json,error\n")
+                    LOG.info(
+                        f"structure_qc: two_char_code={code} entries={len(entry_jsons)}"
+                    )
+                    merged = []
+                    has_checks = False
+                    for i, (
+                        entry_json,
+                        contents,
                         entry_df,
-                        structure_df,
-                        on=["system_id", "ligand_instance", "ligand_asym_id"],
-                        how="left",
-                    ).to_parquet(pqt_dir / f"{code}.parquet", index=False)
+                        checks,
+                        errors,
+                    ) in enumerate(results):
+                        if not i % 25:
+                            LOG.info(f"on entry={i} {entry_json}")
+                        fails.write(errors)
+                        if contents is None:
+                            continue
+                        archive.writestr(entry_json.name, contents)
+                        if entry_df is None:
+                            continue
+                        if len(checks):
+                            has_checks = True
+                            entry_df = pd.merge(
+                                entry_df,
+                                pd.DataFrame(checks),
+                                on=["system_id", "ligand_instance", "ligand_asym_id"],
+                                how="left",
+                            )
+                        merged.append(entry_df)
+                    if len(merged) and has_checks:
+                        pd.concat(merged).reset_index(drop=True).to_parquet(
+                            pqt_dir / f"{code}.parquet", index=False
+                        )
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
 
 def scatter_make_system_archives(
@@ -464,6 +594,7 @@ def scatter_make_system_archives(
     data_dir: Path,
     two_char_codes: list[str],
     batch_size: int,
+    balance: bool = False,
 ) -> list[list[str]]:
     """
     Scatter two character codes for system archive generation
@@ -476,6 +607,8 @@ def scatter_make_system_archives(
         how many codes to put in a chunk
     two_char_codes : list[str], default=[]
         only consider particular codes
+    balance : bool, default=False
+        balance chunks by the size of their raw entries instead of count
 
     Returns
     -------
@@ -488,38 +621,203 @@ def scatter_make_system_archives(
     else:
         codes = sorted(os.listdir(entry_dir.as_posix()))
     LOG.info(f"scatter_make_system_archives: found {len(codes)} two character codes")
+    if balance:
+        costs = _two_char_code_costs(data_dir=data_dir, two_char_codes=codes)
+        return utils.balance_chunks(codes, costs, batch_size=batch_size)
     return [codes[pos : pos + batch_size] for pos in range(0, len(codes), batch_size)]
 
 
+# members with these suffixes are already compressed and are stored as is
+_COMPRESSED_SUFFIXES = (".gz", ".bz2", ".xz", ".zip", ".zst")
+
+
+def _deflate_member(path: Path) -> tuple[bytes, int, int]:
+    """
+    Raw deflate a file the way zipfile does for ZIP_DEFLATED members.
+
+    Parameters
+    ----------
+    path : Path
+        the file to compress
+
+    Returns
+    -------
+    tuple[bytes, int, int]
+        the deflated bytes, the CRC-32 and the size of the file
+    """
+    import zlib
+
+    data = path.read_bytes()
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return (
+        compressor.compress(data) + compressor.flush(),
+        zlib.crc32(data),
+        len(data),
+    )
+
+
+class _Deflated:
+    """
+    Stand-in for the compressor of a zipfile member whose data
+    was already deflated by _deflate_member.
+    """
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b""
+
+
+def _write_deflated(
+    zip_archive: ZipFile,
+    full_path: Path,
+    arc_name: str,
+    deflated: tuple[bytes, int, int],
+) -> None:
+    """
+    Write a member deflated by _deflate_member into a zip archive.
+
+    Parameters
+    ----------
+    zip_archive : ZipFile
+        the archive opened for writing
+    full_path : Path
+        the file the member was read from
+    arc_name : str
+        the name of the member in the archive
+    deflated : tuple[bytes, int, int]
+        the output of _deflate_member for full_path
+    """
+    data, crc, file_size = deflated
+    info = ZipInfo.from_file(full_path, arc_name)
+    info.compress_type = ZIP_DEFLATED
+    # zipfile decides on zip64 headers from the size of the file
+    info.file_size = file_size
+    with zip_archive.open(info, "w") as member:
+        member._compressor = _Deflated()  # type: ignore[attr-defined]
+        member.write(data)
+        # the header takes the CRC and size of the uncompressed file
+        member._crc = crc  # type: ignore[attr-defined]
+        member._file_size = file_size  # type: ignore[attr-defined]
+
+
+def _make_system_archive(
+    entry_dir: Path,
+    archive: Path,
+    pool: Optional[ProcessPoolExecutor] = None,
+) -> Path:
+    """
+    Write the system files of a two character code into a zip archive
+    and the offsets of the members of every system into an index
+    sidecar next to it.
+
+    Parameters
+    ----------
+    entry_dir : Path
+        the raw_entries directory of the two character code
+    archive : Path
+        the zip archive to write
+    pool : ProcessPoolExecutor, default=None
+        processes deflating the members, the archive itself is
+        written by the calling process
+
+    Returns
+    -------
+    Path
+        the index sidecar
+    """
+    paths = []
+    for subdir in sorted(os.listdir(entry_dir)):
+        if not (entry_dir / subdir).is_dir():
+            continue
+        for root, _, files in os.walk(entry_dir / subdir):
+            paths.extend(Path(root) / file for file in sorted(files))
+    to_deflate = [path for path in paths if path.suffix not in _COMPRESSED_SUFFIXES]
+    if pool is not None:
+        # system files are small, batch them to the workers
+        deflated = pool.map(_deflate_member, to_deflate, chunksize=16)
+    else:
+        deflated = map(_deflate_member, to_deflate)
+    with ZipFile(archive.as_posix(), "w", compression=ZIP_DEFLATED) as zip_archive:
+        for full_path in paths:
+            arc_name = full_path.relative_to(entry_dir).as_posix()
+            if full_path.suffix in _COMPRESSED_SUFFIXES:
+                zip_archive.write(full_path, arc_name, ZIP_STORED)
+            else:
+                _write_deflated(zip_archive, full_path, arc_name, next(deflated))
+        members = zip_archive.infolist()
+    index = archive.with_suffix(".index.parquet")
+    pd.DataFrame(
+        {
+            "system_id": [member.filename.split("/")[0] for member in members],
+            "member": [member.filename for member in members],
+            "header_offset": [member.header_offset for member in members],
+            "compress_size": [member.compress_size for member in members],
+            "file_size": [member.file_size for member in members],
+            "compress_type": [member.compress_type for member in members],
+        },
+        columns=[
+            "system_id",
+            "member",
+            "header_offset",
+            "compress_size",
+            "file_size",
+            "compress_type",
+        ],
+    ).to_parquet(index, index=False)
+    return index
+
+
 def make_system_archives(
     *,
     data_dir: Path,
     two_char_codes: list[str],
+    cpu: int = 1,
 ) -> None:
     """
     Create a zip file of all the system files in a given
     two character code to reduce pressure on the network
     for large-scale file IO.
+
+    Files that are already compressed (e.g. .gz) are stored rather
+    than deflated again, and every archives/{code}.zip gets an
+    archives/{code}.index.parquet sidecar mapping system_id to the
+    offsets and sizes of its members for random access.
+
+    Parameters
+    ----------
+    data_dir : Path
+        the root plinder dir
+    two_char_codes : list[str]
+        the two character codes to archive
+    cpu : int, default=1
+        number of processes deflating the members of the archives,
+        shared by all the two character codes of the chunk
     """
-    for code in two_char_codes:
-        entry_dir = data_dir / "raw_entries" / code
-        archive = data_dir / "archives" / f"{code}.zip"
-        archive.parent.mkdir(exist_ok=True, parents=True)
-        with ZipFile(archive.as_posix(), "w", compression=ZIP_DEFLATED) as zip_archive:
-            for subdir in os.listdir(entry_dir):
-                if os.path.isdir(f"{entry_dir}/{subdir}"):
-                    for root, _, files in os.walk(f"{entry_dir}/{subdir}"):
-                        for file in files:
-                            full_path = os.path.join(root, file)
-                            parts = full_path.split(os.sep)
-                            arc_name = os.path.join(*parts[parts.index(code) + 1 :])
-                            zip_archive.write(full_path, arc_name)
+    archive_dir = data_dir / "archives"
+    archive_dir.mkdir(exist_ok=True, parents=True)
+    entry_dirs = [data_dir / "raw_entries" / code for code in two_char_codes]
+    archives = [archive_dir / f"{code}.zip" for code in two_char_codes]
+    if cpu > 1:
+        with ProcessPoolExecutor(
+            max_workers=cpu,
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as pool:
+            indices = [
+                _make_system_archive(entry_dir, archive, pool)
+                for entry_dir, archive in zip(entry_dirs, archives)
+            ]
+    else:
+        indices = list(map(_make_system_archive, entry_dirs, archives))
+    LOG.info(f"make_system_archives: wrote {len(indices)} archives")
 
 
 def make_sub_dbs(
     *,
     data_dir: Path,
     sub_databases: list[str],
+    create_index: bool = False,
 ) -> None:
     """
     Get the list of all pdb IDs to load all the entries
@@ -532,13 +830,17 @@ def make_sub_dbs(
     ----------
     data_dir : Path
         the root plinder dir
+    sub_databases : list[str]
+        the search databases to create
+    create_index : bool, default=False
+        pre-compute the search index of every sub-database
     """
     entries = utils.load_entries_from_zips(data_dir=data_dir)
     db_dir = data_dir / "dbs" / "subdbs"
     db_dir.mkdir(exist_ok=True)
     LOG.info("making sub-databases for scoring")
     db_sources = utils.get_db_sources(data_dir=data_dir, sub_databases=sub_databases)
-    databases.make_sub_dbs(db_dir, db_sources, entries)
+    databases.make_sub_dbs(db_dir, db_sources, entries, create_index=create_index)
 
 
 def scatter_make_ligands(
@@ -586,8 +888,24 @@ def make_ligands(
     *,
     data_dir: Path,
     pdb_ids: list[str],
+    cpu: int = 1,
+    cache_dir: str = "",
 ) -> None:
-    """ """
+    """
+    Save the ligands of a chunk of pdb IDs to ligands/{hash}.parquet
+
+    Parameters
+    ----------
+    data_dir : Path
+        the root plinder dir
+    pdb_ids : list[str]
+        the pdb IDs of the chunk
+    cpu : int, default=1
+        number of processes computing the inchikeys
+    cache_dir : str, default=""
+        persistent ligand cache, relative to data_dir unless absolute,
+        empty to disable
+    """
     entries = utils.load_entries_from_zips(data_dir=data_dir, pdb_ids=pdb_ids)
     hashed_contents = utils.hash_contents(pdb_ids)
     output_dir = data_dir / "ligands"
@@ -597,6 +915,8 @@ def make_ligands(
     utils.save_ligand_batch(
         entries=entries,
         output_path=output_path,
+        cpu=cpu,
+        cache_dir=data_dir / cache_dir if cache_dir else None,
     )
 
 
@@ -606,17 +926,42 @@ def compute_ligand_fingerprints(
     split_char: str = "__",
     radius: int = 2,
     nbits: int = 1024,
+    cpu: int = 1,
+    cache_dir: str = "",
 ) -> None:
-    """ """
+    """
+    Compute the fingerprints of the unique ligands, reusing the
+    fingerprints and inchikeys of the persistent ligand cache
+
+    Parameters
+    ----------
+    data_dir : Path
+        the root plinder dir
+    split_char : str, default="__"
+        separator of the aggregated ligand ids of a system
+    radius : int, default=2
+        ECFP radius
+    nbits : int, default=1024
+        ECFP number of bits
+    cpu : int, default=1
+        number of processes computing the fingerprints
+    cache_dir : str, default=""
+        persistent ligand cache, relative to data_dir unless absolute,
+        empty to disable
+    """
+    from plinder.data.utils import tanimoto
+
     LOG.info("compute_ligand_fingerprints: running")
     #  data_dir / "fingerprints" / ligands_per_system.parquet
     #  data_dir / "fingerprints"  / ligands_per_inchikey.parquet
-    #  data_dir / "fingerprints" /ligands_per_inchikey_ecfp4.npy
+    #  data_dir / "fingerprints" / ligands_per_inchikey_ecfp4.fp
     tanimoto.compute_ligand_fingerprints(
         data_dir=data_dir,
         split_char=split_char,
         radius=radius,
         nbits=nbits,
+        cpu=cpu,
+        cache_dir=data_dir / cache_dir if cache_dir else None,
     )
 
 
@@ -644,7 +989,10 @@ def make_ligand_scores(
     save_top_k_similar_ligands: int = 5000,
     multiply_by: int = 100,
     number_id_col: str = "number_id_by_inchikeys",
+    cpu: int = 1,
 ) -> None:
+    from plinder.data.utils import tanimoto
+
     hashid = utils.hash_contents([str(i) for i in ligand_ids])
     output_path = data_dir / "ligand_scores" / f"{hashid}.parquet"
     output_path.parent.mkdir(exist_ok=True, parents=True)
@@ -655,6 +1003,7 @@ def make_ligand_scores(
         number_id_col=number_id_col,
         save_top_k_similar_ligands=save_top_k_similar_ligands,
         multiply_by=multiply_by,
+        threads=cpu,
     )
 
 
@@ -716,6 +1065,7 @@ def scatter_run_batch_searches(
     batch_size: int,
     two_char_codes: list[str],
     pdb_ids: list[str],
+    balance: bool = False,
 ) -> list[list[str]]:
     """
     Split all the PDB IDs in the dataset
@@ -731,6 +1081,8 @@ def scatter_run_batch_searches(
         only consider particular codes
     pdb_ids : list[str], default=[]
         only consider particular pdb IDs
+    balance : bool, default=False
+        balance chunks by the size of their raw entries instead of count
 
     Returns
     -------
@@ -757,6 +1109,16 @@ def scatter_run_batch_searches(
     #     )
     # ]
     LOG.info(f"scatter_make_scorers: found {len(pdb_ids)} pdb IDs")
+    if balance:
+        costs = [
+            float(
+                utils.get_path_size(
+                    data_dir / "raw_entries" / pdb_id[-3:-1] / f"{pdb_id}.json"
+                )
+            )
+            for pdb_id in pdb_ids
+        ]
+        return utils.balance_chunks(pdb_ids, costs, batch_size=batch_size)
     return [
         pdb_ids[pos : pos + batch_size] for pos in range(0, len(pdb_ids), batch_size)
     ]
@@ -765,10 +1127,16 @@ def scatter_run_batch_searches(
 def run_batch_searches(
     *,
     data_dir: Path,
-    # TODO: : use large batches for run_batch_searches
     pdb_ids: list[str],
     scorer_cfg: DictConfig,
 ) -> None:
+    """
+    Search the pdb IDs of a batch against all the sub-databases. The
+    query sub-databases are created once per alignment type and, with
+    scorer.preload_target_dbs, the target indices are kept in memory,
+    so that large batches (scatter.run_batch_searches_batch_size)
+    amortize the cost of loading the target databases.
+    """
     scorer, entry_ids, batch_db_dir = utils.get_scorer(
         data_dir=data_dir,
         pdb_ids=pdb_ids,
@@ -777,14 +1145,13 @@ def run_batch_searches(
     )
     # TODO: convert get_similarity_scores.run_alignment to
     #       accept FoldseekConfig / MMSeqsConfig
-    for search_db in scorer_cfg.sub_databases:
-        LOG.info(f"make_scorers: run_alignments for {search_db}")
-        scorer.run_alignments(
-            entry_ids=entry_ids,
-            output_folder=batch_db_dir,
-            overwrite=True,
-            search_db=search_db,
-        )
+    LOG.info(f"run_batch_searches: searching {scorer_cfg.sub_databases}")
+    scorer.run_batch_alignments(
+        entry_ids=entry_ids,
+        search_dbs=list(scorer_cfg.sub_databases),
+        output_folder=batch_db_dir,
+        preload_target_dbs=scorer_cfg.preload_target_dbs,
+    )
     rmtree(batch_db_dir)
 
 
@@ -793,6 +1160,7 @@ def make_batch_scores(
     data_dir: Path,
     pdb_ids: list[str],
     scorer_cfg: DictConfig,
+    cpu: int = 1,
 ) -> None:
     scorer, entry_ids, batch_db_dir = utils.get_scorer(
         data_dir=data_dir,
@@ -800,47 +1168,214 @@ def make_batch_scores(
         scorer_cfg=scorer_cfg,
         load_entries=False,
     )
-    for search_db in scorer_cfg.sub_databases:
-        LOG.info("make_batch_scores: aggregating batch scores")
-        scorer.aggregate_batch_scores(
-            data_dir=data_dir,
-            batch_id=batch_db_dir.stem,
-            pdb_ids=entry_ids,
-            search_db=search_db,
-            overwrite=True,
+    # one pool per batch so that the entry caches of the workers are
+    # reused across search_dbs
+    with scorer.score_workers(min(cpu, len(entry_ids))) as pool:
+        for search_db in scorer_cfg.sub_databases:
+            LOG.info("make_batch_scores: aggregating batch scores")
+            scorer.aggregate_batch_scores(
+                data_dir=data_dir,
+                batch_id=batch_db_dir.stem,
+                pdb_ids=entry_ids,
+                search_db=search_db,
+                overwrite=True,
+                pool=pool,
+            )
+
+
+def _collated_manifest(batch_files: list[Path]) -> dict[str, list[int]]:
+    manifest = {}
+    for batch_file in batch_files:
+        stat = batch_file.stat()
+        manifest[batch_file.name] = [stat.st_size, stat.st_mtime_ns]
+    return manifest
+
+
+def _finish_compaction(partition: Path) -> None:
+    """
+    Complete a compaction of a partition interrupted by a crash using
+    its journal: if the compacted file was moved in place, remove the
+    sources it already contains, otherwise keep the sources.
+    """
+    journal = partition / "_compaction.json"
+    if not journal.is_file():
+        return
+    pending = json.loads(journal.read_text())
+    if (partition / pending["compacted"]).is_file():
+        LOG.info(f"compact_partitions: finishing compaction of {partition}")
+        for name in pending["parts"]:
+            (partition / name).unlink(missing_ok=True)
+    (partition / ".compacted.parquet.tmp").unlink(missing_ok=True)
+    journal.unlink()
+
+
+def compact_partitions(
+    con: Any, *, partition_dir: Path, min_files: int, row_group_size: int
+) -> None:
+    """
+    Rewrite every partition (e.g. metric=...) of a collated dataset
+    holding at least min_files parquet files into a single file.
+
+    The compacted file and its sources are recorded in a journal
+    (_compaction.json) before the compacted file is moved in place,
+    so that an interrupted compaction is finished by the next run
+    instead of collating the sources twice.
+
+    Parameters
+    ----------
+    con : duckdb.DuckDBPyConnection
+        the connection to run the compaction with
+    partition_dir : Path
+        the collated directory of a search_db
+    min_files : int
+        only compact partitions with at least this many files
+    row_group_size : int
+        parquet row group size of the compacted files
+    """
+    for partition in sorted(partition_dir.glob("*=*")):
+        _finish_compaction(partition)
+        parts = sorted(partition.glob("*.parquet"))
+        if len(parts) < max(min_files, 2):
+            continue
+        LOG.info(f"compact_partitions: compacting {len(parts)} files in {partition}")
+        tmp = partition / ".compacted.parquet.tmp"
+        files = [part.as_posix() for part in parts]
+        # the partition column lives in the directory name, not in the files
+        con.execute(
+            f"COPY (SELECT * FROM read_parquet({files}, hive_partitioning = false)) "
+            f"TO '{tmp}' (FORMAT PARQUET, ROW_GROUP_SIZE {row_group_size})"
+        )
+        compacted = f"compacted_{utils.hash_contents([p.name for p in parts])}.parquet"
+        journal = partition / "_compaction.json"
+        journal.write_text(
+            json.dumps({"compacted": compacted, "parts": [p.name for p in parts]})
         )
+        tmp.rename(partition / compacted)
+        for part in parts:
+            part.unlink()
+        journal.unlink()
 
 
-def collate_partitions(*, data_dir: Path, row_group_size: int = 500_000) -> None:
+def collate_partitions(
+    *,
+    data_dir: Path,
+    dst_dir: str = "collated_scores",
+    incremental: bool = True,
+    memory_limit: str = "",
+    threads: int = 0,
+    row_group_size: int = 500_000,
+    compact_min_files: int = 0,
+) -> None:
     """
-    Collate the batch results from make_batch_scores into a partitioned
-    sorted dataset using duckdb.
+    Collate the batch results from make_batch_scores into a dataset
+    partitioned by metric using duckdb. Only the long score layout
+    is collated, scores_wide keeps one file per batch.
+
+    A manifest of the collated batch files is kept next to the
+    collated files of every search_db, so that only new batch files
+    are appended when running again. If a batch file that was
+    already collated changed or vanished, the search_db is rebuilt.
 
     Parameters
     ----------
     data_dir : Path
         plinder root dir
-    partitions : Path
-        root directory of batch partitions
+    dst_dir : str, default="collated_scores"
+        destination of the collated dataset, relative to data_dir
+        unless absolute
+    incremental : bool, default=True
+        if False, always rebuild the collated dataset
+    memory_limit : str, default=""
+        duckdb memory limit, e.g. "16GB"
+    threads : int, default=0
+        duckdb threads, 0 for duckdb's default
+    row_group_size : int, default=500_000
+        parquet row group size of the collated files
+    compact_min_files : int, default=0
+        compact partitions with at least this many files in a
+        background thread while the next search_db is collated,
+        0 to disable
     """
     import duckdb
 
     score_dir = data_dir / "scores"
-    for search_db in ["holo", "apo", "pred"]:
-        LOG.info(f"collate_partitions: collating search_db={search_db}")
-        dst_dir = Path("/plinder/2024-06/duckdb/search_db={search_db}/")
-        dst_dir.mkdir(exist_ok=True, parents=True)
-        duckdb.sql(
-            dedent(
-                f"""
-                    COPY
-                        (select * from '{score_dir}/search_db={search_db}/*.parquet')
-                    TO
-                        '{dst_dir}/*.parquet'
-                    (FORMAT PARQUET, ROW_GROUP_SIZE {row_group_size}, PARTITION_BY (metric))
-                """
+    dst_root = data_dir / dst_dir
+    dst_root.mkdir(exist_ok=True, parents=True)
+    # spill outside of dst_root, which is a fingerprinted output of the stage
+    config = {"temp_directory": (data_dir / "tmp" / "collate").as_posix()}
+    if memory_limit:
+        config["memory_limit"] = memory_limit
+    if threads:
+        config["threads"] = str(threads)
+    con = duckdb.connect(config=config)
+    compactions = []
+    compactor = ThreadPoolExecutor(max_workers=1)
+    try:
+        for search_db in ["holo", "apo", "pred"]:
+            batch_files = sorted(
+                (score_dir / f"search_db={search_db}").glob("*.parquet")
             )
-        )
+            if not len(batch_files):
+                LOG.info(f"collate_partitions: no batch scores for {search_db}")
+                continue
+            partition_dir = dst_root / f"search_db={search_db}"
+            for partition in partition_dir.glob("*=*"):
+                _finish_compaction(partition)
+            manifest_file = partition_dir / "_collated.json"
+            current = _collated_manifest(batch_files)
+            collated = {}
+            if incremental and manifest_file.is_file():
+                collated = json.loads(manifest_file.read_text())
+            if any(current.get(name) != stat for name, stat in collated.items()):
+                LOG.info(f"collate_partitions: rebuilding search_db={search_db}")
+                collated = {}
+            if not len(collated) and partition_dir.is_dir():
+                rmtree(partition_dir)
+            new_files = [
+                batch_file.as_posix()
+                for batch_file in batch_files
+                if batch_file.name not in collated
+            ]
+            LOG.info(
+                f"collate_partitions: collating {len(new_files)} new batch files "
+                f"of search_db={search_db}"
+            )
+            if len(new_files):
+                partition_dir.mkdir(exist_ok=True, parents=True)
+                pattern = f"{utils.hash_contents(new_files)}_{{i}}"
+                con.execute(
+                    dedent(
+                        f"""
+                            COPY
+                                (SELECT * FROM read_parquet({new_files}))
+                            TO
+                                '{partition_dir}'
+                            (
+                                FORMAT PARQUET,
+                                ROW_GROUP_SIZE {row_group_size},
+                                PARTITION_BY (metric),
+                                OVERWRITE_OR_IGNORE,
+                                FILENAME_PATTERN '{pattern}'
+                            )
+                        """
+                    )
+                )
+                manifest_file.write_text(json.dumps(current))
+            if compact_min_files:
+                compactions.append(
+                    compactor.submit(
+                        compact_partitions,
+                        con.cursor(),
+                        partition_dir=partition_dir,
+                        min_files=compact_min_files,
+                        row_group_size=row_group_size,
+                    )
+                )
+        for compaction in compactions:
+            compaction.result()
+    finally:
+        compactor.shutdown()
+        con.close()
 
 
 def scatter_make_components_and_communities(
@@ -859,6 +1394,8 @@ def make_components_and_communities(
     metric_threshold: list[tuple[str, int]],
     skip_existing_clusters: bool,
 ) -> None:
+    from plinder.data import clusters
+
     [(metric, threshold)] = metric_threshold
     clusters.make_components_and_communities(
         data_dir=data_dir,
@@ -910,6 +1447,8 @@ def scatter_make_splits(
     data_dir: Path,
     split_config_dir: str,
 ) -> list[list[tuple[DictConfig, str]]]:
+    from plinder.data import splits
+
     # defaults to empty string so skip it
     configs: list[list[tuple[DictConfig, str]]]
     if not len(split_config_dir):
@@ -960,6 +1499,8 @@ def make_splits(
     data_dir: Path,
     cfg_and_path: list[tuple[DictConfig, str]],
 ) -> None:
+    from plinder.data import splits
+
     [(cfg, path)] = cfg_and_path
     splits.split(data_dir=data_dir, cfg=cfg, relpath=path)
 
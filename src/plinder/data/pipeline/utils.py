@@ -2,21 +2,23 @@
 # Distributed under the terms of the Apache License 2.0
 from __future__ import annotations
 
+import heapq
 from functools import wraps
 from hashlib import md5
 from json import dumps
+from math import ceil
 from os import listdir
 from pathlib import Path
-from time import time
-from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, TypeVar
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, Optional, TypeVar
+from uuid import uuid4
 from zipfile import ZipFile
 
 import pandas as pd
 from omegaconf import DictConfig
 
-from plinder.core.utils import schemas
+from plinder.core.utils import profiling, schemas
+from plinder.core.utils.dec import timeit
 from plinder.core.utils.log import setup_logger
-from plinder.data.utils import tanimoto
 
 if TYPE_CHECKING:
     from plinder.data.utils.annotations.aggregate_annotations import Entry
@@ -27,30 +29,6 @@ LOG = setup_logger(__name__)
 T = TypeVar("T")
 
 
-def timeit(func: Callable[..., T]) -> Callable[..., T]:
-    """
-    Simple function timer decorator
-    """
-
-    @wraps(func)
-    def wrapped(*args: Any, **kwargs: Any) -> Any:
-        name = func.__name__
-        mod = func.__module__
-        log = setup_logger(".".join([mod, name]))
-        ts = time()
-        result = None
-        try:
-            result = func(*args, **kwargs)
-            log.info(f"runtime succeeded: {time() - ts:>9.2f}s")
-        except Exception as e:
-            log.error(f"runtime failed: {time() - ts:>9.2f}s")
-            log.error(f"{name} failed with: {repr(e)}")
-            raise
-        return result
-
-    return wrapped
-
-
 def entry_exists(
     *,
     entry_dir: Path,
@@ -189,7 +167,10 @@ def get_scorer(
     scorer_cfg: DictConfig,
     load_entries: bool,
 ) -> tuple["Scorer", list[str], Path]:
-    from plinder.data.utils.annotations.get_similarity_scores import Scorer
+    from plinder.data.utils.annotations.get_similarity_scores import (
+        EntryCache,
+        Scorer,
+    )
 
     # need holo to db to compare against independently of what to score
     sub_dbs = list(set(scorer_cfg.sub_databases).union(["holo"]))
@@ -220,7 +201,11 @@ def get_scorer(
         source_to_full_db_file=db_sources,
         db_dir=sub_db_dir,
         scores_dir=scores_dir,
+        wide_scores_dir=data_dir / "scores_wide"
+        if scorer_cfg.write_wide_scores
+        else None,
         minimum_threshold=scorer_cfg.minimum_threshold,
+        entry_cache=EntryCache(maxsize=scorer_cfg.entry_cache_size),
     ), entry_ids, batch_db_dir
 
 
@@ -228,14 +213,21 @@ def save_ligand_batch(
     *,
     entries: dict[str, "Entry"],
     output_path: Path,
+    cpu: int = 1,
+    cache_dir: Optional[Path] = None,
 ) -> None:
+    from plinder.data.utils import tanimoto
+
     dfs = []
     for entry in entries.values():
-        df = tanimoto.load_ligands_from_entry(entry=entry)
+        df = tanimoto.load_ligands_from_entry(entry=entry, compute_inchikeys=False)
         if df is not None:
             dfs.append(df)
     LOG.info(f"save_ligand_batch: {len(dfs)} entries have usable ligands")
     df = pd.concat(dfs).drop_duplicates().reset_index(drop=True)
+    smiles = df["ligand_rdkit_canonical_smiles"]
+    inchikeys = tanimoto.get_inchikeys(smiles, cpu=cpu, cache_dir=cache_dir)
+    df["inchikeys"] = smiles.map(inchikeys)
     for col in df.columns:
         nunique = df[col].nunique()
         LOG.info(f"save_ligand_batch: unique {col}={nunique}")
@@ -260,6 +252,134 @@ def hash_contents(contents: list[str]) -> str:
     return md5(dumps(sorted(contents)).encode("utf8")).hexdigest()
 
 
+def get_path_size(path: Path) -> int:
+    """
+    Get the size of a file, or of all files in a directory,
+    used as a cheap cost proxy when scattering.
+
+    Parameters
+    ----------
+    path : Path
+        file or directory
+
+    Returns
+    -------
+    int
+        the size in bytes, 0 if path does not exist
+    """
+    if path.is_file():
+        return path.stat().st_size
+    if path.is_dir():
+        return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+    return 0
+
+
+def balance_chunks(
+    items: list[T],
+    costs: list[float],
+    *,
+    batch_size: int,
+) -> list[list[T]]:
+    """
+    Split items into as many chunks as fixed-size batching with
+    batch_size would, but balance the chunks by cost instead of
+    count, targeting sum(costs) / n_chunks per chunk. Items are
+    assigned most expensive first to the cheapest chunk so far
+    (ties broken by item count), and keep their original order
+    within a chunk.
+
+    Parameters
+    ----------
+    items : list[T]
+        the items to chunk
+    costs : list[float]
+        cost estimate of every item
+    batch_size : int
+        the number of items per chunk of fixed-size batching
+
+    Returns
+    -------
+    chunks : list[list[T]]
+        the balanced chunks
+    """
+    if len(items) != len(costs):
+        raise ValueError(f"got {len(items)} items but {len(costs)} costs")
+    if not len(items):
+        return []
+    n_chunks = ceil(len(items) / max(batch_size, 1))
+    heap = [(0.0, 0, i) for i in range(n_chunks)]
+    members: list[list[int]] = [[] for _ in range(n_chunks)]
+    for pos in sorted(range(len(items)), key=lambda pos: -costs[pos]):
+        load, count, i = heapq.heappop(heap)
+        members[i].append(pos)
+        heapq.heappush(heap, (load + costs[pos], count + 1, i))
+    return [[items[pos] for pos in sorted(chunk)] for chunk in members]
+
+
+def save_task_telemetry(
+    *,
+    data_dir: Path,
+    stage: str,
+    records: list[dict[str, Any]],
+) -> Optional[Path]:
+    """
+    Save per-task resource usage (wall and CPU time, peak RSS,
+    exit status) of a chunk of a stage to
+    reports/telemetry/{stage}_{hash}.parquet, keyed by pdb_id.
+
+    Parameters
+    ----------
+    data_dir : Path
+        the root plinder dir
+    stage : str
+        the name of the stage
+    records : list[dict[str, Any]]
+        one record per task, must contain pdb_id
+
+    Returns
+    -------
+    Path | None
+        the written parquet or None if there were no records
+    """
+    if not len(records):
+        return None
+    df = pd.DataFrame(records)
+    df["timestamp"] = pd.Timestamp.now(tz="UTC")
+    output_dir = data_dir / "reports" / "telemetry"
+    output_dir.mkdir(exist_ok=True, parents=True)
+    output = output_dir / f"{stage}_{hash_contents(df['pdb_id'].tolist())}.parquet"
+    df.to_parquet(output, index=False)
+    return output
+
+
+def load_task_telemetry(*, data_dir: Path, stage: str) -> pd.DataFrame:
+    """
+    Load the per-task telemetry of a stage, keeping the
+    most recent record of every pdb_id.
+
+    Parameters
+    ----------
+    data_dir : Path
+        the root plinder dir
+    stage : str
+        the name of the stage
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per pdb_id, empty if no telemetry was recorded
+    """
+    files = sorted((data_dir / "reports" / "telemetry").glob(f"{stage}_*.parquet"))
+    if not len(files):
+        return pd.DataFrame()
+    df = pd.concat([pd.read_parquet(file) for file in files], ignore_index=True)
+    return (
+        df.sort_values("timestamp")
+        .drop_duplicates("pdb_id", keep="last")
+        .reset_index(drop=True)
+    )
+
+
 def get_local_contents(
     *,
     data_dir: Path,
@@ -314,6 +434,9 @@ def partition_batch_scores(*, partition_dir: Path, scores_dir: Path) -> None:
     and metric value. This partitioned dataset needs to be further
     consolidated in a join step elsewhere.
 
+    The fragments are streamed record batch by record batch, so
+    memory does not grow with the number of fragments.
+
     Parameters
     ----------
     partition_dir : Path
@@ -321,21 +444,33 @@ def partition_batch_scores(*, partition_dir: Path, scores_dir: Path) -> None:
     scores_dir : Path
         source directory for fragmented scores
     """
-    # collect the fragmented parquets
-    dfs = []
-    for pqt in scores_dir.glob("*.parquet"):
-        df = pd.read_parquet(pqt)
-        if not df.empty:
-            dfs.append(df)
-    if len(dfs):
-        df = pd.concat(dfs).reset_index(drop=True)
-        df.to_parquet(
-            partition_dir,
-            partition_cols=["metric", "similarity"],
-            index=False,
-            max_partitions=3939,
-            schema=schemas.PROTEIN_SIMILARITY_SCHEMA,
-        )
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    schema = schemas.PROTEIN_SIMILARITY_SCHEMA
+    fragments = sorted(scores_dir.glob("*.parquet"))
+    if not len(fragments):
+        return
+
+    def batches() -> Iterator[pa.RecordBatch]:
+        for fragment in fragments:
+            for batch in pq.ParquetFile(fragment).iter_batches():
+                if batch.num_rows:
+                    table = pa.Table.from_batches([batch]).select(schema.names)
+                    yield from table.cast(schema).to_batches()
+
+    ds.write_dataset(
+        batches(),
+        partition_dir,
+        schema=schema,
+        format="parquet",
+        partitioning=["metric", "similarity"],
+        partitioning_flavor="hive",
+        max_partitions=3939,
+        basename_template=f"{uuid4().hex}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
 
 
 def should_run_stage(stage: str, run: list[str], skip: list[str]) -> bool:
@@ -369,6 +504,31 @@ def should_run_stage(stage: str, run: list[str], skip: list[str]) -> bool:
     return True
 
 
+def stage_is_selected(pipe: Any, stage: str) -> bool:
+    """
+    Check the ingest.run_specific_stages and ingest.skip_specific_stages
+    of a pipeline for a stage. The single place deciding whether a stage
+    runs, both for its decorated methods and for IngestPipeline.run_stage.
+
+    Parameters
+    ----------
+    pipe : IngestPipeline
+        the pipeline
+    stage : str
+        the name of the stage
+
+    Returns
+    -------
+    bool
+        whether or not to run the stage
+    """
+    return should_run_stage(
+        stage,
+        pipe.cfg.ingest.run_specific_stages,
+        pipe.cfg.ingest.skip_specific_stages,
+    )
+
+
 def ingest_flow_control(func: Callable[..., T]) -> Callable[..., T]:
     """
     Function decorator to apply for every stage
@@ -386,11 +546,7 @@ def ingest_flow_control(func: Callable[..., T]) -> Callable[..., T]:
         elif func.__name__.startswith("join_"):
             is_join = True
             name = func.__name__.replace("join_", "", 1)
-        if should_run_stage(
-            name,
-            pipe.cfg.ingest.run_specific_stages,
-            pipe.cfg.ingest.skip_specific_stages,
-        ):
+        if stage_is_selected(pipe, name):
             chunks = None
             if len(args) and args[0] is not None:
                 chunks = len(args[0])
@@ -404,7 +560,11 @@ def ingest_flow_control(func: Callable[..., T]) -> Callable[..., T]:
                 msg += f" {chunks} parts"
             if not is_scatter:
                 LOG.info(msg)
-            ret = func(pipe, *args, **kwargs)
+            kind = "join" if is_join else "scatter" if is_scatter else "compute"
+            with profiling.span(func.__name__, stage=name, kind=kind) as span:
+                if chunks is not None:
+                    span.add(items=chunks)
+                ret = func(pipe, *args, **kwargs)
             if is_scatter and ret is not None:
                 LOG.info(f"{msg} {len(ret)} chunks")  # type: ignore
             return ret
@@ -415,38 +575,130 @@ def ingest_flow_control(func: Callable[..., T]) -> Callable[..., T]:
     return inner
 
 
+def _trainable_filter() -> Any:
+    import pyarrow.dataset as ds
+
+    return (
+        ~(
+            ds.field("ligand_is_invalid")
+            | ds.field("ligand_is_artifact")
+            | ds.field("ligand_is_ion")
+        )
+        & ds.field("ligand_passes_valence_checks")
+        & ds.field("ligand_sanitization")
+        & ds.field("ligand_passes_kekulization")
+        & ds.field("ligand_mol_pred_loaded")
+        & (ds.field("system_num_ligand_chains") == 1)
+        & ds.field("ligand_rdkit_canonical_smiles").is_valid()
+    )
+
+
+def _uniqueness(table: Any) -> Any:
+    import pyarrow.compute as pc
+
+    return pc.binary_join_element_wise(
+        table["system_id_no_biounit"],
+        table["pli_qcov__100__strong__component"],
+        "_",
+    )
+
+
+def _concat_parquets(paths: list[Path], dst: Path) -> None:
+    """
+    Stream parquet files into a single parquet file, unifying their
+    schemas the way pd.concat would (missing columns become null,
+    numeric types are promoted).
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.unify_schemas(
+        [pq.read_schema(path).remove_metadata() for path in paths],
+        promote_options="permissive",
+    )
+    with pq.ParquetWriter(dst, schema) as writer:
+        for path in paths:
+            for batch in pq.ParquetFile(path).iter_batches():
+                columns = [
+                    batch.column(field.name).cast(field.type)
+                    if field.name in batch.schema.names
+                    else pa.nulls(batch.num_rows, field.type)
+                    for field in schema
+                ]
+                writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+
+
 def create_nonredundant_dataset(*, data_dir: Path) -> None:
     """
     This is called in make_mmp_index to ensure the existence of the index
     and simultaneously generates a non-redundant index for various use
     cases. Ultimately this should run as the join step of structure_qc.
+
+    Both tables are built by streaming record batches, only the keys of
+    the trainable systems and the non-redundant subset are held in memory.
     """
-    if not (data_dir / "index" / "annotation_table.parquet").exists():
-        dfs = []
-        for path in (data_dir / "qc" / "index").glob("*"):
-            dfs.append(pd.read_parquet(path))
-        df = pd.concat(dfs).reset_index(drop=True)
-        df.to_parquet(data_dir / "index" / "annotation_table.parquet", index=False)
-    else:
-        df = pd.read_parquet(data_dir / "index" / "annotation_table.parquet")
-    df_trainable = df[
-        ~(df.ligand_is_invalid | df.ligand_is_artifact | df.ligand_is_ion)
-        & (df.ligand_passes_valence_checks)
-        & (df.ligand_sanitization)
-        & (df.ligand_passes_kekulization)
-        & (df.ligand_mol_pred_loaded)
-        & (df.system_num_ligand_chains == 1)
-        & (df.ligand_rdkit_canonical_smiles.notna())
-    ].reset_index(drop=True)
-
-    df_trainable["uniqueness"] = (
-        df_trainable["system_id_no_biounit"]
-        + "_"
-        + df_trainable["pli_qcov__100__strong__component"]
-    )
-    df_trainable_nonredundant = df_trainable.sort_values(
-        "system_biounit_id"
-    ).drop_duplicates("uniqueness")
-    df_trainable_nonredundant.to_parquet(
-        data_dir / "index" / "annotation_table_nonredundant.parquet", index=False
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    index_dir = data_dir / "index"
+    index_dir.mkdir(exist_ok=True, parents=True)
+    annotation_table = index_dir / "annotation_table.parquet"
+    if not annotation_table.exists():
+        _concat_parquets(
+            sorted((data_dir / "qc" / "index").glob("*")), annotation_table
+        )
+    dataset = ds.dataset(annotation_table, format="parquet")
+    trainable = _trainable_filter()
+
+    # first pass: smallest system_biounit_id of every uniqueness key
+    keys = ["system_id_no_biounit", "pli_qcov__100__strong__component"]
+    minima = []
+    for batch in dataset.to_batches(
+        columns=keys + ["system_biounit_id"], filter=trainable
+    ):
+        minima.append(
+            pa.table(
+                {
+                    "uniqueness": _uniqueness(batch),
+                    "system_biounit_id": batch["system_biounit_id"],
+                }
+            )
+            .group_by("uniqueness")
+            .aggregate([("system_biounit_id", "min")])
+        )
+
+    # second pass: rows with that biounit, then the first row of every key
+    table = dataset.schema.empty_table().append_column(
+        "uniqueness", pa.array([], pa.string())
     )
+    if len(minima):
+        best = (
+            pa.concat_tables(minima)
+            .group_by("uniqueness")
+            .aggregate([("system_biounit_id_min", "min")])
+        )
+        candidates = []
+        offset = 0
+        for batch in dataset.to_batches(filter=trainable):
+            uniqueness = _uniqueness(batch)
+            minimum = pc.take(
+                best["system_biounit_id_min_min"],
+                pc.index_in(uniqueness, value_set=best["uniqueness"]),
+            )
+            candidates.append(
+                pa.Table.from_batches([batch])
+                .append_column("uniqueness", uniqueness)
+                .append_column("_row", pa.array(np.arange(offset, offset + len(batch))))
+                .filter(pc.equal(batch["system_biounit_id"], minimum))
+            )
+            offset += len(batch)
+        table = pa.concat_tables(candidates)
+        first = table.group_by("uniqueness").aggregate([("_row", "min")])
+        table = table.filter(
+            pc.is_in(table["_row"], value_set=first["_row_min"])
+        ).drop_columns(["_row"])
+    table = table.sort_by("system_biounit_id")
+    pq.write_table(table, index_dir / "annotation_table_nonredundant.parquet")
@@ -122,26 +122,66 @@ class LinkedStructureConfig:
     )  # Filter criteria for deciding whether to keep a linked structure (AND logic)
 
 
-def make_linked_structures_data_file(
+def _wide_scores_are_fresh(data_dir: Path, search_db: str) -> bool:
+    """
+    Check that scores_wide holds exactly the batches of scores and
+    that none of them was scored again after its wide file was written.
+    """
+    wide_dir = data_dir / "scores_wide" / f"search_db={search_db}"
+    if not wide_dir.is_dir():
+        return False
+    score_dir = data_dir / "scores" / f"search_db={search_db}"
+    if not score_dir.is_dir():
+        return True
+    wide = {path.name: path.stat().st_mtime_ns for path in wide_dir.glob("*.parquet")}
+    batches = {
+        path.name: path.stat().st_mtime_ns for path in score_dir.glob("*.parquet")
+    }
+    return set(wide) == set(batches) and all(
+        mtime <= wide[name] for name, mtime in batches.items()
+    )
+
+
+def load_links(
     data_dir: Path,
     search_db: str,
-    superposed_folder: Path,
-    output_file: Path,
-    cfg: LinkedStructureConfig = LinkedStructureConfig(),
-    num_processes: int = 8,
-) -> None:
-    multiprocessing.set_start_method("spawn")
-
-    def get_system_ligand_files(system_id: str) -> list[Path]:
-        system_folder = get_cif_file(data_dir, "holo", system_id).parent
-        return [
-            system_folder / "ligand_files" / f"{c}.sdf"
-            for c in system_id.split("__")[-1].split("_")
-        ]
+    filter_criteria: dict[str, int],
+) -> pd.DataFrame:
+    """
+    Load the (query_system, target_system) pairs passing all
+    filter criteria with one column per criteria metric. Reads
+    the wide score layout when it is up to date with the long
+    score layout, otherwise pivots the long score layout.
 
-    (superposed_folder / search_db).mkdir(exist_ok=True, parents=True)
+    Parameters
+    ----------
+    data_dir : Path
+        the plinder dataset directory
+    search_db : str
+        the search database to load links for
+    filter_criteria : dict[str, int]
+        minimum similarity per metric (AND logic)
+
+    Returns
+    -------
+    pd.DataFrame
+        the links between query and target systems
+    """
+    wide_file = data_dir / "scores_wide" / f"search_db={search_db}"
+    if _wide_scores_are_fresh(data_dir, search_db):
+        links = pd.read_parquet(
+            wide_file,
+            columns=["query_system", "target_system", *filter_criteria],
+            filters=[
+                (metric, ">=", threshold)
+                for metric, threshold in filter_criteria.items()
+            ],
+        )
+        return links[
+            links["query_system"].str[:4] != links["target_system"].str[:4]
+        ].reset_index(drop=True)
     filters = []
-    for metric, threshold in cfg.filter_criteria.items():
+    for metric, threshold in filter_criteria.items():
         filters.append([("metric", "==", metric), ("similarity", ">=", threshold)])
     score_file = data_dir / "scores" / f"search_db={search_db}"
     links = pd.read_parquet(
@@ -162,8 +202,29 @@ def make_linked_structures_data_file(
         columns="metric",
         values="similarity",
     ).reset_index()
-    query = " and ".join([f"{m} >= {t}" for (m, t) in cfg.filter_criteria.items()])
-    links = links.query(query)
+    query = " and ".join([f"{m} >= {t}" for (m, t) in filter_criteria.items()])
+    return links.query(query)
+
+
+def make_linked_structures_data_file(
+    data_dir: Path,
+    search_db: str,
+    superposed_folder: Path,
+    output_file: Path,
+    cfg: LinkedStructureConfig = LinkedStructureConfig(),
+    num_processes: int = 8,
+) -> None:
+    multiprocessing.set_start_method("spawn")
+
+    def get_system_ligand_files(system_id: str) -> list[Path]:
+        system_folder = get_cif_file(data_dir, "holo", system_id).parent
+        return [
+            system_folder / "ligand_files" / f"{c}.sdf"
+            for c in system_id.split("__")[-1].split("_")
+        ]
+
+    (superposed_folder / search_db).mkdir(exist_ok=True, parents=True)
+    links = load_links(data_dir, search_db, cfg.filter_criteria)
     links["target_id"] = links["target_system"].map(lambda x: x.split("_")[0])
 
     targets = set(links["target_id"])
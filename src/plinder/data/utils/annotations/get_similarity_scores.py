@@ -2,12 +2,17 @@
 # Distributed under the terms of the Apache License 2.0
 from __future__ import annotations
 
+import multiprocessing
+import os
 import shutil
 import subprocess
-from collections import abc, defaultdict
+from collections import OrderedDict, abc, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass, field
+from functools import partial
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional
 
 import biotite.sequence as seq
 import biotite.sequence.align as align
@@ -25,6 +30,7 @@ from plinder.data import databases
 from plinder.data.pipeline.config import FoldseekConfig, MMSeqsConfig
 from plinder.data.pipeline.utils import load_entries_from_zips
 from plinder.data.utils.annotations.aggregate_annotations import Entry, System
+from plinder.data.utils.annotations.protein_utils import Chain
 
 LOG = setup_logger(__name__)
 
@@ -56,9 +62,22 @@ SCORE_NAMES = (
     "pli_unique_qcov",
 )
 
+WIDE_SORT_ORDER = [
+    ("query_system", "ascending"),
+    ("target_system", "ascending"),
+]
+
 _ChainInstanceMapping = str
 _ChainPairType = tuple[_ChainInstanceMapping, _ChainInstanceMapping]
 _SimilarityScoreDictType = dict[str, float]
+_NON_CANONICAL_AA = {
+    "X": "A",  # Replace X (any a.a with alanine)
+    "B": "D",  # Replace Asx ( with aspartic acid)
+    "J": "L",  # Replace Xle ( with leucine)
+    "Z": "E",  # Replace Glx (any a.a with glutamic acid)
+    "U": "C",  # Replace Selenocysteine(sec) (with cysteine)
+    "O": "K",  # replace Pyrrolysine(Pyl) (any a.a with alanine)
+}
 
 
 def get_sequence_similarity(seq_str1: str, seq_str2: str) -> tuple[float, float]:
@@ -80,14 +99,7 @@ def get_sequence_similarity(seq_str1: str, seq_str2: str) -> tuple[float, float]
     tuple[float, float]
         Sequence identity and sequence similarity score.
     """
-    non_canonical_aa: dict[str, str | int | None] = {
-        "X": "A",  # Replace X (any a.a with alanine)
-        "B": "D",  # Replace Asx ( with aspartic acid)
-        "J": "L",  # Replace Xle ( with leucine)
-        "Z": "E",  # Replace Glx (any a.a with glutamic acid)
-        "U": "C",  # Replace Selenocysteine(sec) (with cysteine)
-        "O": "K",  # replace Pyrrolysine(Pyl) (any a.a with alanine)
-    }
+    non_canonical_aa: dict[str, str | int | None] = dict(_NON_CANONICAL_AA)
     seq_str1 = seq_str1.translate(str.maketrans(non_canonical_aa))
     seq_str2 = seq_str2.translate(str.maketrans(non_canonical_aa))
     seq1_arr = np.array(list(seq_str1))
@@ -131,11 +143,166 @@ def get_sequence_similarity(seq_str1: str, seq_str2: str) -> tuple[float, float]
     return (align.get_sequence_identity(ali), similarity_score)
 
 
-def get_sequence_similarity_helper(seq_str1: str, seq_str2: str) -> float:
-    try:
-        return get_sequence_similarity(seq_str1, seq_str2)[1]
-    except Exception:
-        return 0
+_GAP = ord("-")
+
+
+def _encode_alignments(alns: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Concatenate aligned sequence strings into a single uint8 array
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        the character codes and the offsets of every row into them
+    """
+    lengths = alns.str.len().to_numpy(dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    codes = np.frombuffer(
+        "".join(alns).encode("ascii", errors="replace"), dtype=np.uint8
+    )
+    return codes, offsets
+
+
+def _count_before(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Number of True values before every position within its row
+    """
+    before = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(values, out=before[1:])
+    return before[:-1] - np.repeat(before[offsets[:-1]], np.diff(offsets))
+
+
+def _similarity_tables() -> tuple[np.ndarray, np.ndarray]:
+    """
+    Lookup tables for get_sequence_similarities
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        the index of every byte in the standard protein substitution
+        matrix (-1 for gaps, -2 for unknown symbols), and which pairs
+        of symbols count as similar
+    """
+    matrix = align.SubstitutionMatrix.std_protein_matrix()
+    symbols = matrix.get_alphabet1().get_symbols()
+    codes = np.full(256, -2, dtype=np.int64)
+    for i, symbol in enumerate(symbols):
+        codes[ord(symbol)] = i
+    for non_canonical, canonical in _NON_CANONICAL_AA.items():
+        codes[ord(non_canonical)] = codes[ord(canonical)]
+    codes[_GAP] = -1
+    scores = matrix.score_matrix()
+    diagonal = np.diagonal(scores)
+    similar = (
+        np.maximum(scores, 0) / np.maximum(diagonal[:, None], diagonal[None, :]) > 0.2
+    )
+    return codes, similar
+
+
+def get_sequence_similarities(
+    seq_strs1: abc.Sequence[str] | pd.Series, seq_strs2: abc.Sequence[str] | pd.Series
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Calculate the sequence identity and similarity score of many
+    aligned sequence pairs at once, see get_sequence_similarity.
+
+    All pairs are encoded into uint8 arrays, columns with a gap in
+    either sequence are dropped and the scores are reduced per pair
+    with numpy. Pairs that get_sequence_similarity can not score
+    (no ungapped columns or unknown symbols) get scores of 0.
+
+    Parameters
+    ----------
+    seq_strs1 : Sequence[str]
+        First aligned protein sequences
+    seq_strs2 : Sequence[str]
+        Second aligned protein sequences, of the same lengths
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Sequence identities and sequence similarity scores.
+    """
+    q_bytes, offsets = _encode_alignments(pd.Series(seq_strs1, dtype=object))
+    t_bytes, t_offsets = _encode_alignments(pd.Series(seq_strs2, dtype=object))
+    if not np.array_equal(offsets, t_offsets):
+        raise ValueError("aligned sequences differ in length")
+    n_pairs = len(offsets) - 1
+    codes, similar = _similarity_tables()
+    q_codes, t_codes = codes[q_bytes], codes[t_bytes]
+    rows = np.repeat(np.arange(n_pairs), np.diff(offsets))
+    kept = (q_codes != -1) & (t_codes != -1)
+    rows, q_codes, t_codes = rows[kept], q_codes[kept], t_codes[kept]
+    unknown = (q_codes == -2) | (t_codes == -2)
+    valid = np.bincount(rows[unknown], minlength=n_pairs) == 0
+    q_codes, t_codes = np.maximum(q_codes, 0), np.maximum(t_codes, 0)
+    columns = np.bincount(rows, minlength=n_pairs)
+    identical = np.bincount(rows, weights=q_codes == t_codes, minlength=n_pairs)
+    similarity = np.bincount(rows, weights=similar[q_codes, t_codes], minlength=n_pairs)
+    valid &= columns > 0
+    denominator = np.where(valid, columns, 1)
+    return (
+        np.where(valid, identical / denominator, 0.0),
+        np.where(valid, similarity / denominator, 0.0),
+    )
+
+
+def _lookup(
+    groups: np.ndarray, keys: np.ndarray, mappings: list[dict[int, int]]
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Look up keys in the mapping of their group
+
+    Parameters
+    ----------
+    groups : np.ndarray
+        index into mappings for every key
+    keys : np.ndarray
+        the keys to look up
+    mappings : list[dict[int, int]]
+        one mapping per group
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        whether every key was found and the value it maps to
+    """
+    table_keys = [np.zeros(0, dtype=np.int64)]
+    table_values = [np.zeros(0, dtype=np.int64)]
+    for group, mapping in enumerate(mappings):
+        table_keys.append(
+            (group << 32) + np.fromiter(mapping.keys(), np.int64, len(mapping)) + 2**31
+        )
+        table_values.append(np.fromiter(mapping.values(), np.int64, len(mapping)))
+    all_keys = np.concatenate(table_keys)
+    order = np.argsort(all_keys)
+    all_keys, all_values = all_keys[order], np.concatenate(table_values)[order]
+    query = (groups.astype(np.int64) << 32) + keys + 2**31
+    index = np.minimum(np.searchsorted(all_keys, query), max(len(all_keys) - 1, 0))
+    if not len(all_keys):
+        return np.zeros(len(query), dtype=bool), np.zeros(len(query), dtype=np.int64)
+    return all_keys[index] == query, all_values[index]
+
+
+def _list_array(n_rows: int, rows: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    Split values into one numpy array per row through an arrow
+    list array, rows must be sorted
+    """
+    offsets = np.zeros(n_rows + 1, dtype=np.int32)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=offsets[1:])
+    lists = pyarrow.ListArray.from_arrays(pyarrow.array(offsets), pyarrow.array(values))
+    return lists.to_numpy(zero_copy_only=False)
+
+
+def _pairs_to_arrays(pairs: np.ndarray, dtype: type) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Split the (alignment position, value) pairs stored by older
+    versions of Scorer.map_residues into parallel arrays
+    """
+    pairs = np.asarray([tuple(pair) for pair in pairs]).reshape(-1, 2)
+    return pairs[:, 0].astype(np.int32), pairs[:, 1].astype(dtype)
 
 
 def run_alignment(
@@ -147,6 +314,7 @@ def run_alignment(
     alignment_config: FoldseekConfig | MMSeqsConfig,
     tmp_dir: Path = Path.cwd() / "tmp",
     remove_tmp: bool = True,
+    db_load_mode: int = 0,
 ) -> None:
     if search_db.with_suffix(".dbtype").exists():
         search_db.with_suffix(".dbtype").unlink()
@@ -174,6 +342,9 @@ def run_alignment(
     ]
     if aln_type == "foldseek":
         search_commands += ["--sort-by-structure-bits", "0"]
+    if db_load_mode:
+        # e.g. 2 to read a target index already in the page cache (see touchdb)
+        search_commands += ["--db-load-mode", f"{db_load_mode}"]
     convert_commands = [
         aln_type,
         "convertalis",
@@ -281,12 +452,144 @@ def combine_scores(
     return q_t_scores_combined
 
 
+def pivot_scores_wide(scores: pyarrow.Table) -> pyarrow.Table:
+    """
+    Pivot long-format protein similarity scores (one row per
+    query_system, target_system and metric) into the wide layout
+    (one row per query_system, target_system pair and one int8
+    column per metric).
+
+    Parameters
+    ----------
+    scores : pyarrow.Table
+        scores conforming to schemas.PROTEIN_SIMILARITY_SCHEMA
+
+    Returns
+    -------
+    pyarrow.Table
+        scores conforming to schemas.PROTEIN_SIMILARITY_WIDE_SCHEMA,
+        sorted by query_system and target_system
+    """
+    keys = [col for (col, _) in WIDE_SORT_ORDER]
+    df = scores.select(
+        ["query_system", "target_system", "protein_mapping", "protein_mapper"]
+        + ["metric", "similarity"]
+    ).to_pandas()
+    for col in ["protein_mapper", "metric"]:
+        df[col] = df[col].astype(str)
+    info = df.groupby(keys, sort=False)[["protein_mapping", "protein_mapper"]].first()
+    wide = df.pivot_table(
+        index=keys, columns="metric", values="similarity", aggfunc="max"
+    ).reindex(columns=schemas.PROTEIN_SIMILARITY_METRICS)
+    wide.columns.name = None
+    wide = info.join(wide).reset_index().sort_values(keys)
+    return pyarrow.Table.from_pandas(
+        wide, schema=schemas.PROTEIN_SIMILARITY_WIDE_SCHEMA, preserve_index=False
+    )
+
+
+class EntryCache:
+    """
+    A bounded least recently used cache of the entries loaded from
+    the entry zips for scoring, keyed by pdb_id. Popular alignment
+    targets are then parsed once per batch instead of once per query.
+    PDB IDs missing from the zips are cached as well.
+
+    Parameters
+    ----------
+    maxsize : int, default=5000
+        maximum number of cached entries
+    """
+
+    def __init__(self, maxsize: int = 5000) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, Optional[Entry]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, *, data_dir: Path, pdb_ids: abc.Iterable[str]) -> dict[str, Entry]:
+        """
+        Get entries, loading the ones that are not cached from the zips
+
+        Parameters
+        ----------
+        data_dir : Path
+            the root plinder dir
+        pdb_ids : Iterable[str]
+            the pdb IDs of the entries
+
+        Returns
+        -------
+        dict[str, Entry]
+            the entries found in the zips
+        """
+        pdb_ids = set(pdb_ids)
+        missing = pdb_ids.difference(self._entries)
+        self.hits += len(pdb_ids) - len(missing)
+        self.misses += len(missing)
+        entries = {}
+        for pdb_id in pdb_ids.intersection(self._entries):
+            self._entries.move_to_end(pdb_id)
+            entry = self._entries[pdb_id]
+            if entry is not None:
+                entries[pdb_id] = entry
+        if len(missing):
+            LOG.info(f"loading {len(missing)} (additional) entries")
+            loaded = load_entries_from_zips(
+                data_dir=data_dir,
+                pdb_ids=list(missing),
+                load_for_scoring=True,
+            )
+            entries.update(loaded)
+            for pdb_id in missing:
+                self._entries[pdb_id] = loaded.get(pdb_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return entries
+
+    def stats(self) -> dict[str, float]:
+        requests = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
+
+
+# the scorer of a worker process of Scorer.score_workers
+_WORKER_SCORER: Optional[Scorer] = None
+
+
+def _init_score_worker(scorer: Scorer) -> None:
+    global _WORKER_SCORER
+    _WORKER_SCORER = scorer
+
+
+def _score_pdb_id(
+    pdb_id: str, *, data_dir: Path, search_db: str, overwrite: bool
+) -> tuple[Path, int, dict[str, float]]:
+    assert _WORKER_SCORER is not None
+    LOG.info(f"aggregating {pdb_id} scores for {search_db}")
+    path = _WORKER_SCORER.get_score_df(
+        data_dir, pdb_id, search_db=search_db, overwrite=overwrite
+    )
+    return path, os.getpid(), _WORKER_SCORER.entry_cache.stats()
+
+
 @dataclass
 class Scorer:
     entries: dict[str, Entry]
     source_to_full_db_file: dict[str, Path]
     db_dir: Path
     scores_dir: Path
+    # entries of the queries and their alignment targets, reused across pdb_ids
+    entry_cache: EntryCache = field(default_factory=EntryCache)
+    # if set, also write the wide score layout to this directory
+    wide_scores_dir: Optional[Path] = None
     protein_chain_mappers: list[str] = field(
         default_factory=lambda: [
             "protein_lddt_qcov_foldseek",
@@ -309,21 +612,15 @@ class Scorer:
     def __post_init__(self) -> None:
         self.db_dir.mkdir(exist_ok=True, parents=True)
         self.scores_dir.mkdir(exist_ok=True, parents=True)
+        if self.wide_scores_dir is not None:
+            self.wide_scores_dir.mkdir(exist_ok=True, parents=True)
 
     def make_dbs(self) -> None:
         databases.make_sub_dbs(self.db_dir, self.source_to_full_db_file, self.entries)
 
     @staticmethod
     def get_config(search_db: str, aln_type: str) -> FoldseekConfig | MMSeqsConfig:
-        config: FoldseekConfig | MMSeqsConfig
-        if aln_type == "foldseek":
-            config = FoldseekConfig()
-        else:
-            config = MMSeqsConfig()
-        if search_db in ["apo", "pred"]:
-            config.coverage = 0.9
-            config.min_seq_id = 0.9
-        return config
+        return databases.get_search_config(search_db, aln_type)
 
     def run_alignments(
         self,
@@ -332,59 +629,171 @@ class Scorer:
         output_folder: Path,
         overwrite: bool = False,
     ) -> None:
+        self.run_batch_alignments(
+            entry_ids=entry_ids, search_dbs=[search_db], output_folder=output_folder
+        )
+
+    def run_batch_alignments(
+        self,
+        entry_ids: list[str],
+        search_dbs: list[str],
+        output_folder: Path,
+        preload_target_dbs: bool = False,
+    ) -> None:
+        """
+        Search the holo chains of entry_ids against the search_dbs with
+        mmseqs and foldseek and split the alignments into
+        {db_dir}/{search_db}_{aln_type}/aln/{pdb_id}.parquet.
+
+        The query sub-database of an alignment type is created once
+        and searched against every search_db.
+
+        Parameters
+        ----------
+        entry_ids : list[str]
+            the pdb IDs to search
+        search_dbs : list[str]
+            the databases to search against
+        output_folder : Path
+            scratch directory of the batch
+        preload_target_dbs : bool, default=False
+            load the (pre-computed) index of every target database into
+            the page cache with touchdb and search with --db-load-mode 2
+        """
         output_folder.mkdir(exist_ok=True)
+        if preload_target_dbs:
+            # once per target database and batch, before any search
+            for aln_type in ["mmseqs", "foldseek"]:
+                for search_db in search_dbs:
+                    target_db = (
+                        self.db_dir
+                        / f"{search_db}_{aln_type}"
+                        / f"{search_db}_{aln_type}"
+                    )
+                    databases.run([aln_type, "touchdb", str(target_db)])
         for aln_type in ["mmseqs", "foldseek"]:
-            sub_db = output_folder / search_db / aln_type
-            sub_db.mkdir(exist_ok=True, parents=True)
+            query_dir = output_folder / aln_type
+            query_dir.mkdir(exist_ok=True, parents=True)
             db_ids = databases.get_db_ids(
                 self.entries, "holo", aln_type, entry_ids=entry_ids
             )
             databases.make_sub_db(
                 db_ids,
                 self.source_to_full_db_file[f"holo_{aln_type}"],
-                sub_db,
+                query_dir,
                 aln_type,
             )
-            tmp_dir = sub_db / f"tmp_{search_db}_{aln_type}"
-            tmp_dir.mkdir(exist_ok=True, parents=True)
-            aln_file = sub_db / f"aln_{search_db}.tsv"
-            LOG.info("run_alignments calling run_alignment:")
-            LOG.info(f"    sub_db={sub_db}")
-            LOG.info(f"    query_db={sub_db / sub_db.name}")
-            LOG.info(f"    search_db={sub_db / 'search'}")
-            LOG.info(f"    tmp_dir={tmp_dir / output_folder.stem}")
-            LOG.info(f"    aln_file={aln_file.with_suffix('.tsv')}")
-            # LOG.info(f"    aln_dir={aln_dir}")
-            LOG.info(f"    aln_type={aln_type}")
-            LOG.info(
-                f"    target_db={self.db_dir / f'{search_db}_{aln_type}' / f'{search_db}_{aln_type}'}"
-            )
-            try:
-                run_alignment(
-                    aln_type=aln_type,
-                    query_db=sub_db / sub_db.name,
-                    target_db=self.db_dir
-                    / f"{search_db}_{aln_type}"
-                    / f"{search_db}_{aln_type}",
-                    search_db=sub_db / "search",
-                    aln_file=aln_file.with_suffix(".tsv"),
-                    tmp_dir=tmp_dir / output_folder.stem,
-                    alignment_config=self.get_config(search_db, aln_type),
-                )
-            except Exception as e:
-                LOG.error(f"scoring: Error for {search_db}_{aln_type}: {e}")
-                continue
-            aln_dir = self.db_dir / f"{search_db}_{aln_type}" / "aln"
-            aln_dir.mkdir(exist_ok=True, parents=True)
-            for pdb_id in tqdm(entry_ids):
-                pdb_id_file = (
-                    aln_file.with_suffix(".parquet") / f"query_pdb_id={pdb_id}"
+            for search_db in search_dbs:
+                target_db = (
+                    self.db_dir / f"{search_db}_{aln_type}" / f"{search_db}_{aln_type}"
                 )
-                if not pdb_id_file.exists():
+                sub_db = query_dir / search_db
+                sub_db.mkdir(exist_ok=True, parents=True)
+                tmp_dir = sub_db / f"tmp_{search_db}_{aln_type}"
+                tmp_dir.mkdir(exist_ok=True, parents=True)
+                aln_file = sub_db / f"aln_{search_db}.tsv"
+                LOG.info("run_batch_alignments calling run_alignment:")
+                LOG.info(f"    query_db={query_dir / aln_type}")
+                LOG.info(f"    search_db={sub_db / 'search'}")
+                LOG.info(f"    tmp_dir={tmp_dir / output_folder.stem}")
+                LOG.info(f"    aln_file={aln_file.with_suffix('.tsv')}")
+                LOG.info(f"    aln_type={aln_type}")
+                LOG.info(f"    target_db={target_db}")
+                try:
+                    run_alignment(
+                        aln_type=aln_type,
+                        query_db=query_dir / aln_type,
+                        target_db=target_db,
+                        search_db=sub_db / "search",
+                        aln_file=aln_file.with_suffix(".tsv"),
+                        tmp_dir=tmp_dir / output_folder.stem,
+                        alignment_config=self.get_config(search_db, aln_type),
+                        db_load_mode=2 if preload_target_dbs else 0,
+                    )
+                except Exception as e:
+                    LOG.error(f"scoring: Error for {search_db}_{aln_type}: {e}")
                     continue
-                pdb_id_df = pd.read_parquet(pdb_id_file)
-                if not pdb_id_df.empty:
-                    pdb_id_df.to_parquet(aln_dir / f"{pdb_id}.parquet")
+                aln_dir = self.db_dir / f"{search_db}_{aln_type}" / "aln"
+                aln_dir.mkdir(exist_ok=True, parents=True)
+                for pdb_id in tqdm(entry_ids):
+                    pdb_id_file = (
+                        aln_file.with_suffix(".parquet") / f"query_pdb_id={pdb_id}"
+                    )
+                    if not pdb_id_file.exists():
+                        continue
+                    pdb_id_df = pd.read_parquet(pdb_id_file)
+                    if not pdb_id_df.empty:
+                        pdb_id_df.to_parquet(aln_dir / f"{pdb_id}.parquet")
+
+    @contextmanager
+    def score_workers(self, cpu: int) -> Iterator[Optional[ProcessPoolExecutor]]:
+        """
+        Start the processes scoring pdb_ids, each with its own copy
+        of the scorer and entry cache. Pass the pool to every call of
+        aggregate_batch_scores of a batch so that the entry caches are
+        reused across search_dbs.
+
+        Parameters
+        ----------
+        cpu : int
+            number of processes, no pool is started if cpu <= 1
+
+        Yields
+        ------
+        ProcessPoolExecutor | None
+            the pool or None if pdb_ids are scored in this process
+        """
+        if cpu <= 1:
+            yield None
+            return
+        with ProcessPoolExecutor(
+            max_workers=cpu,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_score_worker,
+            initargs=(self,),
+        ) as pool:
+            yield pool
+
+    def _score_pdb_ids(
+        self,
+        data_dir: Path,
+        pdb_ids: list[str],
+        search_db: str,
+        overwrite: bool,
+        pool: Optional[ProcessPoolExecutor],
+    ) -> list[Path]:
+        if pool is None:
+            score_paths = []
+            for pdb_id in tqdm(pdb_ids):
+                LOG.info(f"aggregating {pdb_id} scores for {search_db}")
+                score_paths.append(
+                    self.get_score_df(
+                        data_dir, pdb_id, search_db=search_db, overwrite=overwrite
+                    )
+                )
+            LOG.info(f"entry cache {self.entry_cache.stats()}")
+            return score_paths
+        score_paths = []
+        worker_stats: dict[int, dict[str, float]] = {}
+        for score_path, pid, stats in pool.map(
+            partial(
+                _score_pdb_id,
+                data_dir=data_dir,
+                search_db=search_db,
+                overwrite=overwrite,
+            ),
+            pdb_ids,
+        ):
+            score_paths.append(score_path)
+            # results come in submission order, keep the latest stats of a worker
+            previous = worker_stats.get(pid)
+            if previous is None or (
+                stats["hits"] + stats["misses"] > previous["hits"] + previous["misses"]
+            ):
+                worker_stats[pid] = stats
+        for pid, stats in sorted(worker_stats.items()):
+            LOG.info(f"entry cache of worker {pid} {stats}")
+        return score_paths
 
     def aggregate_batch_scores(
         self,
@@ -393,15 +802,42 @@ class Scorer:
         pdb_ids: list[str],
         search_db: str,
         overwrite: bool = True,
+        cpu: int = 1,
+        pool: Optional[ProcessPoolExecutor] = None,
     ) -> None:
-        results = []
-        for pdb_id in tqdm(pdb_ids):
-            LOG.info(f"aggregating {pdb_id} scores for {search_db}")
-            score_path = self.get_score_df(
-                data_dir, pdb_id, search_db=search_db, overwrite=overwrite
+        """
+        Score every pdb_id of a batch into its own parquet file and
+        merge them into a single sorted parquet file of the batch.
+
+        Parameters
+        ----------
+        data_dir : Path
+            the root plinder dir
+        batch_id : str
+            name of the batch parquet file
+        pdb_ids : list[str]
+            the pdb IDs to score
+        search_db : str
+            holo, apo or pred
+        overwrite : bool, default=True
+            re-create existing per pdb_id files
+        cpu : int, default=1
+            number of processes scoring pdb_ids if no pool is given
+        pool : ProcessPoolExecutor, default=None
+            the processes of score_workers, reused across search_dbs
+        """
+        if pool is None and cpu > 1 and len(pdb_ids) > 1:
+            with self.score_workers(min(cpu, len(pdb_ids))) as workers:
+                score_paths = self._score_pdb_ids(
+                    data_dir, pdb_ids, search_db, overwrite, workers
+                )
+        else:
+            score_paths = self._score_pdb_ids(
+                data_dir, pdb_ids, search_db, overwrite, pool
             )
-            if score_path.is_file():
-                results.append(score_path.as_posix())
+        results = [
+            score_path.as_posix() for score_path in score_paths if score_path.is_file()
+        ]
         sorting_columns = pq.SortingColumn.from_ordering(
             schemas.PROTEIN_SIMILARITY_SCHEMA,
             SORT_ORDER,
@@ -411,11 +847,28 @@ class Scorer:
         LOG.info(f"writing {pqt_file}")
         data = ds.dataset(results, schema=schemas.PROTEIN_SIMILARITY_SCHEMA)
         LOG.info(f"rows of data {data.count_rows()}")
+        table = data.to_table()
         pq.write_table(
-            data.to_table().sort_by(SORT_ORDER),
+            table.sort_by(SORT_ORDER),
             pqt_file,
             sorting_columns=sorting_columns,
         )
+        if self.wide_scores_dir is not None:
+            wide_file = (
+                self.wide_scores_dir
+                / f"search_db={search_db}"
+                / (batch_id + ".parquet")
+            )
+            wide_file.parent.mkdir(exist_ok=True, parents=True)
+            LOG.info(f"writing {wide_file}")
+            pq.write_table(
+                pivot_scores_wide(table),
+                wide_file,
+                sorting_columns=pq.SortingColumn.from_ordering(
+                    schemas.PROTEIN_SIMILARITY_WIDE_SCHEMA,
+                    WIDE_SORT_ORDER,
+                ),
+            )
 
     def get_score_df(
         self, data_dir: Path, pdb_id: str, search_db: str, overwrite: bool = True
@@ -432,7 +885,6 @@ class Scorer:
             )
             pdb_file.parent.mkdir(exist_ok=True, parents=True)
             if overwrite or not pdb_file.exists():
-                self.entries = {}
                 entries_to_load = {pdb_id}
                 if search_db != "pred" and pdb_id_file.exists():
                     entries_to_load |= set(
@@ -440,17 +892,9 @@ class Scorer:
                             "target_pdb_id"
                         ]
                     )
-                entries_to_load = entries_to_load.difference(self.entries.keys())
                 LOG.info(f"entries_to_load pdb_id={pdb_id} {len(entries_to_load)}")
-                LOG.info(
-                    f"loading {len(entries_to_load)} (additional) entries for {pdb_id}"
-                )
-                self.entries.update(
-                    load_entries_from_zips(
-                        data_dir=data_dir,
-                        pdb_ids=entries_to_load,
-                        load_for_scoring=True,
-                    )
+                self.entries = self.entry_cache.get(
+                    data_dir=data_dir, pdb_ids=entries_to_load
                 )
 
                 try:
@@ -498,16 +942,16 @@ class Scorer:
                 continue
             aln_df = pd.read_parquet(aln_file)
             aln_df["source"] = aln_type
-            aln_df["qrnum"] = aln_df["qrnum"].apply(
-                lambda x: dict([(int(i), int(r)) for i, r in x])
-            )
-            aln_df["trnum"] = aln_df["trnum"].apply(
-                lambda x: dict([(int(i), int(r)) for i, r in x])
-            )
-            if "lddtfull" in aln_df.columns:
-                aln_df["lddtfull"] = aln_df["lddtfull"].apply(
-                    lambda x: dict([(int(i), l) for i, l in x])
-                )
+            if "qrnum_pos" not in aln_df.columns:
+                # mapped by an older version with (position, value) pairs
+                for col in ["qrnum", "trnum"]:
+                    aln_df[f"{col}_pos"], aln_df[col] = zip(
+                        *[_pairs_to_arrays(pairs, np.int32) for pairs in aln_df[col]]
+                    )
+                aln_df["lddtfull"] = [
+                    _pairs_to_arrays(pairs, np.float64)[1]
+                    for pairs in aln_df["lddtfull"]
+                ]
             data.append(aln_df)
         if len(data):
             df = pd.concat(data)
@@ -557,19 +1001,12 @@ class Scorer:
         df["target_entry"] = df["target"].str.split("_", expand=True)[0]
         df["qaln"] = df["qaln"].str.upper()
         df["taln"] = df["taln"].str.upper()
-        df["seqsim"] = df[["qaln", "taln"]].apply(
-            lambda x: get_sequence_similarity_helper(x["qaln"], x["taln"]), axis=1
-        )
+        df["seqsim"] = get_sequence_similarities(df["qaln"], df["taln"])[1]
         df["seqsim_qcov"] = df["seqsim"] * df["qcov"]
         df["fident_qcov"] = df["fident"] * df["qcov"]
         if aln_type == "foldseek":
             df["lddt_qcov"] = df["lddt"] * df["qcov"]
-            df["lddtaln"] = df["lddtfull"].apply(lambda x: x.split(","))
-        df = df.apply(
-            lambda x: self.map_row(x, aln_type=aln_type, search_db=search_db), axis=1
-        )
-        if aln_type == "foldseek":
-            df.drop(columns=["lddtaln"], inplace=True)
+        df = self.map_residues(df, aln_type=aln_type, search_db=search_db)
         df["source"] = aln_type
         df.set_index(
             [
@@ -583,49 +1020,118 @@ class Scorer:
         )
         return df
 
-    def map_row(self, parts: pd.Series, aln_type: str, search_db: str) -> pd.Series:
-        parts["qrnum"] = []
-        parts["trnum"] = []
-        parts["lddtfull"] = []
-        q_i, t_i = int(parts["qstart"]) - 1, int(parts["tstart"]) - 1
-        aln_index = 0
-        for x, (q_a, t_a) in enumerate(zip(parts["qaln"], parts["taln"])):
-            if q_a != "-" and t_a != "-":
-                q_chain = self.entries[parts["query_entry"]].chains[
-                    parts["query_chain_mapped"]
-                ]
-                t_chain = (
-                    self.entries[parts["target_entry"]].chains[
-                        parts["target_chain_mapped"]
-                    ]
-                    if search_db != "pred"
-                    else None
-                )
-                if aln_type == "foldseek":
-                    # it's the residue_index, map to residue_number
-                    q_n = q_chain.residue_index_to_number.get(q_i, None)
-                    if t_chain is not None:
-                        t_n = t_chain.residue_index_to_number.get(t_i, None)
-                    else:
-                        t_n = None
-                    if q_n is not None:
-                        parts["qrnum"].append((x, q_n))
-                        parts["lddtfull"].append(
-                            (x, float(parts["lddtaln"][aln_index]))
-                        )
-                    if t_n is not None:
-                        parts["trnum"].append((x, t_n))
-                elif aln_type == "mmseqs":
-                    if q_i in q_chain.residues:
-                        parts["qrnum"].append((x, q_i))
-                    if t_chain is not None and t_i in t_chain.residues:
-                        parts["trnum"].append((x, t_i))
-                aln_index += 1
-            if q_a != "-":
-                q_i += 1
-            if t_a != "-":
-                t_i += 1
-        return parts
+    def map_residues(
+        self, df: pd.DataFrame, aln_type: str, search_db: str
+    ) -> pd.DataFrame:
+        """
+        Map the aligned positions of every alignment to query and target
+        residue numbers.
+
+        The alignment strings are encoded into a single uint8 array,
+        residue indices are cumulative sums over the gap masks and
+        residues are looked up per chain with sorted arrays, so no
+        python code runs per alignment column.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            alignments with mapped chains
+        aln_type : str
+            foldseek or mmseqs
+        search_db : str
+            holo, apo or pred
+
+        Returns
+        -------
+        pd.DataFrame
+            df with parallel list columns of alignment positions
+            (qrnum_pos, trnum_pos) and residue numbers (qrnum, trnum)
+            of the mapped residues, and the lddt of every qrnum_pos
+            (lddtfull, foldseek only)
+        """
+        df = df.reset_index(drop=True)
+        n_rows = len(df)
+        q_codes, offsets = _encode_alignments(df["qaln"])
+        t_codes, _ = _encode_alignments(df["taln"])
+        if len(q_codes) != len(t_codes):
+            raise ValueError("query and target alignments differ in length")
+        rows = np.repeat(np.arange(n_rows), np.diff(offsets))
+        q_residue, t_residue = q_codes != _GAP, t_codes != _GAP
+        aligned = q_residue & t_residue
+        q_i = (df["qstart"].to_numpy(dtype=np.int64) - 1)[rows] + _count_before(
+            q_residue, offsets
+        )
+        t_i = (df["tstart"].to_numpy(dtype=np.int64) - 1)[rows] + _count_before(
+            t_residue, offsets
+        )
+        aln_index = _count_before(aligned, offsets)
+        x = np.arange(len(q_codes)) - offsets[rows]
+        (positions,) = np.nonzero(aligned)
+        rows, x, q_i, t_i, aln_index = (
+            rows[positions],
+            x[positions],
+            q_i[positions],
+            t_i[positions],
+            aln_index[positions],
+        )
+
+        def residue_mapping(chain: Chain) -> dict[int, int]:
+            if aln_type == "foldseek":
+                # it's the residue_index, map to residue_number
+                return chain.residue_index_to_number
+            return {r: r for r in chain.residues}
+
+        q_groups, q_chains = pd.factorize(
+            pd.Series(list(zip(df["query_entry"], df["query_chain_mapped"])))
+        )
+        q_found, q_n = _lookup(
+            q_groups[rows],
+            q_i,
+            [
+                residue_mapping(self.entries[entry].chains[chain])
+                for entry, chain in q_chains
+            ],
+        )
+        if search_db != "pred":
+            t_groups, t_chains = pd.factorize(
+                pd.Series(list(zip(df["target_entry"], df["target_chain_mapped"])))
+            )
+            t_found, t_n = _lookup(
+                t_groups[rows],
+                t_i,
+                [
+                    residue_mapping(self.entries[entry].chains[chain])
+                    for entry, chain in t_chains
+                ],
+            )
+        else:
+            t_found = np.zeros(len(rows), dtype=bool)
+            t_n = t_i
+        df["qrnum_pos"] = _list_array(
+            n_rows, rows[q_found], x[q_found].astype(np.int32)
+        )
+        df["qrnum"] = _list_array(n_rows, rows[q_found], q_n[q_found].astype(np.int32))
+        df["trnum_pos"] = _list_array(
+            n_rows, rows[t_found], x[t_found].astype(np.int32)
+        )
+        df["trnum"] = _list_array(n_rows, rows[t_found], t_n[t_found].astype(np.int32))
+        if aln_type == "foldseek":
+            lddt = df["lddtfull"].str.split(",")
+            lddt_offsets = np.zeros(n_rows + 1, dtype=np.int64)
+            np.cumsum(lddt.str.len().to_numpy(dtype=np.int64), out=lddt_offsets[1:])
+            lddt_values = pd.to_numeric(
+                pd.Series([v for values in lddt for v in values], dtype=object),
+                errors="coerce",
+            ).to_numpy(dtype=np.float64)
+            lddt_index = lddt_offsets[rows] + aln_index
+            if np.any(lddt_index[q_found] >= lddt_offsets[rows + 1][q_found]):
+                raise IndexError("lddtfull is shorter than the alignment")
+            df["lddtfull"] = _list_array(
+                n_rows, rows[q_found], lddt_values[lddt_index[q_found]]
+            )
+        else:
+            df["lddtfull"] = _list_array(n_rows, rows[:0], np.zeros(0))
+        return df
 
     def get_protein_scores_pair(self, aln: pd.DataFrame) -> dict[str, float]:
         scores = {}
@@ -755,38 +1261,50 @@ class Scorer:
                     t_instance_chain, {}
                 )
             for source, aln_source in aln.iterrows():
-                for i in aln_source["qrnum"]:
-                    q_a, t_a, lddt, q_n, t_n = (
-                        aln_source["qaln"][i],
-                        aln_source["taln"][i],
-                        aln_source["lddtfull"].get(i, 0),
-                        aln_source["qrnum"][i],
-                        aln_source["trnum"].get(i, None),
+                q_pos, q_n = aln_source["qrnum_pos"], aln_source["qrnum"]
+                if not len(q_pos):
+                    continue
+                lddt = aln_source["lddtfull"]
+                if len(lddt) != len(q_pos):
+                    lddt = np.zeros(len(q_pos))
+                q_a = np.frombuffer(aln_source["qaln"].encode(), dtype=np.uint8)
+                t_a = np.frombuffer(aln_source["taln"].encode(), dtype=np.uint8)
+                identical = q_a[q_pos] == t_a[q_pos]
+                in_pocket = np.isin(q_n, list(q_pocket))
+                if not np.any(in_pocket):
+                    continue
+                pocket_scores[f"pocket_lddt_{source}"] += lddt[in_pocket].sum()
+                if np.any(identical & in_pocket):
+                    pocket_scores[f"pocket_fident_{source}"] += np.sum(
+                        identical & in_pocket
                     )
-                    assert q_a != "-" and t_a != "-"
-                    if q_n in q_pocket:
-                        pocket_scores[f"pocket_lddt_{source}"] += lddt
-                        if q_a == t_a:
-                            pocket_scores[f"pocket_fident_{source}"] += 1
-                        if (
-                            target_system is not None
-                            and t_n is not None
-                            and t_n in t_pocket
-                        ):
-                            pocket_scores[f"pocket_qcov_{source}"] += 1
-                            pocket_scores[f"pocket_lddt_qcov_{source}"] += lddt
-                            if q_a == t_a:
-                                pocket_scores[f"pocket_fident_qcov_{source}"] += 1
-                            if q_n in q_interactions and t_n in t_interactions:
-                                pli_scores[f"pli_qcov_{source}"] += sum(
-                                    (q_interactions[q_n] & t_interactions[t_n]).values()
-                                )
-                                pli_scores[f"pli_unique_qcov_{source}"] += len(
-                                    (
-                                        set(q_interactions[q_n].values())
-                                        & set(t_interactions[t_n].values())
-                                    )
-                                )
+                if target_system is None:
+                    continue
+                t_pos, t_n = aln_source["trnum_pos"], aln_source["trnum"]
+                if not len(t_pos):
+                    continue
+                # target residue numbers at the query positions
+                t_index = np.minimum(np.searchsorted(t_pos, q_pos), len(t_pos) - 1)
+                has_t = t_pos[t_index] == q_pos
+                t_n = t_n[t_index]
+                covered = in_pocket & has_t & np.isin(t_n, list(t_pocket))
+                if not np.any(covered):
+                    continue
+                pocket_scores[f"pocket_qcov_{source}"] += np.sum(covered)
+                pocket_scores[f"pocket_lddt_qcov_{source}"] += lddt[covered].sum()
+                if np.any(identical & covered):
+                    pocket_scores[f"pocket_fident_qcov_{source}"] += np.sum(
+                        identical & covered
+                    )
+                for q_r, t_r in zip(q_n[covered].tolist(), t_n[covered].tolist()):
+                    if q_r in q_interactions and t_r in t_interactions:
+                        pli_scores[f"pli_qcov_{source}"] += sum(
+                            (q_interactions[q_r] & t_interactions[t_r]).values()
+                        )
+                        pli_scores[f"pli_unique_qcov_{source}"] += len(
+                            set(q_interactions[q_r].values())
+                            & set(t_interactions[t_r].values())
+                        )
         for score in pocket_scores:
             pocket_scores[score] /= pocket_length
         for score in pli_scores:
@@ -77,7 +77,9 @@ def make_mmp_index_from_smiles_df(
         raise
 
     fragment_tasks = [
-        f"mmpdb fragment -j 1 {smi.name}" for smi in output_path.glob("*.*.smi")
+        # prefix with the input size so mpqueue starts the largest first
+        f"{smi.stat().st_size}\tmmpdb fragment -j 1 {smi.name}"
+        for smi in output_path.glob("*.*.smi")
     ]
     with (scratch_dir / "fragment_tasks.txt").open("w") as f:
         f.write("\n".join(fragment_tasks))
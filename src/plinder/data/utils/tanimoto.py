@@ -1,7 +1,12 @@
 # Copyright (c) 2024, Plinder Development Team
 # Distributed under the terms of the Apache License 2.0
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, Optional
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Optional
 
 import numpy as np
 import pandas as pd
@@ -9,7 +14,6 @@ import pyarrow as pa
 import pyarrow.parquet as pq
 from rdkit import Chem
 from rdkit.Chem import AllChem
-from scipy.spatial.distance import cdist
 
 from plinder.core.utils import schemas
 from plinder.core.utils.log import setup_logger
@@ -20,6 +24,18 @@ if TYPE_CHECKING:
 
 LOG = setup_logger(__name__)
 
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+
+FINGERPRINTS_FILE = "ligands_per_inchikey_ecfp4.fp"
+_FP_MAGIC = b"PLFP"
+# fingerprints start at a multiple of this offset, past the header
+_FP_ALIGN = 64
+# persistent cache of inchikeys by canonical SMILES, see get_inchikeys
+INCHIKEY_CACHE = "inchikeys.parquet"
+
 
 def get_ecfp_fingerprint(
     smiles: str, radius: int, nbits: int
@@ -32,11 +48,171 @@ def get_ecfp_fingerprint(
         return None
 
 
+def _packed_ecfp_fingerprint(smiles: str, radius: int, nbits: int) -> Optional[bytes]:
+    fp = get_ecfp_fingerprint(smiles, radius, nbits)
+    if fp is None:
+        return None
+    return bytes(pack_fingerprints(fp[None]).data)
+
+
+def _map_processes(
+    func: Callable[[str], Any], items: list[str], cpu: int = 1
+) -> list[Any]:
+    if cpu <= 1 or len(items) < 2:
+        return list(map(func, items))
+    chunksize = max(1, len(items) // (cpu * 16))
+    with ProcessPoolExecutor(
+        max_workers=cpu, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        return list(executor.map(func, items, chunksize=chunksize))
+
+
+def _fingerprint_cache(cache_dir: Path, radius: int, nbits: int) -> Path:
+    return cache_dir / f"ecfp_radius={radius}_nbits={nbits}.parquet"
+
+
+def _read_cache(
+    path: Optional[Path], keys: Iterable[str], column: str
+) -> dict[str, Any]:
+    if path is None or not path.is_file():
+        return {}
+    keys = set(keys)
+    df = pd.read_parquet(path)
+    df = df[df["smiles"].isin(keys)]
+    return dict(zip(df["smiles"], df[column]))
+
+
+def _update_cache(path: Optional[Path], values: dict[str, Any], column: str) -> None:
+    if path is None or not values:
+        return
+    df = pd.DataFrame({"smiles": list(values), column: list(values.values())})
+    if path.is_file():
+        df = pd.concat([pd.read_parquet(path), df]).drop_duplicates(subset="smiles")
+    path.parent.mkdir(exist_ok=True, parents=True)
+    tmp = path.with_suffix(".tmp")
+    df.to_parquet(tmp, index=False)
+    tmp.replace(path)
+    LOG.info(f"updated {path} with {len(values)} new SMILES")
+
+
+def get_inchikeys(
+    smiles: Iterable[str],
+    *,
+    cpu: int = 1,
+    cache_dir: Optional[Path] = None,
+) -> dict[str, Optional[str]]:
+    """
+    Map canonical SMILES to inchikeys, only computing (in processes)
+    the SMILES missing in the cache. The cache is only read here,
+    see update_inchikey_cache.
+
+    Parameters
+    ----------
+    smiles : Iterable[str]
+        canonical SMILES
+    cpu : int, default=1
+        number of processes computing the inchikeys
+    cache_dir : Path, default=None
+        persistent ligand cache, shared across releases
+
+    Returns
+    -------
+    inchikeys : dict[str, Optional[str]]
+        map of SMILES to inchikey (None if it can't be computed)
+    """
+    smiles = list(dict.fromkeys(smiles))
+    path = cache_dir / INCHIKEY_CACHE if cache_dir is not None else None
+    inchikeys = _read_cache(path, smiles, "inchikey")
+    missing = [smi for smi in smiles if smi not in inchikeys]
+    LOG.info(
+        f"get_inchikeys: {len(inchikeys)} cached, computing {len(missing)} inchikeys"
+    )
+    inchikeys.update(
+        zip(missing, _map_processes(smallmolecules.smil2inchikey, missing, cpu))
+    )
+    return inchikeys
+
+
+def update_inchikey_cache(ligands: pd.DataFrame, cache_dir: Path) -> None:
+    """
+    Add the inchikeys of the ligands (see load_ligands_from_entry)
+    that are missing in the persistent ligand cache.
+    """
+    path = cache_dir / INCHIKEY_CACHE
+    ligands = ligands.drop_duplicates(subset="ligand_rdkit_canonical_smiles")
+    cached = _read_cache(path, ligands["ligand_rdkit_canonical_smiles"], "inchikey")
+    new = ligands[~ligands["ligand_rdkit_canonical_smiles"].isin(list(cached))]
+    _update_cache(
+        path,
+        dict(zip(new["ligand_rdkit_canonical_smiles"], new["inchikeys"])),
+        "inchikey",
+    )
+
+
+def get_packed_fingerprints(
+    smiles: list[str],
+    *,
+    radius: int,
+    nbits: int,
+    cpu: int = 1,
+    cache_dir: Optional[Path] = None,
+) -> np.ndarray[Any, Any]:
+    """
+    Compute the packed ECFP fingerprints (see pack_fingerprints) of
+    canonical SMILES in processes, reusing and updating the ones in
+    the persistent ligand cache for the same radius and nbits.
+
+    Parameters
+    ----------
+    smiles : list[str]
+        canonical SMILES
+    radius : int
+        ECFP radius
+    nbits : int
+        ECFP number of bits
+    cpu : int, default=1
+        number of processes computing the fingerprints
+    cache_dir : Path, default=None
+        persistent ligand cache, shared across releases
+
+    Returns
+    -------
+    fingerprints : np.ndarray
+        (len(smiles), ceil(nbits / 64)) packed fingerprints
+    """
+    path = _fingerprint_cache(cache_dir, radius, nbits) if cache_dir else None
+    fingerprints = _read_cache(path, smiles, "fingerprint")
+    missing = list(dict.fromkeys(smi for smi in smiles if smi not in fingerprints))
+    LOG.info(
+        f"computing {len(missing)} ECFP fingerprints with radius={radius} "
+        f"nbits={nbits} ({len(fingerprints)} cached)"
+    )
+    computed = dict(
+        zip(
+            missing,
+            _map_processes(
+                partial(_packed_ecfp_fingerprint, radius=radius, nbits=nbits),
+                missing,
+                cpu,
+            ),
+        )
+    )
+    failed = [smi for smi, fp in computed.items() if fp is None]
+    if failed:
+        raise ValueError(f"found {len(failed)}")
+    _update_cache(path, computed, "fingerprint")
+    fingerprints.update(computed)
+    return np.frombuffer(
+        b"".join(fingerprints[smi] for smi in smiles), dtype="<u8"
+    ).reshape(len(smiles), -(-nbits // 64))
+
+
 def load_ligands_from_entry(
     *,
     entry: "Entry",
     ccd_col: str = "unique_ccd_code",
     smiles_col: str = "rdkit_canonical_smiles",
+    compute_inchikeys: bool = True,
 ) -> Optional[pd.DataFrame]:
     """
     Load ligands from entries for tanimoto similarity calculations
@@ -49,6 +225,9 @@ def load_ligands_from_entry(
         entry attribute where ccd code is fetched
     smiles_col : str
         entry attribute where smiles is fetched
+    compute_inchikeys : bool, default=True
+        add the inchikeys column, callers loading many entries can
+        instead map them once with get_inchikeys
     """
     ligands = []
     for system_id, system in entry.systems.items():
@@ -90,6 +269,8 @@ def load_ligands_from_entry(
         .sort_values(by="ligand_id")
     )
     LOG.info(f"after deduplication {len(df.index)} entries")
+    if not compute_inchikeys:
+        return df
     # aggregate multiple ligands into one:
     df["inchikeys"] = df["ligand_rdkit_canonical_smiles"].map(
         smallmolecules.smil2inchikey
@@ -98,11 +279,20 @@ def load_ligands_from_entry(
 
 
 def compute_ligand_fingerprints(
-    *, data_dir: Path, split_char: str = "__", radius: int = 2, nbits: int = 1024
+    *,
+    data_dir: Path,
+    split_char: str = "__",
+    radius: int = 2,
+    nbits: int = 1024,
+    cpu: int = 1,
+    cache_dir: Optional[Path] = None,
 ) -> None:
     ligands = (
         pd.read_parquet(data_dir / "ligands").drop_duplicates().reset_index(drop=True)
     )
+    if cache_dir is not None:
+        # single writer of the cache read by the make_ligands chunks
+        update_inchikey_cache(ligands, cache_dir)
     for col in ligands.columns:
         nunique = ligands[col].nunique()
         LOG.info(f"compute_ligand_fingerprints: unique {col}={nunique}")
@@ -127,20 +317,21 @@ def compute_ligand_fingerprints(
     output_dir.mkdir(exist_ok=True, parents=True)
     ligands_unique.to_parquet(output_dir / "ligands_per_inchikey.parquet", index=False)
 
-    LOG.info(f"computing ECFP fingerprints with radius={radius} nbits={nbits}")
-    ligands_unique["ECFP4"] = ligands_unique["ligand_rdkit_canonical_smiles"].apply(
-        get_ecfp_fingerprint,
+    ecfp = get_packed_fingerprints(
+        ligands_unique["ligand_rdkit_canonical_smiles"].to_list(),
         radius=radius,
         nbits=nbits,
+        cpu=cpu,
+        cache_dir=cache_dir,
     )
-    if ligands_unique["ECFP4"].isnull().any():
-        raise ValueError(f"found {ligands_unique['ECFP4'].isnull().sum()}")
-
-    ecfp = (
-        np.concatenate(ligands_unique.ECFP4.values).reshape(-1, nbits).astype(np.int8)
+    LOG.info(f"writing {output_dir}/{FINGERPRINTS_FILE}")
+    save_fingerprints(
+        output_dir / FINGERPRINTS_FILE,
+        ecfp,
+        radius=radius,
+        nbits=nbits,
+        id_column="number_id_by_inchikeys",
     )
-    LOG.info(f"writing {output_dir}/ligands_per_inchikey_ecfp4.npy")
-    np.save(output_dir / "ligands_per_inchikey_ecfp4.npy", ecfp)
 
     ligs = pd.merge(
         ligands,
@@ -171,6 +362,206 @@ def compute_ligand_fingerprints(
     ligs.to_parquet(output_dir / "ligands_per_system.parquet", index=False)
 
 
+def pack_fingerprints(fingerprints: np.ndarray[Any, Any]) -> np.ndarray[Any, Any]:
+    """
+    Pack fingerprints holding one byte per bit into 64 bit words.
+
+    Parameters
+    ----------
+    fingerprints : np.ndarray
+        (n_ligands, nbits) array of 0/1 values
+
+    Returns
+    -------
+    packed : np.ndarray
+        (n_ligands, ceil(nbits / 64)) uint64 array
+    """
+    packed = np.packbits(fingerprints.astype(bool), axis=1, bitorder="little")
+    pad = -packed.shape[1] % 8
+    if pad:
+        packed = np.pad(packed, ((0, 0), (0, pad)))
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def save_fingerprints(
+    path: Path,
+    fingerprints: np.ndarray[Any, Any],
+    *,
+    radius: int,
+    nbits: int,
+    id_column: str,
+) -> None:
+    """
+    Write packed fingerprints (see pack_fingerprints) after a small
+    header, so that they can be memory-mapped by load_fingerprints.
+
+    Parameters
+    ----------
+    path : Path
+        fingerprint file
+    fingerprints : np.ndarray
+        (n_ligands, n_words) packed fingerprints, row i is ligand id i
+    radius : int
+        ECFP radius
+    nbits : int
+        ECFP number of bits
+    id_column : str
+        column of ligands_per_inchikey.parquet holding the row of a ligand
+    """
+    header = json.dumps(
+        {
+            "radius": radius,
+            "nbits": nbits,
+            "id_column": id_column,
+            "n_ligands": fingerprints.shape[0],
+            "n_words": fingerprints.shape[1],
+        }
+    ).encode()
+    header = _FP_MAGIC + len(header).to_bytes(4, "little") + header
+    header += b"\0" * (-len(header) % _FP_ALIGN)
+    with path.open("wb") as f:
+        f.write(header)
+        f.write(np.ascontiguousarray(fingerprints, dtype="<u8").tobytes())
+
+
+def load_fingerprints(path: Path) -> tuple[np.ndarray[Any, Any], dict[str, Any]]:
+    """
+    Memory-map the packed fingerprints written by save_fingerprints,
+    concurrent readers on a node share them in the page cache.
+
+    Parameters
+    ----------
+    path : Path
+        fingerprint file
+
+    Returns
+    -------
+    fingerprints : np.ndarray
+        read-only (n_ligands, n_words) packed fingerprints
+    header : dict[str, Any]
+        radius, nbits, id_column, n_ligands and n_words
+    """
+    with path.open("rb") as f:
+        if f.read(len(_FP_MAGIC)) != _FP_MAGIC:
+            raise ValueError(f"{path} is not a fingerprint file")
+        size = int.from_bytes(f.read(4), "little")
+        header: dict[str, Any] = json.loads(f.read(size))
+    offset = len(_FP_MAGIC) + 4 + size
+    offset += -offset % _FP_ALIGN
+    fingerprints = np.memmap(
+        path,
+        dtype="<u8",
+        mode="r",
+        offset=offset,
+        shape=(header["n_ligands"], header["n_words"]),
+    )
+    return fingerprints, header
+
+
+def _popcount(x: np.ndarray[Any, Any]) -> np.ndarray[Any, Any]:
+    # numpy < 2 has no bitwise_count, count the bits of every word in parallel
+    x = x - ((x >> np.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return (x * _H01) >> np.uint64(56)
+
+
+def _tanimoto_block(
+    queries: np.ndarray[Any, Any],
+    targets: np.ndarray[Any, Any],
+    target_counts: np.ndarray[Any, Any],
+    target_block_size: int,
+) -> np.ndarray[Any, Any]:
+    intersection = np.zeros((queries.shape[0], targets.shape[0]), dtype=np.uint64)
+    # one word at a time over target blocks keeps the operands in cache
+    for start in range(0, targets.shape[0], target_block_size):
+        block = targets[start : start + target_block_size]
+        acc = intersection[:, start : start + target_block_size]
+        for word in range(targets.shape[1]):
+            acc += _popcount(queries[:, word, None] & block[None, :, word])
+    query_counts = _popcount(queries).sum(axis=1)
+    union = query_counts[:, None] + target_counts[None, :] - intersection
+    # same as 1 - jaccard distance (two empty fingerprints are identical)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        similarity = 1 - (union - intersection) / union
+    similarity[union == 0] = 1.0
+    return similarity
+
+
+def tanimoto_top_k(
+    queries: np.ndarray[Any, Any],
+    targets: np.ndarray[Any, Any],
+    k: int,
+    threads: int = 1,
+    query_block_size: int = 16,
+    target_block_size: int = 4096,
+) -> tuple[np.ndarray[Any, Any], np.ndarray[Any, Any]]:
+    """
+    Find the k most similar targets of every query by Tanimoto
+    similarity of packed fingerprints (see pack_fingerprints).
+
+    Parameters
+    ----------
+    queries : np.ndarray
+        (n_queries, n_words) packed query fingerprints
+    targets : np.ndarray
+        (n_targets, n_words) packed target fingerprints
+    k : int
+        number of targets to keep per query
+    threads : int, default=1
+        number of threads processing blocks of queries, 0 for all cpus
+    query_block_size : int, default=16
+        number of queries compared to all targets at once
+    target_block_size : int, default=4096
+        number of targets compared to a block of queries at once
+
+    Returns
+    -------
+    indices : np.ndarray
+        (n_queries, min(k, n_targets)) indices of the most similar
+        targets, by decreasing similarity
+    similarities : np.ndarray
+        (n_queries, min(k, n_targets)) Tanimoto similarities
+    """
+    k = min(k, targets.shape[0])
+    # in blocks, targets may be memory-mapped
+    target_counts = np.concatenate(
+        [
+            _popcount(targets[start : start + target_block_size]).sum(axis=1)
+            for start in range(0, targets.shape[0], target_block_size)
+        ]
+        or [np.empty(0, dtype=np.uint64)]
+    )
+
+    def top_k(start: int) -> tuple[np.ndarray[Any, Any], np.ndarray[Any, Any]]:
+        similarity = _tanimoto_block(
+            queries[start : start + query_block_size],
+            targets,
+            target_counts,
+            target_block_size,
+        )
+        if k < targets.shape[0]:
+            indices = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+        else:
+            indices = np.broadcast_to(np.arange(k), similarity.shape)
+        values = np.take_along_axis(similarity, indices, axis=1)
+        order = np.lexsort((indices, -values), axis=1)
+        return (
+            np.take_along_axis(indices, order, axis=1),
+            np.take_along_axis(values, order, axis=1),
+        )
+
+    starts = range(0, queries.shape[0], query_block_size)
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as executor:
+        blocks = list(executor.map(top_k, starts))
+    if not blocks:
+        return np.empty((0, k), dtype=np.int64), np.empty((0, k))
+    return (
+        np.concatenate([indices for indices, _ in blocks]),
+        np.concatenate([values for _, values in blocks]),
+    )
+
+
 def ligand_scores(
     *,
     ligand_ids: list[int],
@@ -179,12 +570,18 @@ def ligand_scores(
     number_id_col: str = "number_id_by_inchikeys",
     save_top_k_similar_ligands: int = 5000,
     multiply_by: int = 100,
+    threads: int = 1,
 ) -> None:
     fp_dir = data_dir / "fingerprints"
     all_ligs_ids = pd.read_parquet(fp_dir / "ligands_per_inchikey.parquet")
     LOG.info(f"ligand_scores: loaded {len(all_ligs_ids.index)} ligands")
-    fingerprints = np.load(fp_dir / "ligands_per_inchikey_ecfp4.npy")
-    LOG.info(f"ligand_scores: loaded {fingerprints.shape[0]} fingerprints")
+    fingerprints, header = load_fingerprints(fp_dir / FINGERPRINTS_FILE)
+    LOG.info(f"ligand_scores: mapped {fingerprints.shape[0]} fingerprints")
+
+    if header["id_column"] != number_id_col:
+        raise ValueError(
+            f"fingerprints are ordered by {header['id_column']}, not {number_id_col}"
+        )
 
     # make sure the shape match and the index is in order
     if fingerprints.shape[0] != len(all_ligs_ids.index):
@@ -194,33 +591,20 @@ def ligand_scores(
     if all_ligs_ids[number_id_col].max() != all_ligs_ids.shape[0] - 1:
         raise ValueError("inconsistency in ligand ids, max index != ids shape!")
 
-    query_ecfp = fingerprints[ligand_ids]
-    # target_list = fingerprints
-    ecfp_distances = cdist(query_ecfp, fingerprints, metric="jaccard")
-    # change to similarity score
-    ecfp_distances = np.array(1 - ecfp_distances)
-
-    # For each i and j, the metric dist(u=XA[i], v=XB[j]) is computed
-    # and stored in the ith, jth entry of ecfp_distances = cdist
-    top_k_indices = np.argsort(ecfp_distances, axis=1)[:, -save_top_k_similar_ligands:][
-        ..., ::-1
-    ]
-
-    table = []
-    for row, cols in enumerate(top_k_indices):
-        LOG.info(f"row {ligand_ids[row]}")
-        query_list = [ligand_ids[row]] * len(cols)
-        target_list = cols
-        tani_topk = (np.round(ecfp_distances[row, cols], 2) * multiply_by).astype(int)
-        single_table = pa.table(
-            [
-                pa.array(query_list),
-                pa.array(target_list),
-                pa.array(tani_topk),
-            ],
-            schema=schemas.TANIMOTO_SCORE_SCHEMA,
-        )
-        table.append(single_table)
-    table = pa.concat_tables(table)
+    top_k_indices, top_k_similarities = tanimoto_top_k(
+        fingerprints[ligand_ids],
+        fingerprints,
+        save_top_k_similar_ligands,
+        threads=threads,
+    )
+    tani_topk = (np.round(top_k_similarities, 2) * multiply_by).astype(int)
+    table = pa.table(
+        [
+            pa.array(np.repeat(ligand_ids, top_k_indices.shape[1])),
+            pa.array(top_k_indices.ravel()),
+            pa.array(tani_topk.ravel()),
+        ],
+        schema=schemas.TANIMOTO_SCORE_SCHEMA,
+    )
     LOG.info(f"writing {output_path}")
     pq.write_table(table, output_path)
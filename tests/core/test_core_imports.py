@@ -0,0 +1,59 @@
+# Copyright (c) 2024, Plinder Development Team
+# Distributed under the terms of the Apache License 2.0
+import subprocess
+import sys
+
+import pytest
+
+HEAVY_MODULES = [
+    "pandas",
+    "duckdb",
+    "google.cloud.storage",
+    "cloudpathlib",
+    "omegaconf",
+]
+# generous budget (in microseconds) to only catch eager heavy imports
+IMPORT_TIME_BUDGET = 500_000
+
+
+def _import_time(module):
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if name.strip() == module:
+            return int(cumulative)
+    raise ValueError(f"{module} not found in importtime output")
+
+
+@pytest.mark.parametrize(
+    "module",
+    [
+        "plinder.core",
+        "plinder.core.scores",
+        "plinder.core.utils.config",
+        "plinder.core.utils.cpl",
+        "plinder.core.utils.gcs",
+        "plinder.core.index.utils",
+        "plinder.core.system.system",
+    ],
+)
+def test_core_lazy_imports(module):
+    code = (
+        f"import sys, {module}; "
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-c", code],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    assert proc.stdout.strip() == ""
+    assert _import_time(module) < IMPORT_TIME_BUDGET
@@ -0,0 +1,79 @@
+# Copyright (c) 2024, Plinder Development Team
+# Distributed under the terms of the Apache License 2.0
+import pytest
+
+from plinder.core.utils import profiling
+from plinder.core.utils.dec import timeit
+
+
+@timeit
+def _work(n):
+    with profiling.span("inner", n=n) as span:
+        span.add(items=n)
+        return sum(range(n))
+
+
+@timeit
+def _fail():
+    raise RuntimeError("boom")
+
+
+@pytest.fixture
+def profiled(tmp_path):
+    profiling.enable(format="parquet", root=tmp_path, run_id="test")
+    yield tmp_path
+    profiling.disable()
+
+
+def test_span_disabled():
+    assert not profiling.enabled()
+    with profiling.span("noop") as span:
+        span.add(items=1)
+    assert profiling.run_dir() is None
+
+
+def test_span_nesting(profiled):
+    with profiling.span("stage"):
+        with profiling.span("chunk", index=0):
+            _work(10)
+    df = profiling.read_spans(profiling.run_dir()).set_index("name")
+    assert set(df.index) == {"stage", "chunk", f"{__name__}._work", "inner"}
+    assert df.loc["inner", "path"] == f"stage/chunk/{__name__}._work/inner"
+    assert df.loc["inner", "items"] == 10
+    assert df.loc["inner", "depth"] == 3
+    assert df.loc["chunk", "parent_id"] == df.loc["stage", "span_id"]
+    assert (df["wall_s"] >= 0).all()
+    assert (df["process_peak_rss_mb"] > 0).all()
+
+
+def test_span_failure(profiled):
+    with pytest.raises(RuntimeError):
+        _fail()
+    df = profiling.read_spans(profiling.run_dir())
+    assert df["status"].tolist() == ["failed"]
+
+
+def test_span_export_parquet(profiled):
+    _work(5)
+    profiling.disable()
+    assert (profiled / "test.parquet").is_file()
+
+
+def _slow_len(chunk):
+    from time import sleep
+
+    sleep(0.2)
+    return len(chunk)
+
+
+@pytest.mark.parametrize("kind, func", [("thread", _slow_len), ("process", len)])
+def test_chunk_spans_attach_to_stage(profiled, kind, func):
+    from plinder.data.pipeline import executor
+
+    with profiling.span("stage"):
+        executor.run_chunks(func, [[1], [2], [3], [4]], kind=kind, max_workers=4)
+    df = profiling.read_spans(profiling.run_dir())
+    stage_id = df.loc[df["name"] == "stage", "span_id"].item()
+    assert (df["name"] == "chunk").sum() == 4
+    # concurrent chunks do not attach to each other
+    assert (df.loc[df["name"] == "chunk", "parent_id"] == stage_id).all()
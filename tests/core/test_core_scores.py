@@ -49,6 +49,42 @@ def test_query_protein_similarity_raises(read_plinder_mount):
         )
 
 
+def test_query_protein_similarity_wide(read_plinder_mount):
+    filters = [
+        ("metric", "==", "pocket_lddt"),
+        ("similarity", ">=", 90),
+    ]
+    columns = ["query_system", "target_system", "metric", "similarity"]
+    long = scores.query_protein_similarity(
+        search_db="holo", filters=filters, columns=columns
+    )
+    wide = scores.query_protein_similarity(
+        search_db="holo", filters=filters, columns=columns, layout="wide"
+    )
+    assert len(wide.index)
+    assert set(wide["metric"]) == {"pocket_lddt"}
+    keys = ["query_system", "target_system"]
+    assert (
+        long.sort_values(keys).astype(str).values.tolist()
+        == wide.sort_values(keys).astype(str).values.tolist()
+    )
+
+
+def test_query_protein_similarity_wide_raises(read_plinder_mount):
+    with pytest.raises(ValueError):
+        scores.query_protein_similarity(
+            search_db="holo",
+            filters=[("metric", ">", "pocket_lddt")],
+            layout="wide",
+        )
+    with pytest.raises(ValueError):
+        scores.query_protein_similarity(
+            search_db="holo",
+            filters=[("mapping", "==", "A:B")],
+            layout="wide",
+        )
+
+
 def test_query_ligand_similarity(read_plinder_mount):
 
     df = scores.query_ligand_similarity(
@@ -0,0 +1,180 @@
+# Copyright (c) 2024, Plinder Development Team
+# Distributed under the terms of the Apache License 2.0
+import os
+
+from omegaconf import OmegaConf
+
+from plinder.data.pipeline import cache, pipeline
+
+
+def _touch(path, contents="x"):
+    path.parent.mkdir(exist_ok=True, parents=True)
+    path.write_text(contents)
+
+
+def test_fingerprint_paths(tmp_path):
+    _touch(tmp_path / "a" / "1.txt")
+    first = cache.fingerprint_paths(tmp_path, ["a", "b"])
+    assert first == cache.fingerprint_paths(tmp_path, ["b", "a"])
+    _touch(tmp_path / "b")
+    assert first != cache.fingerprint_paths(tmp_path, ["a", "b"])
+
+
+def test_fingerprint_paths_hash_files(tmp_path):
+    path = tmp_path / "a.txt"
+    _touch(path, "abc")
+    stat = path.stat()
+    stat_only = cache.fingerprint_paths(tmp_path, ["a.txt"])
+    hashed = cache.fingerprint_paths(tmp_path, ["a.txt"], hash_files=True)
+    _touch(path, "xyz")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert stat_only == cache.fingerprint_paths(tmp_path, ["a.txt"])
+    assert hashed != cache.fingerprint_paths(tmp_path, ["a.txt"], hash_files=True)
+
+
+def test_stage_cache(tmp_path):
+    cfg = OmegaConf.create({"annotation": {"a": 1}, "entry": {}})
+    chunk = ["pdb_00001abc"]
+    _touch(tmp_path / "ingest" / "ab" / "pdb_00001abc" / "1abc.cif")
+    stage_cache = cache.StageCache(data_dir=tmp_path, stage="make_entries", cfg=cfg)
+    assert not stage_cache.is_fresh(chunk)
+    _touch(tmp_path / "raw_entries" / "ab" / "1abc.json")
+    stage_cache.record(chunk)
+    assert stage_cache.is_fresh(chunk)
+    assert not stage_cache.is_fresh(["pdb_00001abd"])
+
+    reloaded = cache.StageCache(data_dir=tmp_path, stage="make_entries", cfg=cfg)
+    assert reloaded.is_fresh(chunk)
+
+    cfg.annotation.a = 2
+    changed = cache.StageCache(data_dir=tmp_path, stage="make_entries", cfg=cfg)
+    assert not changed.is_fresh(chunk)
+
+    (tmp_path / "raw_entries" / "ab" / "1abc.json").unlink()
+    assert not reloaded.is_fresh(chunk)
+
+
+def test_stage_cache_entry_systems(tmp_path):
+    cfg = OmegaConf.create({"annotation": {}, "entry": {}})
+    chunk = ["pdb_00001abc"]
+    _touch(tmp_path / "ingest" / "ab" / "pdb_00001abc" / "1abc.cif")
+    _touch(tmp_path / "raw_entries" / "ab" / "1abc.json")
+    system_dir = tmp_path / "raw_entries" / "ab" / "1abc__1__1.A__1.B"
+    _touch(system_dir / "system.cif")
+    _touch(tmp_path / "raw_entries" / "ab" / "1abc__1__1.A__1.C" / "system.cif")
+    stage_cache = cache.StageCache(data_dir=tmp_path, stage="make_entries", cfg=cfg)
+    stage_cache.record(chunk)
+    assert stage_cache.is_fresh(chunk)
+    # the entry is rerun if one of its systems is missing
+    (system_dir / "system.cif").unlink()
+    system_dir.rmdir()
+    assert not stage_cache.is_fresh(chunk)
+
+
+def test_stage_cache_config_outputs(tmp_path):
+    dst_dir = tmp_path / "elsewhere" / "collated"
+    cfg = OmegaConf.create({"collate": {"dst_dir": str(dst_dir)}})
+    _touch(tmp_path / "scores" / "search_db=holo" / "a.parquet")
+    _touch(dst_dir / "search_db=holo" / "metric=x" / "a.parquet")
+    stage_cache = cache.StageCache(
+        data_dir=tmp_path, stage="collate_partitions", cfg=cfg
+    )
+    stage_cache.record()
+    assert stage_cache.is_fresh()
+    # a deleted collated dataset is rebuilt
+    (dst_dir / "search_db=holo" / "metric=x" / "a.parquet").unlink()
+    assert not stage_cache.is_fresh()
+
+
+def test_stage_cache_undeclared_stage(tmp_path):
+    stage_cache = cache.StageCache(
+        data_dir=tmp_path, stage="make_splits", cfg=OmegaConf.create({})
+    )
+    assert not stage_cache.enabled
+    stage_cache.record()
+    assert not stage_cache.is_fresh()
+    assert not (tmp_path / "cache").exists()
+
+
+def test_run_stage_skips_unchanged_chunks(tmp_path):
+    pipe = pipeline.IngestPipeline(
+        config_args=["ingest.cache_stages=true"], cached=False
+    )
+    pipe.plinder_dir = tmp_path
+    for pdb_id in ["1abc", "2abc"]:
+        _touch(tmp_path / "ingest" / "ab" / f"pdb_0000{pdb_id}" / f"{pdb_id}.cif")
+    computed = []
+
+    def make_entries(pdb_dirs):
+        computed.append(pdb_dirs)
+        for pdb_dir in pdb_dirs:
+            if pdb_dir.endswith("2abc"):
+                return pdb_dirs
+            _touch(tmp_path / "raw_entries" / "ab" / f"{pdb_dir[-4:]}.json")
+        return []
+
+    pipe.scatter_make_entries = lambda: [["pdb_00001abc"], ["pdb_00002abc"]]
+    pipe.make_entries = make_entries
+    pipe.run_stage("make_entries")
+    pipe.run_stage("make_entries")
+    # the failed chunk is retried, the successful one is not
+    assert computed == [["pdb_00001abc"], ["pdb_00002abc"], ["pdb_00002abc"]]
+
+
+def test_run_stage_skips_rebalanced_chunks(tmp_path):
+    from plinder.data.pipeline import tasks, utils
+
+    pipe = pipeline.IngestPipeline(
+        config_args=[
+            "ingest.cache_stages=true",
+            "scatter.balance_chunks=true",
+            "scatter.annotation_batch_size=2",
+            "scatter.skip_existing_entries=false",
+        ],
+        cached=False,
+    )
+    pipe.plinder_dir = tmp_path
+    pdb_ids = ["1abc", "2abc", "3abc", "4abc"]
+    for pdb_id, size in zip(pdb_ids, [40, 30, 20, 10]):
+        _touch(
+            tmp_path / "ingest" / "ab" / f"pdb_0000{pdb_id}" / f"{pdb_id}.cif",
+            "x" * size,
+        )
+    computed = []
+
+    def make_entries(pdb_dirs):
+        computed.append(pdb_dirs)
+        for pdb_dir in pdb_dirs:
+            _touch(tmp_path / "raw_entries" / "ab" / f"{pdb_dir[-4:]}.json")
+        return []
+
+    def scatter():
+        return tasks.scatter_make_entries(
+            data_dir=tmp_path,
+            batch_size=2,
+            two_char_codes=[],
+            pdb_ids=[],
+            wipe_entries=False,
+            wipe_annotations=False,
+            skip_existing_entries=False,
+            skip_missing_annotations=False,
+            balance=True,
+        )
+
+    first = scatter()
+    pipe.scatter_make_entries = scatter
+    pipe.make_entries = make_entries
+    pipe.run_stage("make_entries")
+    assert len(computed) == 2
+    # new telemetry regroups the balanced chunks
+    utils.save_task_telemetry(
+        data_dir=tmp_path,
+        stage="make_entries",
+        records=[
+            {"pdb_id": pdb_id, "wall_s": wall, "cif_bytes": 0}
+            for pdb_id, wall in zip(pdb_ids, [1.0, 40.0, 30.0, 20.0])
+        ],
+    )
+    assert scatter() != first
+    pipe.run_stage("make_entries")
+    assert len(computed) == 2
@@ -0,0 +1,75 @@
+# Copyright (c) 2024, Plinder Development Team
+# Distributed under the terms of the Apache License 2.0
+import pytest
+
+from plinder.data.pipeline import config, executor
+
+
+def _fail_on_three(chunk):
+    if 3 in chunk:
+        raise ValueError("three")
+    return sum(chunk)
+
+
+@pytest.mark.parametrize("kind", ["serial", "thread", "process"])
+def test_run_chunks_preserves_order(kind):
+    chunks = [[i, i] for i in range(10)]
+    outs = executor.run_chunks(sum, chunks, kind=kind, max_workers=3)
+    assert outs == [2 * i for i in range(10)]
+
+
+@pytest.mark.parametrize("kind", ["serial", "thread"])
+def test_run_chunks_raises(kind):
+    with pytest.raises(ValueError):
+        executor.run_chunks(
+            _fail_on_three, [[1], [2], [3], [4]], kind=kind, max_workers=2
+        )
+
+
+def test_run_chunks_memory_throttle(monkeypatch):
+    monkeypatch.setattr(executor, "get_available_memory_gb", lambda: 0.0)
+    outs = executor.run_chunks(
+        sum,
+        [[1], [2], [3]],
+        kind="thread",
+        max_workers=2,
+        min_available_memory_gb=1.0,
+        poll_interval=0.01,
+    )
+    assert outs == [1, 2, 3]
+
+
+def test_run_chunks_invalid_kind():
+    with pytest.raises(ValueError):
+        executor.run_chunks(sum, [[1]], kind="dask")
+
+
+@pytest.mark.parametrize("value, expected, raises", [
+    ("", {}, False),
+    ("make_entries:16,structure_qc:2", {"make_entries": 16, "structure_qc": 2}, False),
+    ("make_entries", None, True),
+])
+def test_executor_config(value, expected, raises):
+    if raises:
+        with pytest.raises(ValueError):
+            config.ExecutorConfig(stage_max_workers=value)
+    else:
+        assert config.ExecutorConfig(stage_max_workers=value).stage_max_workers == expected
+
+
+def test_executor_config_kind():
+    with pytest.raises(ValueError):
+        config.ExecutorConfig(kind="dask")
+
+
+@pytest.mark.parametrize("kind", ["serial", "thread"])
+def test_run_chunks_on_done(kind):
+    done = {}
+    executor.run_chunks(
+        sum,
+        [[i] for i in range(5)],
+        kind=kind,
+        max_workers=2,
+        on_done=lambda index, out: done.__setitem__(index, out),
+    )
+    assert done == {i: i for i in range(5)}
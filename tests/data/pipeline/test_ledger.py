@@ -0,0 +1,89 @@
+# Copyright (c) 2024, Plinder Development Team
+# Distributed under the terms of the Apache License 2.0
+import pytest
+
+from plinder.data.pipeline import ledger, pipeline
+
+
+def test_run_ledger(tmp_path):
+    run_ledger = ledger.RunLedger(tmp_path / "run.sqlite")
+    chunks = [["a", "b"], ["c"], ["d"]]
+    assert run_ledger.stage_status("make_entries") is None
+    run_ledger.register("make_entries", chunks)
+    assert run_ledger.stage_status("make_entries") == "running"
+    assert run_ledger.chunks("make_entries", pending=True) == chunks
+
+    run_ledger.start("make_entries", 1, ["c"])
+    run_ledger.finish("make_entries", 1, ["c"], output=[])
+    run_ledger.start("make_entries", 2, ["d"])
+    run_ledger.finish("make_entries", 2, ["d"], status="failed", output=["d"])
+    run_ledger.close()
+
+    run_ledger = ledger.RunLedger(tmp_path / "run.sqlite")
+    run_ledger.register("make_entries", chunks)
+    assert run_ledger.chunks("make_entries") == chunks
+    assert run_ledger.chunks("make_entries", pending=True) == [["a", "b"], ["d"]]
+    assert run_ledger.outputs("make_entries") == [[], ["d"]]
+    summary = {row["status"]: row for row in run_ledger.summary()}
+    assert summary["pending"]["items"] == 2
+    assert summary["failed"]["attempts"] == 1
+    with pytest.raises(ValueError):
+        run_ledger.finish("make_entries", 2, ["d"], status="done")
+    # the content hash validates the position
+    with pytest.raises(ValueError):
+        run_ledger.start("make_entries", 2, ["c"])
+
+
+def test_run_ledger_identical_chunks(tmp_path):
+    run_ledger = ledger.RunLedger(tmp_path / "run.sqlite")
+    chunks = [["a"], ["a"], ["b"]]
+    run_ledger.register("make_entries", chunks)
+    assert run_ledger.chunks("make_entries") == chunks
+    run_ledger.start("make_entries", 1, ["a"])
+    run_ledger.finish("make_entries", 1, ["a"], output=["a"])
+    assert run_ledger.positioned_chunks("make_entries", pending=True) == [
+        (0, ["a"]),
+        (2, ["b"]),
+    ]
+    assert run_ledger.outputs("make_entries") == [["a"]]
+    # a different scatter resets the chunks that changed
+    run_ledger.register("make_entries", [["a"], ["c"]])
+    assert run_ledger.positioned_chunks("make_entries", pending=True) == [
+        (0, ["a"]),
+        (1, ["c"]),
+    ]
+    assert run_ledger.outputs("make_entries") == []
+
+
+def test_run_stage_resumes(tmp_path):
+    pipe = pipeline.IngestPipeline(config_args=["ingest.run_id=test"], cached=False)
+    pipe.plinder_dir = tmp_path
+    scattered = []
+    computed = []
+    joined = []
+
+    def scatter_make_entries():
+        scattered.append(True)
+        return [["pdb_00001abc"], ["pdb_00002abc"], ["pdb_00003abc"]]
+
+    def make_entries(pdb_dirs):
+        computed.append(pdb_dirs[0])
+        if pdb_dirs[0].endswith("2abc") and len(computed) < 3:
+            raise RuntimeError("segfault")
+        return pdb_dirs if pdb_dirs[0].endswith("3abc") else []
+
+    pipe.scatter_make_entries = scatter_make_entries
+    pipe.make_entries = make_entries
+    pipe.join_make_entries = joined.append
+    with pytest.raises(RuntimeError):
+        pipe.run_stage("make_entries")
+    assert computed == ["pdb_00001abc", "pdb_00002abc"]
+
+    pipe.run_stage("make_entries")
+    assert len(scattered) == 1
+    assert computed[2:] == ["pdb_00002abc", "pdb_00003abc"]
+    assert joined == [[[], [], ["pdb_00003abc"]]]
+
+    # the last chunk returned failures so it is retried
+    pipe.run_stage("make_entries")
+    assert computed[4:] == ["pdb_00003abc"]
@@ -0,0 +1,49 @@
+# Copyright (c) 2024, Plinder Development Team
+# Distributed under the terms of the Apache License 2.0
+from plinder.data.pipeline.mpqueue import Task, WorkerPool
+
+
+def test_worker_pool():
+    tasks = [{"obj": i} for i in range(5)] + [{"s": "{"}]
+    pool = WorkerPool(target="json:dumps", num_workers=2, maxtasksperchild=2)
+    results = pool.run(tasks)
+    assert [result.index for result in results] == list(range(6))
+    assert [result.status for result in results] == ["succeeded"] * 5 + ["failed"]
+    assert "TypeError" in results[-1].error
+
+
+def test_worker_pool_respawns_crashed_workers():
+    pool = WorkerPool(target="os:abort", num_workers=1)
+    results = pool.run([{}, {}])
+    assert [result.status for result in results] == ["crashed", "crashed"]
+    assert all(result.exitcode < 0 for result in results)
+
+
+def test_worker_pool_longest_first(tmp_path):
+    log = tmp_path / "log.txt"
+    tasks = [{"args": ["sh", "-c", f"echo {i} >> {log}"]} for i in range(4)]
+    pool = WorkerPool(target="subprocess:run", num_workers=1)
+    pool.run(tasks, costs=[1, 3, 0, 2])
+    assert log.read_text().split() == ["1", "3", "0", "2"]
+
+
+def test_worker_pool_timeout():
+    tasks = [{"args": ["sleep", "5"]}, {"args": ["true"]}]
+    pool = WorkerPool(target="subprocess:run", num_workers=1, timeout=0.5)
+    results = pool.run(tasks)
+    assert [result.status for result in results] == ["timeout", "succeeded"]
+    assert results[0].wall_s < 5
+
+
+def test_task_from_line():
+    task = Task.from_line("12.5\tmmpdb fragment x.smi")
+    assert (task.cost, task.command) == (12.5, "mmpdb fragment x.smi")
+    task = Task.from_line("echo a\tb")
+    assert (task.cost, task.command) == (0.0, "echo a\tb")
+
+
+def test_worker_pool_telemetry():
+    tasks = [{"args": ["python", "-c", "sum(range(10**6))"]}]
+    [result] = WorkerPool(target="subprocess:run", num_workers=1).run(tasks)
+    assert result.cpu_s > 0
+    assert result.peak_rss_mb > 0
@@ -14,3 +14,21 @@ ingest:
     print("in test", conf.as_posix())
     pipe = pipeline.IngestPipeline(config_file=conf.as_posix(), config_args=[], cached=False)
     pipe.run()
+
+
+def test_pipeline_lazy_imports():
+    import subprocess
+    import sys
+
+    heavy = ["ost", "rdkit", "networkit"]
+    code = (
+        "import sys, plinder.data.pipeline.pipeline; "
+        f"print(','.join(m for m in {heavy!r} if m in sys.modules))"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-c", code],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    assert proc.stdout.strip() == ""
@@ -34,3 +34,142 @@ def test_download_rcsb_files(tmp_path):
     io.rsync_rcsb = lambda *args, **kws: None
     tasks.download_rcsb_files(data_dir=tmp_path, two_char_codes=["aa"])
     io.rsync_rcsb = _orig_rsync_rcsb
+
+
+def test_scatter_structure_qc_balanced(tmp_path):
+    for code, size in [("aa", 100), ("bb", 90), ("cc", 10), ("dd", 10)]:
+        (tmp_path / "raw_entries" / code).mkdir(parents=True)
+        (tmp_path / "raw_entries" / code / "1xyz.json").write_text("x" * size)
+    chunks = tasks.scatter_structure_qc(
+        data_dir=tmp_path, two_char_codes=[], batch_size=2, balance=True
+    )
+    assert chunks == [["aa", "dd"], ["bb", "cc"]]
+    chunks = tasks.scatter_structure_qc(
+        data_dir=tmp_path, two_char_codes=[], batch_size=2
+    )
+    assert chunks == [["aa", "bb"], ["cc", "dd"]]
+
+
+@pytest.mark.parametrize("cpu", [1, 2])
+def test_structure_qc_records_invalid_entries(cpu, tmp_path):
+    entry_dir = tmp_path / "raw_entries" / "bc"
+    entry_dir.mkdir(parents=True)
+    for pdb_id in ["1abc", "2abc"]:
+        (entry_dir / f"{pdb_id}.json").write_text("{not json")
+    tasks.structure_qc(data_dir=tmp_path, two_char_codes=["bc"], cpu=cpu)
+    fails = (tmp_path / "qc" / "logs" / "bc_qc_fails.csv").read_text().splitlines()
+    assert len(fails) == 3
+    assert (tmp_path / "entries" / "bc.zip").is_file()
+    assert not (tmp_path / "qc" / "index" / "bc.parquet").exists()
+
+
+@pytest.mark.parametrize("cpu", [1, 2])
+def test_make_system_archives(cpu, tmp_path):
+    import gzip
+    from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+    import pandas as pd
+
+    for code in ["ab", "cd"]:
+        system_dir = tmp_path / "raw_entries" / code / f"1{code}x__1__1.A__1.B"
+        system_dir.mkdir(parents=True)
+        (system_dir / "system.cif").write_text("data_" * 100)
+        (system_dir / "system.cif.gz").write_bytes(gzip.compress(b"data_" * 100))
+    tasks.make_system_archives(data_dir=tmp_path, two_char_codes=["ab", "cd"], cpu=cpu)
+    archive = tmp_path / "archives" / "ab.zip"
+    index = pd.read_parquet(tmp_path / "archives" / "ab.index.parquet")
+    assert set(index.system_id) == {"1abx__1__1.A__1.B"}
+    with ZipFile(archive) as zip_archive:
+        compress_types = {
+            info.filename: info.compress_type for info in zip_archive.infolist()
+        }
+        assert zip_archive.read("1abx__1__1.A__1.B/system.cif") == b"data_" * 100
+        # members deflated by the workers carry the CRC of the original file
+        assert zip_archive.testzip() is None
+    assert compress_types == {
+        "1abx__1__1.A__1.B/system.cif": ZIP_DEFLATED,
+        "1abx__1__1.A__1.B/system.cif.gz": ZIP_STORED,
+    }
+    assert dict(zip(index.member, index.compress_type)) == compress_types
+    with archive.open("rb") as f:
+        for offset in index.header_offset:
+            f.seek(offset)
+            assert f.read(4) == b"PK\x03\x04"
+
+
+def test_collate_partitions_incremental(tmp_path):
+    import pandas as pd
+
+    batch_dir = tmp_path / "scores" / "search_db=holo"
+    batch_dir.mkdir(parents=True)
+
+    def write_batch(name, n):
+        pd.DataFrame(
+            {
+                "query_system": [f"{name}_{i}" for i in range(n)],
+                "metric": ["pli_qcov", "protein_lddt"] * (n // 2),
+                "similarity": list(range(n)),
+            }
+        ).to_parquet(batch_dir / f"{name}.parquet", index=False)
+
+    def collated():
+        return pd.read_parquet(tmp_path / "out" / "search_db=holo")
+
+    write_batch("a", 4)
+    tasks.collate_partitions(data_dir=tmp_path, dst_dir="out", memory_limit="1GB")
+    assert len(collated()) == 4
+    write_batch("b", 2)
+    tasks.collate_partitions(data_dir=tmp_path, dst_dir="out", compact_min_files=2)
+    assert sorted(collated().query_system) == ["a_0", "a_1", "a_2", "a_3", "b_0", "b_1"]
+    assert len(list((tmp_path / "out" / "search_db=holo").glob("*/*.parquet"))) == 2
+    # a collated batch file changed so the search_db is rebuilt
+    write_batch("a", 2)
+    tasks.collate_partitions(data_dir=tmp_path, dst_dir="out")
+    assert sorted(collated().query_system) == ["a_0", "a_1", "b_0", "b_1"]
+    assert not list((tmp_path / "out").glob(".*"))
+
+
+def test_compact_partitions_recovers_from_crash(tmp_path):
+    import duckdb
+    import pandas as pd
+
+    batch_dir = tmp_path / "scores" / "search_db=holo"
+    batch_dir.mkdir(parents=True)
+    for name in ["a", "b"]:
+        pd.DataFrame(
+            {"query_system": [f"{name}_0"], "metric": ["pli_qcov"], "similarity": [1]}
+        ).to_parquet(batch_dir / f"{name}.parquet", index=False)
+        tasks.collate_partitions(data_dir=tmp_path, dst_dir="out")
+    partition_dir = tmp_path / "out" / "search_db=holo"
+    partition = partition_dir / "metric=pli_qcov"
+    parts = sorted(partition.glob("*.parquet"))
+    assert len(parts) == 2
+
+    # crash after moving the compacted file in place but before the unlinks
+    unlink = tasks.Path.unlink
+
+    def crash(path, *args, **kwargs):
+        if path in parts:
+            raise KeyboardInterrupt
+        return unlink(path, *args, **kwargs)
+
+    tasks.Path.unlink = crash
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            tasks.compact_partitions(
+                duckdb.connect(),
+                partition_dir=partition_dir,
+                min_files=2,
+                row_group_size=100,
+            )
+    finally:
+        tasks.Path.unlink = unlink
+    assert len(list(partition.glob("*.parquet"))) == 3
+    assert (partition / "_compaction.json").is_file()
+
+    tasks.collate_partitions(data_dir=tmp_path, dst_dir="out")
+    assert [p.name for p in partition.glob("*.parquet")][0].startswith("compacted_")
+    assert len(list(partition.glob("*.parquet"))) == 1
+    assert not (partition / "_compaction.json").exists()
+    collated = pd.read_parquet(partition_dir)
+    assert sorted(collated.query_system) == ["a_0", "b_0"]
@@ -166,3 +166,104 @@ def test_get_local_contents_pdb_ids(tmp_path):
     b.write_text(_ENTRY(pdb_id="bbbb"))
     contents = utils.get_local_contents(data_dir=tmp_path, as_four_char_ids=True)
     assert contents == ["aaaa", "bbbb"]
+
+
+def test_task_telemetry(tmp_path):
+    assert utils.load_task_telemetry(data_dir=tmp_path, stage="make_entries").empty
+    assert utils.save_task_telemetry(
+        data_dir=tmp_path, stage="make_entries", records=[]
+    ) is None
+    for wall_s in [1.0, 2.0]:
+        utils.save_task_telemetry(
+            data_dir=tmp_path,
+            stage="make_entries",
+            records=[
+                {"pdb_id": "1abc", "status": "succeeded", "wall_s": wall_s},
+                {"pdb_id": f"{int(wall_s)}xyz", "status": "crashed", "wall_s": 0.5},
+            ],
+        )
+    df = utils.load_task_telemetry(data_dir=tmp_path, stage="make_entries")
+    assert sorted(df["pdb_id"]) == ["1abc", "1xyz", "2xyz"]
+    assert df.set_index("pdb_id").loc["1abc", "wall_s"] == 2.0
+
+
+def test_balance_chunks():
+    items = ["a", "b", "c", "d", "e", "f"]
+    chunks = utils.balance_chunks(items, [10, 1, 1, 1, 1, 6], batch_size=2)
+    assert len(chunks) == 3
+    assert sorted(sum(chunks, [])) == items
+    assert ["a"] in chunks
+    assert utils.balance_chunks([], [], batch_size=2) == []
+    # zero costs still spread evenly by count
+    assert [len(c) for c in utils.balance_chunks(items, [0] * 6, batch_size=2)] == [2, 2, 2]
+    with pytest.raises(ValueError):
+        utils.balance_chunks(items, [1], batch_size=2)
+
+
+def test_partition_batch_scores(tmp_path):
+    import pandas as pd
+
+    scores_dir = tmp_path / "scores"
+    scores_dir.mkdir()
+    for i in range(2):
+        pd.DataFrame(
+            {
+                "query_system": [f"q{i}"] * 3,
+                "target_system": ["t"] * 3,
+                "protein_mapping": ["A:A"] * 3,
+                "mapping": ["A:A"] * 3,
+                "protein_mapper": ["foldseek"] * 3,
+                "source": ["both"] * 3,
+                "metric": ["pli_qcov", "pli_qcov", "protein_lddt"],
+                "similarity": [50, 60, 50],
+            }
+        ).to_parquet(scores_dir / f"{i}.parquet", index=False)
+    partition_dir = tmp_path / "partitions"
+    utils.partition_batch_scores(partition_dir=partition_dir, scores_dir=scores_dir)
+    assert sorted(
+        p.parent.relative_to(partition_dir).as_posix()
+        for p in partition_dir.rglob("*.parquet")
+    ) == [
+        "metric=pli_qcov/similarity=50",
+        "metric=pli_qcov/similarity=60",
+        "metric=protein_lddt/similarity=50",
+    ]
+    assert len(pd.read_parquet(partition_dir)) == 6
+
+
+def test_create_nonredundant_dataset(tmp_path):
+    import pandas as pd
+
+    qc_dir = tmp_path / "qc" / "index"
+    qc_dir.mkdir(parents=True)
+    trainable = {
+        "ligand_is_invalid": False,
+        "ligand_is_artifact": False,
+        "ligand_is_ion": False,
+        "ligand_passes_valence_checks": True,
+        "ligand_sanitization": True,
+        "ligand_passes_kekulization": True,
+        "ligand_mol_pred_loaded": True,
+        "system_num_ligand_chains": 1,
+        "ligand_rdkit_canonical_smiles": "C",
+        "pli_qcov__100__strong__component": "c1",
+    }
+    pd.DataFrame(
+        [
+            {**trainable, "system_id_no_biounit": "1abc", "system_biounit_id": "2"},
+            {**trainable, "system_id_no_biounit": "1abc", "system_biounit_id": "1"},
+            {**trainable, "system_id_no_biounit": "2abc", "system_biounit_id": "1",
+             "ligand_is_ion": True},
+        ]
+    ).to_parquet(qc_dir / "ab.parquet", index=False)
+    pd.DataFrame(
+        [{**trainable, "system_id_no_biounit": "3abc", "system_biounit_id": "1"}]
+    ).to_parquet(qc_dir / "bc.parquet", index=False)
+    utils.create_nonredundant_dataset(data_dir=tmp_path)
+    index_dir = tmp_path / "index"
+    assert len(pd.read_parquet(index_dir / "annotation_table.parquet")) == 4
+    df = pd.read_parquet(index_dir / "annotation_table_nonredundant.parquet")
+    assert sorted(zip(df.uniqueness, df.system_biounit_id)) == [
+        ("1abc_c1", "1"),
+        ("3abc_c1", "1"),
+    ]
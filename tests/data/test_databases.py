@@ -0,0 +1,69 @@
+# Copyright (c) 2024, Plinder Development Team
+# Distributed under the terms of the Apache License 2.0
+from plinder.data import databases
+
+
+def test_make_sub_dbs_from_full_db(tmp_path, monkeypatch):
+    commands = []
+    monkeypatch.setattr(databases, "run", commands.append)
+    full_db = tmp_path / "mmseqs" / "mmseqs"
+    full_db.parent.mkdir()
+    lookup = "0\t1abc_A\t0\n1\t1abc_B\t0\n2\t2abc_A\t1\n3\tNA\t2\n"
+    (full_db.parent / "mmseqs.lookup").write_text(lookup)
+    holo = tmp_path / "holo_mmseqs"
+    apo = tmp_path / "apo_mmseqs"
+    holo.mkdir()
+    apo.mkdir()
+    report = databases.make_sub_dbs_from_full_db(
+        {holo: {"2abc_A", "1abc_A", "9xyz_A"}, apo: {"NA"}}, full_db, "mmseqs"
+    )
+    assert report == {"holo_mmseqs": ["9xyz_A"], "apo_mmseqs": []}
+    assert (holo / "ids.tsv").read_text() == "0\t1abc_A\t0\n2\t2abc_A\t1\n"
+    assert (apo / "ids.tsv").read_text() == "3\tNA\t2\n"
+    assert [cmd[1] for cmd in commands] == ["createsubdb", "createsubdb"]
+    # the persisted index is reused and rebuilt when the lookup changes
+    assert (full_db.parent / "mmseqs.lookup.parquet").is_file()
+    databases._LOOKUP_INDEXES.clear()
+    assert databases.make_sub_db({"1abc_B"}, full_db, holo, "mmseqs") == []
+    assert (holo / "ids.tsv").read_text() == "1\t1abc_B\t0\n"
+
+
+def test_make_sub_dbs_create_index(tmp_path, monkeypatch):
+    commands = []
+    monkeypatch.setattr(databases, "run", commands.append)
+    monkeypatch.setattr(databases, "get_db_ids", lambda *args: set())
+    monkeypatch.setattr(
+        databases, "make_sub_dbs_from_full_db", lambda sub_db_ids, *args: {}
+    )
+    db_sources = {
+        "holo_mmseqs": tmp_path / "mmseqs",
+        "apo_foldseek": tmp_path / "foldseek",
+    }
+    databases.make_sub_dbs(tmp_path / "subdbs", db_sources, {}, create_index=True)
+    holo, apo = (
+        tmp_path / "subdbs" / "holo_mmseqs",
+        tmp_path / "subdbs" / "apo_foldseek",
+    )
+    # the index is built with the prefilter parameters of the searches
+    assert commands == [
+        [
+            "mmseqs",
+            "createindex",
+            str(holo / "holo_mmseqs"),
+            str(holo / "tmp_index"),
+            "-s",
+            "11.0",
+            "--max-seqs",
+            "5000",
+        ],
+        [
+            "foldseek",
+            "createindex",
+            str(apo / "apo_foldseek"),
+            str(apo / "tmp_index"),
+            "-s",
+            "11.0",
+            "--max-seqs",
+            "5000",
+        ],
+    ]
@@ -1,6 +1,7 @@
 # Copyright (c) 2024, Plinder Development Team
 # Distributed under the terms of the Apache License 2.0
 import pandas as pd
+import pytest
 from plinder.data.final_structure_qc import run_all_checks
 
 def test_final_structure_checks(
@@ -12,3 +13,21 @@ def test_final_structure_checks(
     df["ligand_rdkit_validation"] = df.ligand_rdkit_validation.astype("str")
     target_df = pd.read_csv(target_structure_validation_file, sep="\t")
     pd.testing.assert_frame_equal(df, target_df.fillna(""))
+
+
+def test_structure_cache_parses_once(tmp_path, monkeypatch):
+    from plinder.data import final_structure_qc
+
+    loaded = []
+
+    def load_structure(path, **kwargs):
+        loaded.append(path)
+        raise ValueError("unreadable")
+
+    monkeypatch.setattr(final_structure_qc, "load_structure", load_structure)
+    cache = final_structure_qc.StructureCache()
+    complex_file = tmp_path / "system.cif"
+    assert not final_structure_qc.file_loadbable_via_biotite(complex_file, cache)
+    with pytest.raises(ValueError):
+        final_structure_qc.all_protein_chains_present({"A"}, complex_file, cache)
+    assert loaded == [complex_file]
@@ -0,0 +1,250 @@
+# Copyright (c) 2024, Plinder Development Team
+# Distributed under the terms of the Apache License 2.0
+import pytest
+
+from plinder.data.utils.annotations import get_similarity_scores
+
+
+def test_entry_cache(tmp_path, monkeypatch):
+    loaded = []
+
+    def load_entries_from_zips(*, data_dir, pdb_ids, load_for_scoring):
+        loaded.append(sorted(pdb_ids))
+        return {pdb_id: f"entry {pdb_id}" for pdb_id in pdb_ids if pdb_id != "9xyz"}
+
+    monkeypatch.setattr(
+        get_similarity_scores, "load_entries_from_zips", load_entries_from_zips
+    )
+    cache = get_similarity_scores.EntryCache(maxsize=3)
+    entries = cache.get(data_dir=tmp_path, pdb_ids=["1abc", "2abc", "9xyz"])
+    assert entries == {"1abc": "entry 1abc", "2abc": "entry 2abc"}
+    entries = cache.get(data_dir=tmp_path, pdb_ids=["1abc", "9xyz", "3abc"])
+    assert entries == {"1abc": "entry 1abc", "3abc": "entry 3abc"}
+    # 2abc was the least recently used entry and got evicted
+    cache.get(data_dir=tmp_path, pdb_ids=["2abc"])
+    assert loaded == [["1abc", "2abc", "9xyz"], ["3abc"], ["2abc"]]
+    assert len(cache) == 3
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (2, 5)
+
+
+def test_map_residues():
+    from types import SimpleNamespace
+
+    import pandas as pd
+
+    def entry(residue_index_to_number):
+        chain = SimpleNamespace(
+            residue_index_to_number=residue_index_to_number,
+            residues={number: None for number in residue_index_to_number.values()},
+        )
+        return SimpleNamespace(chains={"A": chain})
+
+    scorer = get_similarity_scores.Scorer.__new__(get_similarity_scores.Scorer)
+    scorer.entries = {"1abc": entry({0: 10, 2: 12, 3: 3}), "2abc": entry({0: 5, 3: 8})}
+    df = pd.DataFrame(
+        {
+            "qaln": ["AC-DE"],
+            "taln": ["A-CDE"],
+            "qstart": [1],
+            "tstart": [1],
+            "query_entry": ["1abc"],
+            "query_chain_mapped": ["A"],
+            "target_entry": ["2abc"],
+            "target_chain_mapped": ["A"],
+            "lddtfull": ["0.5,0.6,0.7"],
+        }
+    )
+    row = scorer.map_residues(df, aln_type="foldseek", search_db="holo").iloc[0]
+    assert row["qrnum_pos"].tolist() == [0, 3, 4]
+    assert row["qrnum"].tolist() == [10, 12, 3]
+    assert row["trnum_pos"].tolist() == [0, 4]
+    assert row["trnum"].tolist() == [5, 8]
+    assert row["lddtfull"].tolist() == [0.5, 0.6, 0.7]
+    row = scorer.map_residues(df, aln_type="mmseqs", search_db="pred").iloc[0]
+    assert (row["qrnum_pos"].tolist(), row["qrnum"].tolist()) == ([4], [3])
+    assert len(row["trnum"]) == len(row["lddtfull"]) == 0
+
+
+def test_load_alignments(tmp_path):
+    import numpy as np
+    import pandas as pd
+
+    scorer = get_similarity_scores.Scorer.__new__(get_similarity_scores.Scorer)
+    # written by an older version with (position, value) pairs
+    pd.DataFrame(
+        {
+            "qaln": ["AC"],
+            "taln": ["AC"],
+            "qrnum": [[(0, 10), (1, 11)]],
+            "trnum": [[(1, 5)]],
+            "lddtfull": [[(0, 0.5), (1, 0.25)]],
+        }
+    ).to_parquet(tmp_path / "1abc.parquet")
+    df = scorer.load_alignments({"holo_foldseek": tmp_path / "1abc.parquet"})
+    row = df.iloc[0]
+    assert row["qrnum_pos"].tolist() == [0, 1]
+    assert row["qrnum"].dtype == np.int32
+    assert row["trnum_pos"].tolist() == [1]
+    assert row["lddtfull"].tolist() == [0.5, 0.25]
+
+
+def test_get_sequence_similarities():
+    import numpy as np
+
+    pairs = [("AC-DEX", "ACW-EA"), ("MKV", "MRV"), ("A-", "-A"), ("A1C", "AAC")]
+    identity, similarity = get_similarity_scores.get_sequence_similarities(
+        [q for q, _ in pairs], [t for _, t in pairs]
+    )
+    for i, (q, t) in enumerate(pairs[:2]):
+        expected = get_similarity_scores.get_sequence_similarity(q, t)
+        assert np.allclose((identity[i], similarity[i]), expected)
+    # no ungapped columns or unknown symbols
+    assert identity[2:].tolist() == similarity[2:].tolist() == [0.0, 0.0]
+
+
+class _FakeScorer(get_similarity_scores.Scorer):
+    def get_score_df(self, data_dir, pdb_id, search_db, overwrite=True):
+        import pandas as pd
+
+        path = self.db_dir / f"search_db={search_db}" / f"{pdb_id}.parquet"
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.entry_cache.misses += 1
+        if pdb_id != "3abc":
+            pd.DataFrame(
+                {
+                    "query_system": [f"{pdb_id}__1__1.A__1.B"],
+                    "target_system": ["9xyz__1__1.A__1.B"],
+                    "protein_mapping": ["1.A:1.A"],
+                    "mapping": ["1.A:1.A"],
+                    "protein_mapper": ["foldseek"],
+                    "source": ["both"],
+                    "metric": ["pli_qcov"],
+                    "similarity": [int(pdb_id[0]) * 10],
+                }
+            ).to_parquet(path, index=False)
+        return path
+
+
+@pytest.mark.parametrize("cpu", [1, 2])
+def test_aggregate_batch_scores(cpu, tmp_path):
+    import pandas as pd
+
+    scorer = _FakeScorer(
+        entries={},
+        source_to_full_db_file={},
+        db_dir=tmp_path / "dbs",
+        scores_dir=tmp_path / "scores",
+    )
+    scorer.aggregate_batch_scores(
+        data_dir=tmp_path,
+        batch_id="batch",
+        pdb_ids=["1abc", "2abc", "3abc"],
+        search_db="holo",
+        cpu=cpu,
+    )
+    df = pd.read_parquet(tmp_path / "scores" / "search_db=holo" / "batch.parquet")
+    assert df["similarity"].tolist() == [20, 10]
+
+
+def test_score_workers_reused_across_search_dbs(tmp_path, monkeypatch):
+    import re
+
+    messages = []
+    monkeypatch.setattr(get_similarity_scores.LOG, "info", messages.append)
+    scorer = _FakeScorer(
+        entries={},
+        source_to_full_db_file={},
+        db_dir=tmp_path / "dbs",
+        scores_dir=tmp_path / "scores",
+    )
+    with scorer.score_workers(2) as pool:
+        for search_db in ["holo", "apo"]:
+            scorer.aggregate_batch_scores(
+                data_dir=tmp_path,
+                batch_id="batch",
+                pdb_ids=["1abc", "2abc", "3abc"],
+                search_db=search_db,
+                pool=pool,
+            )
+        pids = set(pool._processes)
+    for search_db in ["holo", "apo"]:
+        assert (
+            tmp_path / "scores" / f"search_db={search_db}" / "batch.parquet"
+        ).is_file()
+    # the caches of the workers outlive a search_db
+    misses = {}
+    for message in messages:
+        match = re.match(r"entry cache of worker (\d+) .*'misses': (\d+)", message)
+        if match is not None:
+            pid, count = int(match.group(1)), int(match.group(2))
+            misses[pid] = max(misses.get(pid, 0), count)
+    assert set(misses).issubset(pids)
+    assert sum(misses.values()) == 6
+
+
+def test_run_batch_alignments(tmp_path, monkeypatch):
+    import pandas as pd
+
+    calls = []
+
+    def make_sub_db(db_ids, full_db, sub_db, aln_type):
+        calls.append(("make_sub_db", aln_type))
+
+    def run(cmd):
+        calls.append(tuple(cmd))
+
+    def run_alignment(*, aln_type, aln_file, db_load_mode, **kwargs):
+        calls.append(("run_alignment", aln_type, aln_file.parent.name, db_load_mode))
+        out = aln_file.with_suffix(".parquet") / "query_pdb_id=1abc"
+        out.mkdir(parents=True)
+        pd.DataFrame({"target": ["2abc"]}).to_parquet(out / "part.parquet")
+
+    monkeypatch.setattr(get_similarity_scores.databases, "make_sub_db", make_sub_db)
+    monkeypatch.setattr(
+        get_similarity_scores.databases, "get_db_ids", lambda *a, **k: set()
+    )
+    monkeypatch.setattr(get_similarity_scores.databases, "run", run)
+    monkeypatch.setattr(get_similarity_scores, "run_alignment", run_alignment)
+    scorer = get_similarity_scores.Scorer.__new__(get_similarity_scores.Scorer)
+    scorer.entries = {}
+    scorer.db_dir = tmp_path / "subdbs"
+    scorer.source_to_full_db_file = {"holo_mmseqs": None, "holo_foldseek": None}
+    scorer.get_config = lambda search_db, aln_type: None
+    scorer.run_batch_alignments(
+        entry_ids=["1abc"],
+        search_dbs=["holo", "apo"],
+        output_folder=tmp_path / "batch",
+        preload_target_dbs=True,
+    )
+    # one query sub-database per alignment type, searched against both targets
+    assert [c for c in calls if c[0] == "make_sub_db"] == [
+        ("make_sub_db", "mmseqs"),
+        ("make_sub_db", "foldseek"),
+    ]
+    assert [c for c in calls if c[0] == "run_alignment"] == [
+        ("run_alignment", "mmseqs", "holo", 2),
+        ("run_alignment", "mmseqs", "apo", 2),
+        ("run_alignment", "foldseek", "holo", 2),
+        ("run_alignment", "foldseek", "apo", 2),
+    ]
+    # every target is loaded once per batch, before the searches
+    db_dir = scorer.db_dir
+    assert [c for c in calls if c[1] == "touchdb"] == [
+        ("mmseqs", "touchdb", str(db_dir / "holo_mmseqs" / "holo_mmseqs")),
+        ("mmseqs", "touchdb", str(db_dir / "apo_mmseqs" / "apo_mmseqs")),
+        ("foldseek", "touchdb", str(db_dir / "holo_foldseek" / "holo_foldseek")),
+        ("foldseek", "touchdb", str(db_dir / "apo_foldseek" / "apo_foldseek")),
+    ]
+    assert calls.index(
+        ("mmseqs", "touchdb", str(db_dir / "apo_mmseqs" / "apo_mmseqs"))
+    ) < calls.index(("run_alignment", "mmseqs", "holo", 2))
+    assert sorted(
+        p.relative_to(scorer.db_dir).as_posix()
+        for p in scorer.db_dir.rglob("*.parquet")
+    ) == [
+        "apo_foldseek/aln/1abc.parquet",
+        "apo_mmseqs/aln/1abc.parquet",
+        "holo_foldseek/aln/1abc.parquet",
+        "holo_mmseqs/aln/1abc.parquet",
+    ]
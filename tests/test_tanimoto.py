@@ -0,0 +1,133 @@
+# Copyright (c) 2024, Plinder Development Team
+# Distributed under the terms of the Apache License 2.0
+import numpy as np
+import pytest
+
+from plinder.data.utils import tanimoto
+
+
+@pytest.mark.parametrize("nbits, k", [(1024, 5), (100, 50)])
+def test_tanimoto_top_k(nbits, k):
+    rng = np.random.default_rng(0)
+    fingerprints = (rng.random((50, nbits)) < 0.1).astype(np.int8)
+    fingerprints[1] = 0
+    fingerprints[2] = 0
+    packed = tanimoto.pack_fingerprints(fingerprints)
+    assert packed.dtype == np.uint64
+    assert packed.shape == (50, -(-nbits // 64))
+    queries = [0, 1, 7]
+    indices, similarities = tanimoto.tanimoto_top_k(
+        packed[queries], packed, k, threads=2, query_block_size=2, target_block_size=16
+    )
+    assert indices.shape == similarities.shape == (3, min(k, 50))
+    a = fingerprints[queries].astype(bool)[:, None]
+    b = fingerprints.astype(bool)[None]
+    union = (a | b).sum(-1)
+    expected = np.where(union > 0, (a & b).sum(-1) / np.maximum(union, 1), 1.0)
+    for row in range(3):
+        np.testing.assert_allclose(
+            similarities[row], np.sort(expected[row])[::-1][: indices.shape[1]]
+        )
+        np.testing.assert_allclose(similarities[row], expected[row, indices[row]])
+    assert indices[0, 0] == 0
+    # two empty fingerprints are identical
+    assert set(indices[1, :2]) == {1, 2}
+    assert (similarities[1, :2] == 1.0).all()
+
+
+def test_fingerprint_store(tmp_path):
+    import pandas as pd
+
+    rng = np.random.default_rng(0)
+    fingerprints = (rng.random((20, 1024)) < 0.1).astype(np.int8)
+    fp_dir = tmp_path / "fingerprints"
+    fp_dir.mkdir()
+    tanimoto.save_fingerprints(
+        fp_dir / tanimoto.FINGERPRINTS_FILE,
+        tanimoto.pack_fingerprints(fingerprints),
+        radius=2,
+        nbits=1024,
+        id_column="number_id_by_inchikeys",
+    )
+    packed, header = tanimoto.load_fingerprints(fp_dir / tanimoto.FINGERPRINTS_FILE)
+    assert isinstance(packed, np.memmap)
+    assert packed.shape == (20, 16)
+    assert header["radius"] == 2 and header["nbits"] == 1024
+    np.testing.assert_array_equal(
+        np.unpackbits(packed.view(np.uint8), axis=1, bitorder="little"), fingerprints
+    )
+    pd.DataFrame({"number_id_by_inchikeys": range(20)}).to_parquet(
+        fp_dir / "ligands_per_inchikey.parquet"
+    )
+    output_path = tmp_path / "scores.parquet"
+    tanimoto.ligand_scores(
+        ligand_ids=[3, 5],
+        data_dir=tmp_path,
+        output_path=output_path,
+        save_top_k_similar_ligands=4,
+    )
+    scores = pd.read_parquet(output_path)
+    assert len(scores) == 8
+    assert scores.groupby("query_ligand_id").tanimoto_similarity_max.max().tolist() == [
+        100,
+        100,
+    ]
+    with pytest.raises(ValueError, match="ordered by"):
+        tanimoto.ligand_scores(
+            ligand_ids=[3],
+            data_dir=tmp_path,
+            output_path=output_path,
+            number_id_col="other",
+        )
+
+
+def test_compute_ligand_fingerprints_cache(tmp_path, monkeypatch):
+    import pandas as pd
+
+    from plinder.data import smallmolecules
+
+    smiles = ["CCO", "c1ccccc1", "CC(=O)O", "CCO"]
+    (tmp_path / "ligands").mkdir()
+    pd.DataFrame(
+        {
+            "pdb_id": ["1abc"] * 4,
+            "system_id": ["s1", "s1", "s2", "s3"],
+            "ligand_rdkit_canonical_smiles": smiles,
+            "ligand_ccd_code": ["a", "b", "c", "a"],
+            "ligand_id": ["l1", "l2", "l3", "l4"],
+            "inchikeys": [smallmolecules.smil2inchikey(smi) for smi in smiles],
+        }
+    ).to_parquet(tmp_path / "ligands" / "batch.parquet", index=False)
+    cache_dir = tmp_path / "cache"
+    fp_file = tmp_path / "fingerprints" / tanimoto.FINGERPRINTS_FILE
+    tanimoto.compute_ligand_fingerprints(data_dir=tmp_path, cpu=2, cache_dir=cache_dir)
+    packed, _ = tanimoto.load_fingerprints(fp_file)
+    packed = np.array(packed)
+    unique = pd.read_parquet(tmp_path / "fingerprints" / "ligands_per_inchikey.parquet")
+    expected = np.stack([
+        tanimoto.get_ecfp_fingerprint(smi, 2, 1024)
+        for smi in unique["ligand_rdkit_canonical_smiles"]
+    ])
+    np.testing.assert_array_equal(
+        np.unpackbits(packed.view(np.uint8), axis=1, bitorder="little"), expected
+    )
+    assert tanimoto.get_inchikeys(["CCO", "C"], cache_dir=cache_dir) == {
+        "CCO": smallmolecules.smil2inchikey("CCO"),
+        "C": smallmolecules.smil2inchikey("C"),
+    }
+
+    # nothing is recomputed from the cache
+    def fail(*args, **kwargs):
+        raise AssertionError("recomputed")
+
+    monkeypatch.setattr(tanimoto, "_packed_ecfp_fingerprint", fail)
+    monkeypatch.setattr(smallmolecules, "smil2inchikey", fail)
+    fp_file.unlink()
+    tanimoto.compute_ligand_fingerprints(data_dir=tmp_path, cache_dir=cache_dir)
+    np.testing.assert_array_equal(tanimoto.load_fingerprints(fp_file)[0], packed)
+    assert tanimoto.get_inchikeys(["CCO"], cache_dir=cache_dir)["CCO"]
+    # a different radius is cached separately
+    with pytest.raises(AssertionError, match="recomputed"):
+        tanimoto.compute_ligand_fingerprints(
+            data_dir=tmp_path, radius=3, cache_dir=cache_dir
+        )